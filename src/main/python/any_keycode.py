@@ -1,7 +1,6 @@
-import ast
-
-import simpleeval
 import operator
+import re
+from collections import OrderedDict
 
 from keycodes.keycodes import KEYCODES_SPECIAL, KEYCODES_BASIC, KEYCODES_SHIFTED, KEYCODES_ISO, KEYCODES_BACKLIGHT, \
     KEYCODES_MEDIA, KEYCODES_USER, Keycode
@@ -91,28 +90,157 @@ for x in range(16):
     functions["LT{}".format(x)] = lambda kc, layer=x: (r("QK_LAYER_TAP") | (((layer)&0xF) << 8) | ((kc)&0xFF))
 
 
+TOKEN_RE = re.compile(r"\s*(?:(0[xX][0-9a-fA-F]+|0[bB][01]+|[0-9]+)|([A-Za-z_][A-Za-z0-9_]*)|(<<|>>|[|^&+\-*~(),]))")
+
+# binary operators from the lowest to the highest precedence, same as in python
+BINARY_OPERATORS = [
+    {"|": operator.or_},
+    {"^": operator.xor},
+    {"&": operator.and_},
+    {"<<": operator.lshift, ">>": operator.rshift},
+    {"+": operator.add, "-": operator.sub},
+    {"*": operator.mul},
+]
+
+UNARY_OPERATORS = {"-": operator.neg, "+": operator.pos, "~": operator.invert}
+
+# how many decoded expressions to remember
+CACHE_SIZE = 4096
+
+
+class KeycodeExpression:
+    """
+    Recursive descent parser for keycode expressions, e.g. LT(1, KC_SPC) or LCTL(KC_A) | QK_LSFT.
+    Every name resolves to a constant, so compiling an expression folds it down to a single integer.
+    """
+
+    def __init__(self, text, names):
+        self.text = text
+        self.names = names
+        self.tokens = self.tokenize(text)
+        self.pos = 0
+
+    @staticmethod
+    def tokenize(text):
+        tokens = []
+        pos = 0
+        text = text.rstrip()
+        while pos < len(text):
+            m = TOKEN_RE.match(text, pos)
+            if m is None:
+                raise ValueError("unexpected character {!r} in expression {!r}".format(text[pos:].lstrip()[0], text))
+            number, name, op = m.groups()
+            if number is not None:
+                tokens.append(("number", int(number, 0)))
+            elif name is not None:
+                tokens.append(("name", name))
+            else:
+                tokens.append(("op", op))
+            pos = m.end()
+        return tokens
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None, None
+
+    def expect(self, op):
+        if self.peek() != ("op", op):
+            raise ValueError("expected {!r} in expression {!r}".format(op, self.text))
+        self.pos += 1
+
+    def compile(self):
+        if not self.tokens:
+            raise ValueError("empty expression")
+        value = self.binary(0)
+        if self.pos != len(self.tokens):
+            raise ValueError("unexpected {!r} in expression {!r}".format(self.peek()[1], self.text))
+        return value
+
+    def binary(self, level):
+        if level == len(BINARY_OPERATORS):
+            return self.unary()
+        value = self.binary(level + 1)
+        while True:
+            kind, op = self.peek()
+            if kind != "op" or op not in BINARY_OPERATORS[level]:
+                return value
+            self.pos += 1
+            value = BINARY_OPERATORS[level][op](value, self.binary(level + 1))
+
+    def unary(self):
+        kind, op = self.peek()
+        if kind == "op" and op in UNARY_OPERATORS:
+            self.pos += 1
+            return UNARY_OPERATORS[op](self.unary())
+        return self.primary()
+
+    def primary(self):
+        kind, value = self.peek()
+        self.pos += 1
+        if kind == "number":
+            return value
+        if kind == "op" and value == "(":
+            value = self.binary(0)
+            self.expect(")")
+            return value
+        if kind == "name":
+            if self.peek() == ("op", "("):
+                if value not in functions:
+                    raise ValueError("unknown function {!r} in expression {!r}".format(value, self.text))
+                return functions[value](*self.arguments())
+            if value not in self.names:
+                raise ValueError("unknown name {!r} in expression {!r}".format(value, self.text))
+            return self.names[value]
+        if kind is None:
+            raise ValueError("unexpected end of expression {!r}".format(self.text))
+        raise ValueError("unexpected {!r} in expression {!r}".format(value, self.text))
+
+    def arguments(self):
+        self.expect("(")
+        args = []
+        if self.peek() != ("op", ")"):
+            args.append(self.binary(0))
+            while self.peek() == ("op", ","):
+                self.pos += 1
+                args.append(self.binary(0))
+        self.expect(")")
+        return args
+
+
 class AnyKeycode:
 
-    def __init__(self):
-        self.ops = simpleeval.DEFAULT_OPERATORS.copy()
-        self.ops.update({
-            ast.BitOr: operator.or_,
-            ast.BitXor: operator.xor,
-            ast.BitAnd: operator.and_,
-        })
-        self.names = dict()
-        self.prepare_names()
-
-    def prepare_names(self):
+    # name table and decoded expressions, valid for a single (Keycode.protocol, Keycode.generation)
+    names = dict()
+    names_for = None
+    cache = OrderedDict()
+
+    @classmethod
+    def prepare_names(cls):
+        key = (Keycode.protocol, Keycode.generation)
+        if cls.names_for == key:
+            return
+        names = dict()
         for kc in KEYCODES_SPECIAL + KEYCODES_BASIC + KEYCODES_SHIFTED + KEYCODES_ISO + KEYCODES_BACKLIGHT + \
                   KEYCODES_MEDIA + KEYCODES_USER:
             for qmk_id in kc.alias:
-                self.names[qmk_id] = Keycode.resolve(kc.qmk_id)
-        macros = dict()
+                names[qmk_id] = Keycode.resolve(kc.qmk_id)
         for s in ["MOD_LCTL", "MOD_LSFT", "MOD_LALT", "MOD_LGUI", "MOD_RCTL", "MOD_RSFT", "MOD_RALT", "MOD_RGUI",
                   "MOD_MEH", "MOD_HYPR"]:
-            macros[s] = Keycode.resolve(s)
-        self.names.update(macros)
-
-    def decode(self, s):
-        return simpleeval.simple_eval(s, names=self.names, functions=functions, operators=self.ops)
+            names[s] = Keycode.resolve(s)
+        cls.names = names
+        cls.names_for = key
+        cls.cache.clear()
+
+    @classmethod
+    def decode(cls, s):
+        cls.prepare_names()
+        value = cls.cache.get(s)
+        if value is not None:
+            cls.cache.move_to_end(s)
+            return value
+        value = KeycodeExpression(s, cls.names).compile()
+        cls.cache[s] = value
+        if len(cls.cache) > CACHE_SIZE:
+            cls.cache.popitem(last=False)
+        return value
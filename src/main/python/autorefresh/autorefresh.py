@@ -26,6 +26,8 @@ class Autorefresh(QObject):
     device_opened = pyqtSignal(object)
     # Emitted when an error occurs during async device open (payload: error code or message)
     device_error = pyqtSignal(str)
+    # Emitted as each reload stage of an asynchronously opened keyboard completes (device, stage)
+    device_stage = pyqtSignal(object, str)
 
     def __init__(self):
         super().__init__()
@@ -43,6 +45,10 @@ class Autorefresh(QObject):
             from autorefresh.autorefresh_thread_win import AutorefreshThreadWin
 
             self.thread = AutorefreshThreadWin()
+        elif sys.platform.startswith("linux"):
+            from autorefresh.autorefresh_thread_linux import AutorefreshThreadLinux
+
+            self.thread = AutorefreshThreadLinux()
         else:
             from autorefresh.autorefresh_thread import AutorefreshThread
 
@@ -108,13 +114,16 @@ class Autorefresh(QObject):
         self.current_device = dev
 
         def _open_worker(d):
+            def on_stage(stage):
+                self.device_stage.emit(d, stage)
+
             try:
                 if d.sideload:
-                    d.open(self.thread.sideload_json)
+                    d.open(self.thread.sideload_json, on_stage)
                 elif d.via_stack:
-                    d.open(self.thread.via_stack_json["definitions"][d.via_id])
+                    d.open(self.thread.via_stack_json["definitions"][d.via_id], on_stage)
                 else:
-                    d.open(None)
+                    d.open(None, on_stage)
                 # let autorefresh thread know about current device
                 self.thread.set_device(d)
                 # notify listeners on the main thread
@@ -13,7 +13,7 @@ else:
 
 from PyQt6.QtCore import pyqtSignal, QThread
 
-from util import find_vial_devices
+from util import find_vial_devices, DeviceRegistry
 
 
 class AutorefreshThread(QThread):
@@ -26,7 +26,12 @@ class AutorefreshThread(QThread):
         self.current_device = None
         self.devices = []
         self.locked = False
+        # an update was skipped while lock()ed, e.g. a keyboard rebooting into the bootloader to be flashed
+        self.missed = False
         self.mutex = RLock()
+        # probe results are shared between updates from this thread and from the outside
+        self.registry = DeviceRegistry()
+        self.registry_mutex = RLock()
 
         self.sideload_json = None
         self.sideload_vid = self.sideload_pid = -1
@@ -45,13 +50,22 @@ class AutorefreshThread(QThread):
     def unlock(self):
         with self.mutex:
             self.locked = False
+            missed = self.missed
+        if missed:
+            self.wake()
+
+    def wake(self):
+        """ Asks the thread to update soon after changes were missed while locked, polling does so anyway """
+        pass
 
     # note that this method is called from both inside and outside of this thread
     def update(self, quiet=True, hard=False):
-        # if lock()ed then just do nothing
+        # if lock()ed then just do nothing, but remember to catch up once unlocked
         with self.mutex:
             if self.locked:
+                self.missed = True
                 return
+            self.missed = False
             # can be modified out of mutex so create local copies here
             via_stack_json = self.via_stack_json
             sideload_vid = self.sideload_vid
@@ -59,11 +73,14 @@ class AutorefreshThread(QThread):
 
         # this can take a long (~seconds) time on Windows, so run outside of mutex
         # to make sure calling lock() and unlock() is instant
-        new_devices = find_vial_devices(via_stack_json, sideload_vid, sideload_pid, quiet=quiet)
+        with self.registry_mutex:
+            new_devices = find_vial_devices(via_stack_json, sideload_vid, sideload_pid, quiet=quiet,
+                                            registry=self.registry, hard=hard)
 
         # this is fast again but discard results if we got lock()ed in between
         with self.mutex:
             if self.locked:
+                self.missed = True
                 return
 
             # if the set of the devices didn't change at all, don't need to update the combobox
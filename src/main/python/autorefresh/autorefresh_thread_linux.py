@@ -0,0 +1,91 @@
+import ctypes
+import logging
+import os
+import select
+import struct
+import time
+
+from autorefresh.autorefresh_thread import AutorefreshThread
+
+
+IN_ATTRIB = 0x00000004
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+
+# struct inotify_event header: wd, mask, cookie, len; followed by len bytes of NUL-padded name
+INOTIFY_EVENT = struct.Struct("iIII")
+
+# udev creates the node and then fixes up its permissions, so wait for things to settle down before enumerating
+DEBOUNCE_SECONDS = 0.25
+# but don't let a steady stream of unrelated /dev events hold the rescan back for longer than this
+DEBOUNCE_MAX_SECONDS = 1.0
+
+
+def watch_dev():
+    """ Returns an inotify fd watching /dev for nodes being added, removed or having permissions changed """
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    fd = libc.inotify_init1(os.O_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    if libc.inotify_add_watch(fd, b"/dev", IN_CREATE | IN_DELETE | IN_ATTRIB) < 0:
+        err = ctypes.get_errno()
+        os.close(fd)
+        raise OSError(err, "inotify_add_watch failed")
+    return fd
+
+
+def hidraw_changed(buf):
+    """ Checks whether a batch of inotify events has anything to do with hidraw nodes """
+
+    pos = 0
+    while pos + INOTIFY_EVENT.size <= len(buf):
+        wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(buf, pos)
+        name = buf[pos + INOTIFY_EVENT.size:pos + INOTIFY_EVENT.size + length].rstrip(b"\x00")
+        pos += INOTIFY_EVENT.size + length
+        if mask & IN_Q_OVERFLOW or name.startswith(b"hidraw"):
+            return True
+    return False
+
+
+class AutorefreshThreadLinux(AutorefreshThread):
+
+    def __init__(self):
+        super().__init__()
+        # written to by wake() so that the thread rescans even without anything happening in /dev
+        self.wake_r, self.wake_w = os.pipe()
+        os.set_blocking(self.wake_w, False)
+
+    def wake(self):
+        try:
+            os.write(self.wake_w, b"\x00")
+        except BlockingIOError:
+            # plenty of wakeups are pending already
+            pass
+
+    def run(self):
+        try:
+            fd = watch_dev()
+        except (OSError, AttributeError) as e:
+            logging.warning("autorefresh: cannot watch /dev for hidraw changes ({}), falling back to polling".format(e))
+            return super().run()
+
+        self.update()
+        while True:
+            readable = select.select([fd, self.wake_r], [], [])[0]
+            changed = False
+            if self.wake_r in readable:
+                os.read(self.wake_r, 4096)
+                changed = True
+            if fd in readable:
+                changed = hidraw_changed(os.read(fd, 4096)) or changed
+            deadline = time.monotonic() + DEBOUNCE_MAX_SECONDS
+            while True:
+                timeout = min(DEBOUNCE_SECONDS, deadline - time.monotonic())
+                if timeout <= 0 or not select.select([fd], [], [], timeout)[0]:
+                    break
+                changed = hidraw_changed(os.read(fd, 4096)) or changed
+
+            if changed:
+                self.update()
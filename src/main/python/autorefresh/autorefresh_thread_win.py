@@ -23,6 +23,10 @@ def device_changed(hwnd, msg, wp, lp):
 
 class AutorefreshThreadWin(AutorefreshThread):
 
+    def wake(self):
+        global g_device_changes
+        g_device_changes += 1
+
     def run(self):
         global g_device_changes
 
@@ -3,12 +3,15 @@ from PyQt6 import QtCore
 from PyQt6.QtCore import Qt, pyqtSignal, QObject
 from PyQt6.QtWidgets import QWidget, QSizePolicy, QGridLayout, QHBoxLayout, QVBoxLayout, QLabel, QCheckBox, QScrollArea, QFrame, QToolButton
 
+from keycodes.keycodes import RESET_KEYCODE
 from protocol.constants import VIAL_PROTOCOL_DYNAMIC
+from protocol.io_worker import call_async, log_failure
 from util import make_scrollable, tr
 from widgets.key_widget import KeyWidget
 from protocol.alt_repeat_key import AltRepeatKeyOptions, AltRepeatKeyEntry
 from vial_device import VialKeyboard
 from editor.basic_editor import BasicEditor
+from protocol.keyboard_comm import STAGE_DYNAMIC
 from widgets.checkbox_no_padding import CheckBoxNoPadding
 from widgets.tab_widget_keycodes import TabWidgetWithKeycodes
 
@@ -177,6 +180,8 @@ class AltRepeatKeyEntryUI(QObject):
 
 class AltRepeatKey(BasicEditor):
 
+    stage = STAGE_DYNAMIC
+
     def __init__(self):
         super().__init__()
         self.keyboard = None
@@ -212,5 +217,12 @@ class AltRepeatKey(BasicEditor):
                 and self.device.keyboard.alt_repeat_key_count > 0)
 
     def on_change(self):
-        for x, e in enumerate(self.alt_repeat_key_entries):
-            self.keyboard.alt_repeat_key_set(x, self.alt_repeat_key_entries[x].save())
+        keyboard = self.keyboard
+        entries = [e.save() for e in self.alt_repeat_key_entries]
+
+        def save():
+            for x, entry in enumerate(entries):
+                keyboard.alt_repeat_key_set(x, entry)
+
+        call_async(keyboard, save, log_failure,
+                   unlock=any(RESET_KEYCODE in (entry.keycode, entry.alt_keycode) for entry in entries))
@@ -1,8 +1,13 @@
 from PyQt6.QtWidgets import QVBoxLayout
 
+from protocol.keyboard_comm import STAGE_LAYOUT
+
 
 class BasicEditor(QVBoxLayout):
 
+    # reload stage of the keyboard this editor needs to be complete before it can be shown
+    stage = STAGE_LAYOUT
+
     def __init__(self, parent=None):
         super().__init__(parent)
 
@@ -11,9 +16,17 @@ class BasicEditor(QVBoxLayout):
     def valid(self):
         raise NotImplementedError
 
+    def loaded(self, device):
+        keyboard = getattr(device, "keyboard", None)
+        return keyboard is None or self.stage in keyboard.loaded_stages
+
     def rebuild(self, device):
         self.device = device
 
+    def on_stage_loaded(self, stage):
+        """ Called when a further reload stage of the current keyboard completes """
+        pass
+
     def on_container_clicked(self):
         pass
 
@@ -3,10 +3,13 @@ from PyQt6 import QtCore
 from PyQt6.QtCore import pyqtSignal, QObject
 from PyQt6.QtWidgets import QWidget, QSizePolicy, QGridLayout, QVBoxLayout, QLabel
 
+from keycodes.keycodes import RESET_KEYCODE
 from protocol.constants import VIAL_PROTOCOL_DYNAMIC
+from protocol.io_worker import call_async, log_failure
 from widgets.key_widget import KeyWidget
 from vial_device import VialKeyboard
 from editor.basic_editor import BasicEditor
+from protocol.keyboard_comm import STAGE_DYNAMIC
 from widgets.tab_widget_keycodes import TabWidgetWithKeycodes
 from util import tr
 
@@ -75,6 +78,8 @@ class ComboEntryUI(QObject):
 
 class Combos(BasicEditor):
 
+    stage = STAGE_DYNAMIC
+
     def __init__(self):
         super().__init__()
         self.keyboard = None
@@ -110,5 +115,11 @@ class Combos(BasicEditor):
                 and self.device.keyboard.combo_count > 0)
 
     def on_key_changed(self):
-        for x, e in enumerate(self.combo_entries):
-            self.keyboard.combo_set(x, self.combo_entries[x].save())
+        keyboard = self.keyboard
+        entries = [e.save() for e in self.combo_entries]
+
+        def save():
+            for x, entry in enumerate(entries):
+                keyboard.combo_set(x, entry)
+
+        call_async(keyboard, save, log_failure, unlock=any(entry[-1] == RESET_KEYCODE for entry in entries))
@@ -13,6 +13,7 @@ from PyQt6.QtWidgets import QHBoxLayout, QLineEdit, QToolButton, QPlainTextEdit,
     QCheckBox
 
 from editor.basic_editor import BasicEditor
+from protocol.io_worker import call_async
 from unlocker import Unlocker
 from util import tr, chunks, find_vial_devices, pad_for_vibl
 from vial_device import VialBootloader, VialKeyboard
@@ -203,37 +204,69 @@ class FirmwareFlasher(BasicEditor):
 
         self.layout_restore = self.uid_restore = None
 
-        if isinstance(self.device, VialKeyboard):
-            # back up current layout
-            if self.chk_restore_keymap.isChecked():
-                self.log(tr("Flasher", "Backing up current layout..."))
-                self.layout_restore = self.device.keyboard.save_layout()
+        if not isinstance(self.device, VialKeyboard):
+            self.start_flash(firmware)
+            return
 
-            # keep track of which keyboard we should restore saved layout to
-            self.uid_restore = self.device.keyboard.get_uid()
-            firmware_uid = firmware[8:16]
-            if self.uid_restore != firmware_uid:
-                self.log(tr("Flasher", "Error: Firmware UID does not match keyboard UID. Check that you have the correct file"))
-                self.unlock_ui(False)
-                return
+        keyboard = self.device.keyboard
+        # back up current layout, keymap layers which are still loading are fetched by the worker first
+        if self.chk_restore_keymap.isChecked():
+            self.log(tr("Flasher", "Backing up current layout..."))
+            call_async(keyboard, keyboard.wait_keymap, lambda future: self.on_backup_loaded(firmware, future))
+        else:
+            call_async(keyboard, keyboard.get_uid, lambda future: self.on_uid(firmware, future))
 
-            Unlocker.unlock(self.device.keyboard)
+    def on_backup_loaded(self, firmware, future):
+        if future.exception() is not None:
+            self.log("Error: failed to back up the layout: {}".format(future.exception()))
+            self.unlock_ui(False)
+            return
+        keyboard = self.device.keyboard
+        self.layout_restore = keyboard.save_layout()
+        call_async(keyboard, keyboard.get_uid, lambda future: self.on_uid(firmware, future))
+
+    def on_uid(self, firmware, future):
+        if future.exception() is not None:
+            self.log("Error: failed to read the keyboard UID: {}".format(future.exception()))
+            self.unlock_ui(False)
+            return
 
-            self.log(tr("Flasher", "Restarting in bootloader mode..."))
-            self.device.keyboard.reset()
+        # keep track of which keyboard we should restore saved layout to
+        self.uid_restore = future.result()
+        firmware_uid = firmware[8:16]
+        if self.uid_restore != firmware_uid:
+            self.log(tr("Flasher", "Error: Firmware UID does not match keyboard UID. Check that you have the correct file"))
+            self.unlock_ui(False)
+            return
 
-            # watch for bootloaders to appear and ask them for their UID, return one that matches the keyboard
-            found = None
-            while found is None:
-                self.log(tr("Flasher", "Looking for devices..."))
-                QCoreApplication.processEvents()
-                time.sleep(1)
-                found = self.find_device_with_uid(VialBootloader, self.uid_restore)
+        Unlocker.unlock_async(self.device.keyboard, lambda future: self.on_unlocked(firmware, future))
 
-            self.log(tr("Flasher", "Found Vial Bootloader device at {}").format(found.desc["path"].decode("utf-8")))
-            found.open()
-            self.device = found
+    def on_unlocked(self, firmware, future):
+        if future.exception() is not None or not future.result():
+            self.log(tr("Flasher", "Error: The keyboard has to be unlocked to flash it"))
+            self.unlock_ui(False)
+            return
 
+        self.log(tr("Flasher", "Restarting in bootloader mode..."))
+        keyboard = self.device.keyboard
+        # the keyboard may well be gone before it answers, the bootloader showing up is what counts
+        call_async(keyboard, keyboard.reset, lambda future: self.on_reset(firmware))
+
+    def on_reset(self, firmware):
+        # watch for bootloaders to appear and ask them for their UID, return one that matches the keyboard
+        found = None
+        while found is None:
+            self.log(tr("Flasher", "Looking for devices..."))
+            QCoreApplication.processEvents()
+            time.sleep(1)
+            found = self.find_device_with_uid(VialBootloader, self.uid_restore)
+
+        self.log(tr("Flasher", "Found Vial Bootloader device at {}").format(found.desc["path"].decode("utf-8")))
+        found.open()
+        self.device = found
+        self.start_flash(firmware)
+
+    def start_flash(self, firmware):
         threading.Thread(target=lambda: cmd_flash(
             self.device, firmware, self.layout_restore is not None,
             self.on_log, self.on_progress, self.on_complete, self.on_error)).start()
@@ -273,12 +306,23 @@ class FirmwareFlasher(BasicEditor):
             found.open()
             self.device = found
             self.log(tr("Flasher", "Restoring saved layout..."))
-            QCoreApplication.processEvents()
-            found.keyboard.restore_layout(self.layout_restore)
-            found.keyboard.lock()
-            found.close()
-            self.log(tr("Flasher", "Done!"))
+            keyboard, data = found.keyboard, self.layout_restore
+
+            def restore():
+                keyboard.restore_layout(data)
+                keyboard.lock()
 
+            call_async(keyboard, restore, lambda future: self.on_layout_restored(found, future), unlock=True)
+            return
+
+        self.unlock_ui()
+
+    def on_layout_restored(self, found, future):
+        found.close()
+        if future.exception() is not None:
+            self.log("Error: failed to restore the layout: {}".format(future.exception()))
+        else:
+            self.log(tr("Flasher", "Done!"))
         self.unlock_ui()
 
     def _on_error(self, msg):
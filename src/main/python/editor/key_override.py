@@ -3,12 +3,15 @@ from PyQt6 import QtCore
 from PyQt6.QtCore import Qt, pyqtSignal, QObject
 from PyQt6.QtWidgets import QWidget, QSizePolicy, QGridLayout, QHBoxLayout, QVBoxLayout, QLabel, QCheckBox, QScrollArea, QFrame, QToolButton
 
+from keycodes.keycodes import RESET_KEYCODE
 from protocol.constants import VIAL_PROTOCOL_DYNAMIC
+from protocol.io_worker import call_async, log_failure
 from util import make_scrollable, tr
 from widgets.key_widget import KeyWidget
 from protocol.key_override import KeyOverrideOptions, KeyOverrideEntry
 from vial_device import VialKeyboard
 from editor.basic_editor import BasicEditor
+from protocol.keyboard_comm import STAGE_DYNAMIC
 from widgets.checkbox_no_padding import CheckBoxNoPadding
 from widgets.tab_widget_keycodes import TabWidgetWithKeycodes
 
@@ -260,6 +263,8 @@ class KeyOverrideEntryUI(QObject):
 
 class KeyOverride(BasicEditor):
 
+    stage = STAGE_DYNAMIC
+
     def __init__(self):
         super().__init__()
         self.keyboard = None
@@ -295,5 +300,12 @@ class KeyOverride(BasicEditor):
                 and self.device.keyboard.key_override_count > 0)
 
     def on_change(self):
-        for x, e in enumerate(self.key_override_entries):
-            self.keyboard.key_override_set(x, self.key_override_entries[x].save())
+        keyboard = self.keyboard
+        entries = [e.save() for e in self.key_override_entries]
+
+        def save():
+            for x, entry in enumerate(entries):
+                keyboard.key_override_set(x, entry)
+
+        call_async(keyboard, save, log_failure,
+                   unlock=any(entry.replacement == RESET_KEYCODE for entry in entries))
@@ -1,13 +1,16 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 import json
+import logging
 
-from PyQt6.QtWidgets import QHBoxLayout, QLabel, QVBoxLayout, QMessageBox, QWidget
+from PyQt6.QtWidgets import QHBoxLayout, QLabel, QVBoxLayout, QMessageBox, QWidget, QProgressDialog
 from PyQt6.QtCore import Qt, pyqtSignal
 
 from any_keycode_dialog import AnyKeycodeDialog
 from editor.basic_editor import BasicEditor
 from widgets.keyboard_widget import KeyboardWidget, EncoderWidget
-from keycodes.keycodes import Keycode
+from keycodes.keycodes import Keycode, RESET_KEYCODE
+from protocol.io_worker import call_async, call_on_gui, log_failure
+from protocol.keyboard_comm import STAGE_KEYMAP
 from widgets.square_button import SquareButton
 from tabbed_keycodes import TabbedKeycodes, keycode_filter_masked
 from util import tr, KeycodeDisplay
@@ -130,6 +133,10 @@ class KeymapEditor(BasicEditor):
     def valid(self):
         return isinstance(self.device, VialKeyboard)
 
+    def on_stage_loaded(self, stage):
+        if stage == STAGE_KEYMAP and self.valid():
+            self.refresh_layer_display()
+
     def save_layout(self):
         return self.keyboard.save_layout()
 
@@ -141,8 +148,25 @@ class KeymapEditor(BasicEditor):
                                        QMessageBox.Yes | QMessageBox.No)
             if ret != QMessageBox.Yes:
                 return
-        self.keyboard.restore_layout(data)
-        self.refresh_layer_display()
+
+        progress = QProgressDialog(tr("KeymapEditor", "Writing keymap to the keyboard..."), None, 0, 0, self.widget())
+        progress.setWindowModality(Qt.WindowModality.WindowModal)
+        progress.setMinimumDuration(500)
+
+        def set_progress(sent, total):
+            progress.setMaximum(total)
+            progress.setValue(sent)
+
+        def on_restored(future):
+            progress.close()
+            log_failure(future)
+            self.refresh_layer_display()
+
+        # a restore nearly always rewrites macros, which takes an unlocked keyboard
+        keyboard = self.keyboard
+        call_async(keyboard, lambda: keyboard.restore_layout(
+            data, progress=lambda sent, total: call_on_gui(keyboard, set_progress, sent, total)), on_restored,
+            unlock=True)
 
     def on_any_keycode(self):
         if self.container.active_key is None:
@@ -171,8 +195,6 @@ class KeymapEditor(BasicEditor):
     def refresh_layer_display(self):
         """ Refresh text on key widgets to display data corresponding to current layer """
 
-        self.container.update_layout()
-
         for idx, btn in enumerate(self.layer_buttons):
             btn.setEnabled(idx != self.current_layer)
             btn.setChecked(idx == self.current_layer)
@@ -181,11 +203,25 @@ class KeymapEditor(BasicEditor):
             code = self.code_for_widget(widget)
             KeycodeDisplay.display_keycode(widget, code)
         self.container.update()
-        self.container.updateGeometry()
 
     def switch_layer(self, idx):
         self.container.deselect()
         self.current_layer = idx
+        if not self.keyboard.layer_loaded(idx):
+            # fetched ahead of whatever else is loading, the keys stay disabled until it arrives
+            self.container.setEnabled(False)
+            keyboard = self.keyboard
+            call_async(keyboard, lambda: keyboard.ensure_layer(idx), self.on_layer_loaded)
+        self.refresh_layer_display()
+
+    def on_key_written(self, future):
+        log_failure(future)
+        self.refresh_layer_display()
+
+    def on_layer_loaded(self, future):
+        if future.exception() is not None:
+            logging.warning("failed to load a layer of the keymap: {}".format(future.exception()))
+        self.container.setEnabled(self.valid())
         self.refresh_layer_display()
 
     def set_key(self, keycode):
@@ -214,8 +250,9 @@ class KeymapEditor(BasicEditor):
                 return
             keycode = kc.qmk_id.replace("(kc)", "({})".format(keycode))
 
-        self.keyboard.set_encoder(l, i, d, keycode)
-        self.refresh_layer_display()
+        keyboard = self.keyboard
+        call_async(keyboard, lambda: keyboard.set_encoder(l, i, d, keycode), self.on_key_written,
+                   unlock=keycode == RESET_KEYCODE and keyboard.encoder_layout[(l, i, d)] != keycode)
 
     def set_key_matrix(self, keycode):
         l, r, c = self.current_layer, self.container.active_key.desc.row, self.container.active_key.desc.col
@@ -230,8 +267,9 @@ class KeymapEditor(BasicEditor):
                     return
                 keycode = kc.qmk_id.replace("(kc)", "({})".format(keycode))
 
-            self.keyboard.set_key(l, r, c, keycode)
-            self.refresh_layer_display()
+            keyboard = self.keyboard
+            call_async(keyboard, lambda: keyboard.set_key(l, r, c, keycode), self.on_key_written,
+                       unlock=keycode == RESET_KEYCODE and keyboard.layout[(l, r, c)] != keycode)
 
     def on_key_clicked(self):
         """ Called when a key on the keyboard widget is clicked """
@@ -248,8 +286,10 @@ class KeymapEditor(BasicEditor):
         if self.keyboard is None:
             return
 
+        self.container.update_layout()
         self.refresh_layer_display()
-        self.keyboard.set_layout_options(self.layout_editor.pack())
+        keyboard, options = self.keyboard, self.layout_editor.pack()
+        call_async(keyboard, lambda: keyboard.set_layout_options(options), log_failure)
 
     def on_keymap_override(self):
         self.refresh_layer_display()
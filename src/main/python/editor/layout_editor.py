@@ -111,9 +111,6 @@ class LayoutEditor(BasicEditor):
 
     def update_preview(self):
         self.keyboard_preview.set_keys(self.keyboard.keys, self.keyboard.encoders)
-        self.keyboard_preview.update_layout()
-        self.keyboard_preview.update()
-        self.keyboard_preview.updateGeometry()
 
     def rebuild(self, device):
         super().rebuild(device)
@@ -167,4 +164,4 @@ class LayoutEditor(BasicEditor):
 
     def on_changed(self):
         self.changed.emit()
-        self.update_preview()
+        self.keyboard_preview.update_layout()
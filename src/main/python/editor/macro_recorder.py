@@ -4,12 +4,13 @@ import sys
 from PyQt6.QtWidgets import QPushButton, QHBoxLayout, QWidget, QLabel
 
 from editor.basic_editor import BasicEditor
+from protocol.keyboard_comm import STAGE_MACROS
 from macro.macro_action import ActionText, ActionTap, ActionDown, ActionUp
 from macro.macro_action_ui import ui_action
 from macro.macro_key import KeyString, KeyDown, KeyUp, KeyTap
 from macro.macro_optimizer import macro_optimize
 from macro.macro_tab import MacroTab
-from unlocker import Unlocker
+from protocol.io_worker import call_async, log_failure
 from util import tr
 from vial_device import VialKeyboard
 from widgets.tab_widget_keycodes import TabWidgetWithKeycodes
@@ -17,6 +18,8 @@ from widgets.tab_widget_keycodes import TabWidgetWithKeycodes
 
 class MacroRecorder(BasicEditor):
 
+    stage = STAGE_MACROS
+
     def __init__(self):
         super().__init__()
 
@@ -173,11 +176,17 @@ class MacroRecorder(BasicEditor):
         self.suppress_change = False
 
     def on_revert(self):
-        self.keyboard.reload_macros()
+        call_async(self.keyboard, self.keyboard.reload_macros, self.on_reverted)
+
+    def on_reverted(self, future):
+        log_failure(future)
         self.deserialize(self.keyboard.macro)
         self.on_change()
 
     def on_save(self):
-        Unlocker.unlock(self.device.keyboard)
-        self.keyboard.set_macro(self.serialize())
+        keyboard, data = self.keyboard, self.serialize()
+        call_async(keyboard, lambda: keyboard.set_macro(data), self.on_saved, unlock=True)
+
+    def on_saved(self, future):
+        log_failure(future)
         self.on_change()
@@ -6,6 +6,7 @@ import math
 
 from editor.basic_editor import BasicEditor
 from protocol.constants import VIAL_PROTOCOL_MATRIX_TESTER
+from protocol.io_worker import call_async, log_failure, PRIORITY_POLLING
 from widgets.keyboard_widget import KeyboardWidget
 from util import tr
 from vial_device import VialKeyboard
@@ -21,6 +22,7 @@ class MatrixTest(BasicEditor):
 
         self.keyboardWidget = KeyboardWidget(layout_editor)
         self.keyboardWidget.set_enabled(False)
+        layout_editor.changed.connect(self.keyboardWidget.update_layout)
 
         self.unlock_btn = QPushButton(tr("MatrixTest", "Unlock"))
         self.unlock_btn.setMinimumSize(120, 40)
@@ -62,6 +64,7 @@ class MatrixTest(BasicEditor):
 
     def rebuild(self, device):
         super().rebuild(device)
+        self.polling = False
         if self.valid():
             self.keyboard = device.keyboard
 
@@ -80,22 +83,38 @@ class MatrixTest(BasicEditor):
             w.setPressed(False)
             w.setOn(False)
 
-        self.keyboardWidget.update_layout()
         self.keyboardWidget.update()
-        self.keyboardWidget.updateGeometry()
 
     def matrix_poller(self):
         if not self.valid():
             self.timer.stop()
             return
 
+        # the previous poll is still waiting for the device
+        if self.polling:
+            return
+        self.polling = True
+        call_async(self.keyboard, self.poll_matrix, self.on_matrix_polled, PRIORITY_POLLING)
+
+    def poll_matrix(self):
+        """ Runs on the device's I/O worker, returns matrix state or None if the keyboard is locked """
+
+        if not self.keyboard.get_unlock_status(3):
+            return None
+        return self.keyboard.matrix_poll()
+
+    def on_matrix_polled(self, future):
+        self.polling = False
+        if not self.timer.isActive() or not self.valid():
+            return
+
         try:
-            unlocked = self.keyboard.get_unlock_status(3)
+            data = future.result()
         except (RuntimeError, ValueError):
             self.timer.stop()
             return
 
-        if not unlocked:
+        if data is None:
             self.unlock_btn.show()
             self.unlock_lbl.show()
             return
@@ -110,13 +129,6 @@ class MatrixTest(BasicEditor):
         # Generate 2d array of matrix
         matrix = [[None] * cols for x in range(rows)]
 
-        # Get matrix data from keyboard
-        try:
-            data = self.keyboard.matrix_poll()
-        except (RuntimeError, ValueError):
-            self.timer.stop()
-            return
-
         # Calculate the amount of bytes belong to 1 row, each bit is 1 key, so per 8 keys in a row,
         # a byte is needed for the row.
         row_size = math.ceil(cols / 8)
@@ -136,23 +148,25 @@ class MatrixTest(BasicEditor):
                 # write to matrix array
                 matrix[row][col] = (row_data[col_byte] >> col_mod) & 1
 
-        # write matrix state to keyboard widget
+        # write matrix state to keyboard widget, only keys which changed get repainted
+        changed = []
         for w in self.keyboardWidget.widgets:
             if w.desc.row is not None and w.desc.col is not None:
                 row = w.desc.row
                 col = w.desc.col
 
                 if row < len(matrix) and col < len(matrix[row]):
-                    w.setPressed(matrix[row][col])
-                    if matrix[row][col]:
-                        w.setOn(True)
+                    pressed = bool(matrix[row][col])
+                    if pressed != bool(w.pressed) or (pressed and not w.on):
+                        w.setPressed(pressed)
+                        if pressed:
+                            w.setOn(True)
+                        changed.append(w)
 
-        self.keyboardWidget.update_layout()
-        self.keyboardWidget.update()
-        self.keyboardWidget.updateGeometry()
+        self.keyboardWidget.update_keys(changed)
 
     def unlock(self):
-        Unlocker.unlock(self.keyboard)
+        Unlocker.unlock_async(self.keyboard, log_failure)
 
     def activate(self):
         self.grabber.grabKeyboard()
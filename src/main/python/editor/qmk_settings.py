@@ -1,5 +1,6 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 import json
+import logging
 from collections import defaultdict
 
 from PyQt6 import QtCore
@@ -8,7 +9,9 @@ from PyQt6.QtWidgets import QVBoxLayout, QCheckBox, QGridLayout, QLabel, QWidget
     QHBoxLayout, QPushButton, QMessageBox
 
 from editor.basic_editor import BasicEditor
+from protocol.keyboard_comm import STAGE_SETTINGS
 from protocol.constants import VIAL_PROTOCOL_QMK_SETTINGS
+from protocol.io_worker import call_async, log_failure
 from util import tr
 from vial_device import VialKeyboard
 
@@ -97,6 +100,8 @@ class IntegerOption(GenericOption):
 
 class QmkSettings(BasicEditor):
 
+    stage = STAGE_SETTINGS
+
     def __init__(self):
         super().__init__()
         self.keyboard = None
@@ -111,7 +116,7 @@ class QmkSettings(BasicEditor):
         buttons.addWidget(self.btn_save)
         self.btn_undo = QPushButton(tr("QmkSettings", "Undo"))
         self.btn_undo.setMinimumSize(100, 36)
-        self.btn_undo.clicked.connect(self.reload_settings)
+        self.btn_undo.clicked.connect(self.undo_settings)
         buttons.addWidget(self.btn_undo)
         btn_reset = QPushButton(tr("QmkSettings", "Reset"))
         btn_reset.setMinimumSize(100, 36)
@@ -178,9 +183,18 @@ class QmkSettings(BasicEditor):
             self.tabs.append(self.populate_tab(tab, container))
 
     def reload_settings(self):
-        self.keyboard.reload_settings()
+        call_async(self.keyboard, self.keyboard.reload_settings, self.on_settings_reloaded)
+
+    def on_settings_reloaded(self, future):
+        log_failure(future)
+        self.refresh_settings()
+
+    def refresh_settings(self):
+        """ Shows the values the keyboard holds, dropping any changes which haven't been saved """
         self.recreate_gui()
+        self.undo_settings()
 
+    def undo_settings(self):
         for tab in self.tabs:
             for field in tab:
                 field.reload(self.keyboard)
@@ -188,15 +202,14 @@ class QmkSettings(BasicEditor):
         self.on_change()
 
     def on_change(self):
-        changed = False
-        qsid_values = self.prepare_settings()
+        # every edit replaces what was queued for its qsid, so rapid edits end up as a single write
+        for qsid, value in self.prepare_settings().items():
+            self.keyboard.qmk_settings_stage(qsid, value)
 
+        changed = False
         for x, tab in enumerate(self.tabs):
-            tab_changed = False
-            for opt in tab:
-                if qsid_values[opt.qsid] != self.keyboard.settings[opt.qsid]:
-                    changed = True
-                    tab_changed = True
+            tab_changed = any(opt.qsid in self.keyboard.pending_settings for opt in tab)
+            changed = changed or tab_changed
             title = self.tabs_widget.tabText(x).rstrip("*")
             if tab_changed:
                 self.tabs_widget.setTabText(x, title + "*")
@@ -210,7 +223,7 @@ class QmkSettings(BasicEditor):
         super().rebuild(device)
         if self.valid():
             self.keyboard = device.keyboard
-            self.reload_settings()
+            self.refresh_settings()
 
     def prepare_settings(self):
         qsid_values = defaultdict(int)
@@ -220,17 +233,25 @@ class QmkSettings(BasicEditor):
         return qsid_values
 
     def save_settings(self):
-        qsid_values = self.prepare_settings()
-        for qsid, value in qsid_values.items():
-            self.keyboard.qmk_settings_set(qsid, value)
+        call_async(self.keyboard, self.keyboard.qmk_settings_flush, self.on_settings_saved)
+
+    def on_settings_saved(self, future):
+        log_failure(future)
+        if future.exception() is None and future.result():
+            logging.warning("QmkSettings: keyboard refused to set qsids {}".format(future.result()))
         self.on_change()
 
     def reset_settings(self):
         if QMessageBox.question(self.widget(), "",
                                 tr("QmkSettings", "Reset all settings to default values?"),
                                 QMessageBox.Yes | QMessageBox.No) == QMessageBox.Yes:
-            self.keyboard.qmk_settings_reset()
-            self.reload_settings()
+            keyboard = self.keyboard
+
+            def reset():
+                keyboard.qmk_settings_reset()
+                keyboard.reload_settings()
+
+            call_async(keyboard, reset, self.on_settings_reloaded)
 
     def valid(self):
         return isinstance(self.device, VialKeyboard) and \
@@ -1,4 +1,6 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
+import threading
+
 from PyQt6 import QtCore
 from PyQt6.QtCore import pyqtSignal, QObject, Qt
 from PyQt6.QtGui import QColor, QLinearGradient, QPainter, QBrush
@@ -7,6 +9,8 @@ from PyQt6.QtWidgets import QWidget, QPushButton, QHBoxLayout, QSizePolicy, QGri
     QDialog, QSpinBox, QLineEdit
 
 from editor.basic_editor import BasicEditor
+from protocol.io_worker import call_async, log_failure
+from protocol.keyboard_comm import STAGE_LIGHTING
 from widgets.clickable_label import ClickableLabel
 from util import tr
 from vial_device import VialKeyboard
@@ -126,6 +130,9 @@ class BasicHandler(QObject):
         super().__init__()
         self.device = self.keyboard = None
         self.widgets = []
+        # latest arguments of writes which are queued but haven't run yet, by setter
+        self.pending = dict()
+        self.pending_lock = threading.Lock()
 
     def set_device(self, device):
         self.device = device
@@ -157,6 +164,22 @@ class BasicHandler(QObject):
     def valid(self):
         raise NotImplementedError
 
+    def write(self, fn, *args, callback=log_failure):
+        """
+        Queues a lighting change on the keyboard's I/O worker. While a change through the same setter is still
+        queued only its arguments are replaced, so dragging a slider sends the latest value rather than every step
+        """
+        with self.pending_lock:
+            queued = fn in self.pending
+            self.pending[fn] = args
+        if not queued:
+            call_async(self.device.keyboard, lambda: self.flush(fn), callback)
+
+    def flush(self, fn):
+        with self.pending_lock:
+            args = self.pending.pop(fn)
+        return fn(*args)
+
 
 class QmkRgblightHandler(BasicHandler):
 
@@ -258,7 +281,7 @@ class QmkRgblightHandler(BasicHandler):
             
             def make_callback(effect_idx):
                 def callback():
-                    self.device.keyboard.set_qmk_rgblight_effect(effect_idx)
+                    self.write(self.device.keyboard.set_qmk_rgblight_effect, effect_idx)
                     self.lbl_underglow_color.setVisible(QMK_RGBLIGHT_EFFECTS[effect_idx].color_picker)
                     self.underglow_color.setVisible(QMK_RGBLIGHT_EFFECTS[effect_idx].color_picker)
                     self.build_effect_buttons(effect_idx)
@@ -273,7 +296,7 @@ class QmkRgblightHandler(BasicHandler):
         return isinstance(self.device, VialKeyboard) and self.device.keyboard.lighting_qmk_rgblight
 
     def on_underglow_brightness_changed(self, value):
-        self.device.keyboard.set_qmk_rgblight_brightness(value)
+        self.write(self.device.keyboard.set_qmk_rgblight_brightness, value)
         self.update.emit()
 
     def on_underglow_effect_changed(self):
@@ -294,7 +317,7 @@ class QmkRgblightHandler(BasicHandler):
         h, s, v, a = color.getHsvF()
         if h < 0:
             h = 0
-        self.device.keyboard.set_qmk_rgblight_color(int(255 * h), int(255 * s), int(255 * v))
+        self.write(self.device.keyboard.set_qmk_rgblight_color, int(255 * h), int(255 * s), int(255 * v))
         self.update.emit()
 
     def current_color(self):
@@ -357,10 +380,10 @@ class QmkBacklightHandler(BasicHandler):
         return isinstance(self.device, VialKeyboard) and self.device.keyboard.lighting_qmk_backlight
 
     def on_backlight_brightness_changed(self, value):
-        self.device.keyboard.set_qmk_backlight_brightness(value)
+        self.write(self.device.keyboard.set_qmk_backlight_brightness, value)
 
     def on_backlight_breathing_changed(self, checked):
-        self.device.keyboard.set_qmk_backlight_effect(int(checked))
+        self.write(self.device.keyboard.set_qmk_backlight_effect, int(checked))
 
 
 class VialRGBHandler(BasicHandler):
@@ -459,10 +482,10 @@ class VialRGBHandler(BasicHandler):
         self.current_effect_idx = 0
 
     def on_rgb_brightness_changed(self, value):
-        self.keyboard.set_vialrgb_brightness(value)
+        self.write(self.keyboard.set_vialrgb_brightness, value)
 
     def on_rgb_speed_changed(self, value):
-        self.keyboard.set_vialrgb_speed(value)
+        self.write(self.keyboard.set_vialrgb_speed, value)
 
     def on_rgb_color(self):
         parent = self.rgb_color.window() if hasattr(self.rgb_color, 'window') else None
@@ -493,7 +516,7 @@ class VialRGBHandler(BasicHandler):
         h, s, v, a = color.getHsvF()
         if h < 0:
             h = 0
-        self.keyboard.set_vialrgb_color(int(255 * h), int(255 * s), self.keyboard.rgb_hsv[2])
+        self.write(self.keyboard.set_vialrgb_color, int(255 * h), int(255 * s), self.keyboard.rgb_hsv[2])
         self.update.emit()
 
     def current_color(self):
@@ -526,14 +549,17 @@ class VialRGBHandler(BasicHandler):
             
             def make_callback(effect_obj):
                 def callback():
-                    self.keyboard.set_vialrgb_mode(effect_obj.idx)
-                    self.update_effect_buttons()
+                    self.write(self.keyboard.set_vialrgb_mode, effect_obj.idx, callback=self.on_mode_set)
                 return callback
             
             btn.clicked.connect(make_callback(effect))
             self.effect_buttons.append(btn)
             self.effect_buttons_layout.addWidget(btn, row, col)
 
+    def on_mode_set(self, future):
+        log_failure(future)
+        self.update_effect_buttons()
+
     def update_effect_buttons(self):
         """Update button states to show which effect is currently selected"""
         for idx, btn in enumerate(self.effect_buttons):
@@ -577,6 +603,8 @@ class VialRGBHandler(BasicHandler):
 
 class RGBConfigurator(BasicEditor):
 
+    stage = STAGE_LIGHTING
+
     def __init__(self):
         super().__init__()
 
@@ -612,7 +640,7 @@ class RGBConfigurator(BasicEditor):
         self.addLayout(buttons)
 
     def on_save(self):
-        self.device.keyboard.save_rgb()
+        call_async(self.device.keyboard, self.device.keyboard.save_rgb, log_failure)
 
     def valid(self):
         return isinstance(self.device, VialKeyboard) and \
@@ -628,7 +656,13 @@ class RGBConfigurator(BasicEditor):
             h.unblock_signals()
 
     def update_from_keyboard(self):
-        self.device.keyboard.reload_rgb()
+        # queued behind whatever changes led here, so it reads back their outcome
+        call_async(self.device.keyboard, self.device.keyboard.reload_rgb, self.on_rgb_reloaded)
+
+    def on_rgb_reloaded(self, future):
+        log_failure(future)
+        if not self.valid():
+            return
 
         self.block_signals()
 
@@ -4,12 +4,15 @@ from PyQt6.QtCore import pyqtSignal, QObject
 from PyQt6.QtWidgets import QTabWidget, QWidget, QSizePolicy, QGridLayout, QVBoxLayout, QLabel, QHBoxLayout, \
     QPushButton, QSpinBox
 
+from keycodes.keycodes import RESET_KEYCODE
 from protocol.constants import VIAL_PROTOCOL_DYNAMIC
+from protocol.io_worker import call_async, log_failure
 from widgets.key_widget import KeyWidget
 from tabbed_keycodes import TabbedKeycodes
 from util import tr
 from vial_device import VialKeyboard
 from editor.basic_editor import BasicEditor
+from protocol.keyboard_comm import STAGE_DYNAMIC
 from widgets.tab_widget_keycodes import TabWidgetWithKeycodes
 
 
@@ -100,6 +103,8 @@ class TapDanceEntryUI(QObject):
 
 class TapDance(BasicEditor):
 
+    stage = STAGE_DYNAMIC
+
     def __init__(self):
         super().__init__()
         self.keyboard = None
@@ -140,12 +145,25 @@ class TapDance(BasicEditor):
         self.update_modified_state()
 
     def on_save(self):
-        for x, e in enumerate(self.tap_dance_entries):
-            self.keyboard.tap_dance_set(x, self.tap_dance_entries[x].save())
+        keyboard = self.keyboard
+        entries = [e.save() for e in self.tap_dance_entries]
+
+        def save():
+            for x, entry in enumerate(entries):
+                keyboard.tap_dance_set(x, entry)
+
+        call_async(keyboard, save, self.on_saved,
+                   unlock=any(RESET_KEYCODE in entry[:4] for entry in entries))
+
+    def on_saved(self, future):
+        log_failure(future)
         self.update_modified_state()
 
     def on_revert(self):
-        self.keyboard.reload_dynamic()
+        call_async(self.keyboard, self.keyboard.reload_dynamic, self.on_reverted)
+
+    def on_reverted(self, future):
+        log_failure(future)
         self.reload_ui()
 
     def rebuild(self, device):
@@ -14,6 +14,8 @@ class Keycode:
     recorder_alias_to_keycode = dict()
     qmk_id_to_keycode = dict()
     protocol = 0
+    # bumped every time the global keycode tables are regenerated
+    generation = 0
     hidden = False
 
     def __init__(self, qmk_id, label, tooltip=None, masked=False, printable=None, recorder_alias=None, alias=None, requires_feature=None):
@@ -112,6 +114,15 @@ class Keycode:
         else:
             masked = keycodes_v5.masked
 
+        if 0 <= code <= 0xFFFF:
+            table = SERIALIZE_TABLES.get(cls.protocol == 6)
+            if table is None:
+                table = SERIALIZE_TABLES[cls.protocol == 6] = build_serialize_table(masked)
+            qmk_id = table[code]
+            if qmk_id is not None:
+                return qmk_id
+            return hex(code)
+
         if (code & 0xFF00) not in masked:
             kc = RAWCODES_MAP.get(code)
             if kc is not None:
@@ -133,9 +144,8 @@ class Keycode:
             return val
         if val in cls.qmk_id_to_keycode:
             return cls.resolve(cls.qmk_id_to_keycode[val].qmk_id)
-        anykc = AnyKeycode()
         try:
-            return anykc.decode(val)
+            return AnyKeycode.decode(val)
         except Exception:
             if reraise:
                 raise
@@ -800,6 +810,9 @@ for x in range(256):
 KEYCODES = []
 KEYCODES_MAP = dict()
 RAWCODES_MAP = dict()
+# dense integer keycode -> qmk_id tables for Keycode.serialize, one per protocol flavor;
+# built on first use and dropped whenever the keycodes are regenerated
+SERIALIZE_TABLES = dict()
 
 K = None
 
@@ -813,11 +826,31 @@ def recreate_keycodes():
                     KEYCODES_TAP_DANCE + KEYCODES_MACRO + KEYCODES_USER + KEYCODES_HIDDEN + KEYCODES_MIDI)
     KEYCODES_MAP.clear()
     RAWCODES_MAP.clear()
+    SERIALIZE_TABLES.clear()
+    Keycode.generation += 1
     for keycode in KEYCODES:
         KEYCODES_MAP[keycode.qmk_id.replace("(kc)", "")] = keycode
         RAWCODES_MAP[Keycode.deserialize(keycode.qmk_id)] = keycode
 
 
+def build_serialize_table(masked):
+    """ Precomputes Keycode.serialize for every 16-bit keycode, None means it has no name """
+
+    table = [None] * 0x10000
+    for code, keycode in RAWCODES_MAP.items():
+        if 0 <= code <= 0xFFFF and (code & 0xFF00) not in masked:
+            table[code] = keycode.qmk_id
+
+    inner = [(code, keycode.qmk_id) for code, keycode in RAWCODES_MAP.items() if 0 <= code <= 0xFF]
+    for outer_code in masked:
+        outer = RAWCODES_MAP.get(outer_code)
+        if outer is None:
+            continue
+        for code, qmk_id in inner:
+            table[outer_code | code] = outer.qmk_id.replace("kc", qmk_id)
+    return table
+
+
 def create_user_keycodes():
     KEYCODES_USER.clear()
     for x in range(16):
@@ -41,6 +41,21 @@ class Key:
         self.sb = ""
         self.st = ""
 
+    def to_dict(self):
+        """ Converts the key into plain JSON-compatible data """
+        out = dict(self.__dict__)
+        out["default"] = dict(self.default.__dict__)
+        return out
+
+    @classmethod
+    def from_dict(cls, data):
+        """ Reconstructs a key previously converted with to_dict """
+        key = cls()
+        key.__dict__.update(data)
+        key.default = KeyDefaults()
+        key.default.__dict__.update(data["default"])
+        return key
+
 
 class KeyboardMetadata:
 
@@ -16,10 +16,11 @@ from autorefresh.autorefresh import Autorefresh
 from editor.alt_repeat_key import AltRepeatKey
 from editor.combos import Combos
 from constants import WINDOW_WIDTH, WINDOW_HEIGHT
-from widgets.editor_container import EditorContainer
+from widgets.editor_container import EditorContainer, EditorPlaceholder
 from editor.firmware_flasher import FirmwareFlasher
 from editor.key_override import KeyOverride
-from protocol.keyboard_comm import ProtocolError
+from protocol.io_worker import call_async, log_failure, PRIORITY_BULK
+from protocol.keyboard_comm import ProtocolError, STAGE_LAYOUT
 from editor.keymap_editor import KeymapEditor
 from keymaps import KEYMAPS
 from editor.layout_editor import LayoutEditor
@@ -28,8 +29,10 @@ from editor.qmk_settings import QmkSettings
 from editor.rgb_configurator import RGBConfigurator
 from tabbed_keycodes import TabbedKeycodes
 from editor.tap_dance import TapDance
+from protocol.stats import STATS
+from transport_diagnostics import TransportDiagnostics
 from unlocker import Unlocker
-from util import tr, EXAMPLE_KEYBOARDS, KeycodeDisplay, EXAMPLE_KEYBOARD_PREFIX
+from util import tr, KeycodeDisplay, is_example_keyboard
 from vial_device import VialKeyboard
 from editor.matrix_test import MatrixTest
 from i18n import I18n
@@ -200,6 +203,10 @@ class MainWindow(QMainWindow):
         Unlocker.global_main_window = self
 
         self.current_tab = None
+        # editor -> the placeholder tab it is shown as until its data is loaded
+        self.pending_editors = dict()
+        # keyboard whose editors were built while it was still loading
+        self.streamed_device = None
         self.tabs = QTabWidget()
         self.tabs.currentChanged.connect(self.on_tab_changed)
         self.refresh_tabs()
@@ -279,6 +286,7 @@ class MainWindow(QMainWindow):
             # handle asynchronous device opens
             if hasattr(self.autorefresh, 'device_opened'):
                 self.autorefresh.device_opened.connect(self.on_device_opened)
+                self.autorefresh.device_stage.connect(self.on_device_stage)
 
             # If we cached VIA definitions, load them into the autorefresh thread
             if self._cached_via_stack:
@@ -395,8 +403,11 @@ class MainWindow(QMainWindow):
         about_vial_act.triggered.connect(self.about_vial)
         self.about_keyboard_act = QAction("", self)
         self.about_keyboard_act.triggered.connect(self.about_keyboard)
+        transport_diagnostics_act = QAction(tr("MenuAbout", "Transport diagnostics..."), self)
+        transport_diagnostics_act.triggered.connect(self.transport_diagnostics)
         self.about_menu = self.menuBar().addMenu(tr("Menu", "About"))
         self.about_menu.addAction(self.about_keyboard_act)
+        self.about_menu.addAction(transport_diagnostics_act)
         self.about_menu.addAction(about_vial_act)
 
     def on_layout_loaded(self, layout):
@@ -425,6 +436,15 @@ class MainWindow(QMainWindow):
                 self.rebuild()
 
     def on_layout_save(self):
+        # keymap layers which are still loading in the background are fetched by the worker, not waited on here
+        keyboard = self.keymap_editor.keyboard
+        call_async(keyboard, keyboard.wait_keymap, self.on_keymap_loaded_for_save)
+
+    def on_keymap_loaded_for_save(self, future):
+        if future.exception() is not None:
+            QMessageBox.warning(self, "", tr("MainWindow", "Failed to read the keymap: {}").format(future.exception()))
+            return
+
         if sys.platform == "emscripten":
             import vialglue
             layout = self.keymap_editor.save_layout()
@@ -468,6 +488,7 @@ class MainWindow(QMainWindow):
         # Use async selection to avoid blocking UI while opening the device
         if not self.autorefresh:
             return
+        self.streamed_device = None
         try:
             self.lock_ui()
             # 显示加载对话框
@@ -500,10 +521,15 @@ class MainWindow(QMainWindow):
             # post-open checks and UI refresh
             if isinstance(device, VialKeyboard):
                 keyboard_id = device.keyboard.keyboard_id
-                if (keyboard_id in EXAMPLE_KEYBOARDS) or ((keyboard_id & 0xFFFFFFFFFFFFFF) == EXAMPLE_KEYBOARD_PREFIX):
+                if is_example_keyboard(keyboard_id):
                     QMessageBox.warning(self, "", "An example keyboard UID was detected.\n"
                                               "Please change your keyboard UID to be unique before you ship!")
 
+            if device is self.streamed_device:
+                # the editors were built while the keyboard streamed in, they only need rebuilding after an unlock
+                self.finish_interrupted_unlock()
+                return
+
             # 保持加载对话框显示，更新提示信息
             if self.loading_dialog:
                 self.loading_dialog.label.setText(tr("LoadingDialog", "Loading keyboard layout..."))
@@ -522,6 +548,53 @@ class MainWindow(QMainWindow):
             except Exception:
                 pass
 
+    def on_device_stage(self, device, stage):
+        """ Shows whatever is loaded already while the rest of an asynchronously opened keyboard streams in """
+        if device is not self.autorefresh.current_device:
+            return
+
+        if stage != STAGE_LAYOUT:
+            self.on_stage_loaded(stage)
+            return
+
+        if self.loading_dialog:
+            self.loading_dialog.close()
+            self.loading_dialog = None
+        self.streamed_device = device
+        # an interrupted unlock is taken care of once loading finishes, see on_device_opened
+        self.rebuild(check_unlock=False)
+        self.refresh_tabs()
+        # switching devices stays locked until the keyboard is fully loaded, the editors don't have to
+        self.tabs.setEnabled(True)
+
+    def on_stage_loaded(self, stage):
+        device = self.autorefresh.current_device
+        for container, lbl in self.editors:
+            if container not in self.pending_editors:
+                if container.loaded(device):
+                    container.on_stage_loaded(stage)
+                continue
+            if not container.loaded(device):
+                continue
+
+            placeholder = self.pending_editors.pop(container)
+            # the stages this editor reads from are complete; keymap layers which still arrive in the background
+            # are safe to read meanwhile, see KeymapStore.strings
+            container.rebuild(device)
+            # the tabs haven't been created yet, refresh_tabs will add the editor along with the rest
+            if placeholder is None:
+                continue
+            idx = self.tabs.indexOf(placeholder)
+            if idx >= 0:
+                if container.valid():
+                    current = self.tabs.currentIndex() == idx
+                    self.tabs.insertTab(idx, EditorContainer(container), tr("MainWindow", lbl))
+                    if current:
+                        self.tabs.setCurrentIndex(idx)
+                    idx += 1
+                self.tabs.removeTab(idx)
+            placeholder.deleteLater()
+
     def on_device_error(self, code):
         try:
             if code == "protocol_error":
@@ -531,7 +604,32 @@ class MainWindow(QMainWindow):
         except Exception:
             pass
 
-    def rebuild(self):
+    def finish_interrupted_unlock(self):
+        """ If unlock process was interrupted, we must finish it first; the editors are rebuilt after reloading """
+        device = self.autorefresh.current_device
+        if not isinstance(device, VialKeyboard):
+            return
+        keyboard = device.keyboard
+
+        def on_in_progress(future):
+            if future.exception() is None and future.result():
+                Unlocker.unlock_async(keyboard, on_unlocked)
+
+        def on_unlocked(future):
+            self.lock_ui()
+            call_async(keyboard, keyboard.reload, on_reloaded, PRIORITY_BULK)
+
+        def on_reloaded(future):
+            self.unlock_ui()
+            if future.exception() is not None:
+                logging.error("reloading the keyboard failed: {}".format(future.exception()))
+            elif device is self.autorefresh.current_device:
+                self.rebuild(check_unlock=False)
+                self.refresh_tabs()
+
+        call_async(keyboard, keyboard.get_unlock_in_progress, on_in_progress)
+
+    def rebuild(self, check_unlock=True):
         # don't show "Security" menu for bootloader mode, as the bootloader is inherently insecure
         self.security_menu.menuAction().setVisible(isinstance(self.autorefresh.current_device, VialKeyboard))
 
@@ -540,19 +638,25 @@ class MainWindow(QMainWindow):
             self.about_keyboard_act.setText("About {}...".format(self.autorefresh.current_device.title()))
             self.about_keyboard_act.setVisible(True)
 
-        # if unlock process was interrupted, we must finish it first
-        if isinstance(self.autorefresh.current_device, VialKeyboard) and self.autorefresh.current_device.keyboard.get_unlock_in_progress():
-            Unlocker.unlock(self.autorefresh.current_device.keyboard)
-            self.autorefresh.current_device.keyboard.reload()
+        if check_unlock:
+            self.finish_interrupted_unlock()
 
+        self.pending_editors = dict()
         for e in [self.layout_editor, self.keymap_editor, self.firmware_flasher, self.macro_recorder,
                   self.tap_dance, self.combos, self.key_override, self.alt_repeat_key,
                   self.qmk_settings, self.matrix_tester, self.rgb_configurator]:
-            e.rebuild(self.autorefresh.current_device)
+            if e.loaded(self.autorefresh.current_device):
+                e.rebuild(self.autorefresh.current_device)
+            else:
+                self.pending_editors[e] = None
 
     def refresh_tabs(self):
         self.tabs.clear()
         for container, lbl in self.editors:
+            if container in self.pending_editors:
+                self.pending_editors[container] = EditorPlaceholder()
+                self.tabs.addTab(self.pending_editors[container], tr("MainWindow", lbl))
+                continue
             if not container.valid():
                 continue
 
@@ -607,16 +711,17 @@ class MainWindow(QMainWindow):
 
     def unlock_keyboard(self):
         if isinstance(self.autorefresh.current_device, VialKeyboard):
-            Unlocker.unlock(self.autorefresh.current_device.keyboard)
+            Unlocker.unlock_async(self.autorefresh.current_device.keyboard, log_failure)
 
     def lock_keyboard(self):
         if isinstance(self.autorefresh.current_device, VialKeyboard):
-            self.autorefresh.current_device.keyboard.lock()
+            keyboard = self.autorefresh.current_device.keyboard
+            call_async(keyboard, keyboard.lock, log_failure)
 
     def reboot_to_bootloader(self):
         if isinstance(self.autorefresh.current_device, VialKeyboard):
-            Unlocker.unlock(self.autorefresh.current_device.keyboard)
-            self.autorefresh.current_device.keyboard.reset()
+            keyboard = self.autorefresh.current_device.keyboard
+            call_async(keyboard, keyboard.reset, log_failure, unlock=True)
 
     def change_keyboard_layout(self, index):
         self.settings.setValue("keymap", KEYMAPS[index][0])
@@ -645,9 +750,10 @@ class MainWindow(QMainWindow):
         if index >= 0:
             new_tab = self.tabs.widget(index)
 
-        if old_tab is not None:
+        # placeholders of editors which are still loading have nothing to (de)activate
+        if old_tab is not None and old_tab.editor is not None:
             old_tab.editor.deactivate()
-        if new_tab is not None:
+        if new_tab is not None and new_tab.editor is not None:
             new_tab.editor.activate()
 
         self.current_tab = new_tab
@@ -678,6 +784,10 @@ class MainWindow(QMainWindow):
         self.about_dialog.setModal(True)
         self.about_dialog.show()
 
+    def transport_diagnostics(self):
+        self.diagnostics_dialog = TransportDiagnostics()
+        self.diagnostics_dialog.show()
+
     def apply_stylesheet(self):
         window_bg = themes.Theme.window_color()
         base_bg = themes.Theme.base_color()
@@ -1334,5 +1444,6 @@ class MainWindow(QMainWindow):
         self.settings.setValue("size", self.size())
         self.settings.setValue("pos", self.pos())
         self.settings.setValue("maximized", self.isMaximized())
+        STATS.dump()
 
         e.accept()
@@ -0,0 +1,123 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import asyncio
+import inspect
+
+from keycodes.keycodes import Keycode, RESET_KEYCODE
+from protocol.io_worker import DeviceWorker, PRIORITY_INTERACTIVE, PRIORITY_POLLING, PRIORITY_BULK
+
+
+def _forward(name, priority=PRIORITY_INTERACTIVE, unlock=None):
+    # unlock(*args) tells whether the call may need an unlocked keyboard
+    async def method(self, *args, **kwargs):
+        if unlock is not None and unlock(*args, **kwargs):
+            await self.unlock()
+        return await self.call(getattr(self.keyboard, name), *args, priority=priority, **kwargs)
+
+    method.__name__ = name
+    method.__doc__ = "Awaitable Keyboard.{}".format(name)
+    return method
+
+
+def _is_reset(*codes):
+    # keycodes may be given serialized or as integers
+    reset = Keycode.deserialize(RESET_KEYCODE)
+    return any(Keycode.deserialize(code) == reset for code in codes)
+
+
+class AsyncKeyboard:
+    """
+    asyncio facade over a Keyboard. Every call is queued on the keyboard's DeviceWorker and awaited without
+    blocking the event loop, so one loop can drive many keyboards at once. This is only a facade: the
+    protocol stays in the blocking Keyboard class and its mixins, and the transport underneath stays
+    blocking too, it just runs on the worker thread.
+
+    Calls which may need the keyboard unlocked, e.g. assigning QK_BOOT, first await unlock(), which needs
+    no GUI: unlock_prompt(keys) is told which keys have to be held, if it is given.
+
+        kb = AsyncKeyboard(Keyboard(dev))
+        await kb.reload()
+        await asyncio.gather(kb.set_key(0, 0, 0, "KC_A"), other.set_key(0, 0, 0, "KC_B"))
+    """
+
+    # seconds between unlock polls
+    UNLOCK_POLL_INTERVAL = 0.2
+
+    def __init__(self, keyboard, unlock_prompt=None):
+        self.keyboard = keyboard
+        self.unlock_prompt = unlock_prompt
+        if keyboard.worker is None:
+            keyboard.attach_worker(DeviceWorker(keyboard.usb_send, keyboard.usb_send_many))
+
+    async def call(self, fn, *args, priority=PRIORITY_INTERACTIVE, **kwargs):
+        """ Runs fn on the keyboard's I/O worker and awaits its result """
+        return await asyncio.wrap_future(self.keyboard.worker.submit(fn, *args, priority=priority, **kwargs))
+
+    async def unlock(self, prompt=None):
+        """
+        Unlocks the keyboard unless it is already. prompt(keys), by default unlock_prompt, is called with the
+        (row, col) of the keys to hold and may be a coroutine; an exception from it aborts the unlock.
+        The keyboard is then polled until the keys were held long enough, wrap this in asyncio.wait_for
+        to give up after a while.
+        """
+
+        if await self.call(self.keyboard.get_unlock_status) == 1:
+            return
+
+        prompt = prompt or self.unlock_prompt
+        if prompt is not None:
+            shown = prompt(await self.call(self.keyboard.get_unlock_keys))
+            if inspect.isawaitable(shown):
+                await shown
+
+        await self.call(self.keyboard.unlock_start)
+        while (await self.call(self.keyboard.unlock_poll, priority=PRIORITY_POLLING))[0] != 1:
+            await asyncio.sleep(self.UNLOCK_POLL_INTERVAL)
+
+    def close(self):
+        """ Stops the I/O worker, the underlying device is left for the caller to close """
+        self.keyboard.worker.stop()
+
+    reload = _forward("reload", PRIORITY_BULK)
+    reload_macros = _forward("reload_macros", PRIORITY_BULK)
+    reload_rgb = _forward("reload_rgb", PRIORITY_BULK)
+    reload_settings = _forward("reload_settings", PRIORITY_BULK)
+
+    set_key = _forward("set_key", unlock=lambda layer, row, col, code: _is_reset(code))
+    set_keys = _forward("set_keys", unlock=lambda changes, progress=None: _is_reset(*changes.values()))
+    set_encoder = _forward("set_encoder", unlock=lambda layer, index, direction, code: _is_reset(code))
+    set_layout_options = _forward("set_layout_options")
+    restore_layout = _forward("restore_layout", PRIORITY_BULK, unlock=lambda *args, **kwargs: True)
+
+    set_macro = _forward("set_macro", unlock=lambda *args: True)
+    restore_macros = _forward("restore_macros", unlock=lambda *args: True)
+
+    tap_dance_set = _forward("tap_dance_set", unlock=lambda idx, entry: _is_reset(*entry[:4]))
+    combo_set = _forward("combo_set", unlock=lambda idx, entry: _is_reset(entry[-1]))
+    key_override_set = _forward("key_override_set", unlock=lambda idx, entry: _is_reset(entry.replacement))
+    alt_repeat_key_set = _forward("alt_repeat_key_set",
+                                  unlock=lambda idx, entry: _is_reset(entry.keycode, entry.alt_keycode))
+
+    qmk_settings_set = _forward("qmk_settings_set")
+    qmk_settings_flush = _forward("qmk_settings_flush")
+    qmk_settings_reset = _forward("qmk_settings_reset")
+
+    set_qmk_rgblight_brightness = _forward("set_qmk_rgblight_brightness")
+    set_qmk_rgblight_effect = _forward("set_qmk_rgblight_effect")
+    set_qmk_rgblight_effect_speed = _forward("set_qmk_rgblight_effect_speed")
+    set_qmk_rgblight_color = _forward("set_qmk_rgblight_color")
+    set_qmk_backlight_brightness = _forward("set_qmk_backlight_brightness")
+    set_qmk_backlight_effect = _forward("set_qmk_backlight_effect")
+    set_vialrgb_brightness = _forward("set_vialrgb_brightness")
+    set_vialrgb_speed = _forward("set_vialrgb_speed")
+    set_vialrgb_mode = _forward("set_vialrgb_mode")
+    set_vialrgb_color = _forward("set_vialrgb_color")
+    save_rgb = _forward("save_rgb")
+
+    get_unlock_status = _forward("get_unlock_status")
+    lock = _forward("lock")
+    matrix_poll = _forward("matrix_poll")
+    reset = _forward("reset", unlock=lambda: True)
+
+    def save_layout(self):
+        """ Works on the in-memory state only, so this doesn't need to be awaited """
+        return self.keyboard.save_layout()
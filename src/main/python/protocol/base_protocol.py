@@ -7,20 +7,24 @@ from protocol.constants import CMD_VIA_VIAL_PREFIX, CMD_VIAL_DYNAMIC_ENTRY_OP
 class BaseProtocol:
     vial_protocol = None
     usb_send = NotImplemented
+    usb_send_many = None
     dev = None
 
     macro_count = 0
     macro_memory = 0
     macro = b""
 
+    def _usb_send_many(self, msgs, echo=0, retries=20):
+        """ Sends a batch of requests, pipelined if the transport supports it, and returns all responses """
+        if self.usb_send_many is not None:
+            return self.usb_send_many(self.dev, msgs, echo=echo, retries=retries)
+        return [self.usb_send(self.dev, msg, retries=retries) for msg in msgs]
+
     def _retrieve_dynamic_entries(self, cmd, count, fmt):
         out = []
-        for x in range(count):
-            data = self.usb_send(
-                self.dev,
-                struct.pack("BBBB", CMD_VIA_VIAL_PREFIX, CMD_VIAL_DYNAMIC_ENTRY_OP, cmd, x),
-                retries=20
-            )
+        msgs = [struct.pack("BBBB", CMD_VIA_VIAL_PREFIX, CMD_VIAL_DYNAMIC_ENTRY_OP, cmd, x) for x in range(count)]
+        # dynamic entry responses don't echo the request, so these can only be matched in order
+        for x, data in enumerate(self._usb_send_many(msgs)):
             if data[0] != 0:
                 raise RuntimeError("failed retrieving dynamic={} entry {} from the device".format(cmd, x))
             out.append(struct.unpack(fmt, data[1:1 + struct.calcsize(fmt)]))
@@ -0,0 +1,71 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import hashlib
+import json
+import logging
+import os
+
+# bump whenever the layout of cache entries changes, older entries are then ignored
+CAPABILITY_CACHE_VERSION = 2
+
+
+class CapabilityCache:
+    """
+    Persistent cache of what a keyboard's firmware supports: QMK settings, VialRGB effects and the number
+    of dynamic entries. None of it changes without a reflash, yet querying it takes dozens of round trips.
+
+    Entries are keyed by the keyboard UID, Vial and VIA protocol versions and a hash of the definition.
+    They also hold a probe, the responses to a few cheap queries, which gets compared on every connect to
+    catch a reflash which left everything else the same.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    @classmethod
+    def default(cls):
+        from util import app_data_dir
+
+        return cls(app_data_dir("capabilities"))
+
+    def path(self, keyboard_id):
+        return os.path.join(self.directory, "{:016X}.json".format(keyboard_id))
+
+    @staticmethod
+    def definition_hash(definition):
+        return hashlib.sha256(json.dumps(definition, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def load(self, keyboard_id, vial_protocol, via_protocol, definition, probe):
+        """ Returns the capabilities stored for this keyboard and firmware, None if there are none or they are stale """
+
+        try:
+            with open(self.path(keyboard_id), "r") as inf:
+                entry = json.load(inf)
+            if entry["version"] != CAPABILITY_CACHE_VERSION or entry["vial_protocol"] != vial_protocol \
+                    or entry["via_protocol"] != via_protocol \
+                    or entry["definition_hash"] != self.definition_hash(definition) \
+                    or entry["probe"] != probe.hex():
+                return None
+            return entry["capabilities"]
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.warning("CapabilityCache: ignoring unreadable entry for {:016X}: {}".format(keyboard_id, e))
+            return None
+
+    def store(self, keyboard_id, vial_protocol, via_protocol, definition, probe, capabilities):
+        entry = {
+            "version": CAPABILITY_CACHE_VERSION,
+            "vial_protocol": vial_protocol,
+            "via_protocol": via_protocol,
+            "definition_hash": self.definition_hash(definition),
+            "probe": probe.hex(),
+            "capabilities": capabilities,
+        }
+        path = self.path(keyboard_id)
+        try:
+            # write to a temporary file first so that a crash never leaves a truncated entry behind
+            with open(path + ".tmp", "w") as outf:
+                json.dump(entry, outf)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            logging.warning("CapabilityCache: failed to store entry for {:016X}: {}".format(keyboard_id, e))
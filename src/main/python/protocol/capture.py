@@ -0,0 +1,139 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import struct
+import time
+from collections import namedtuple
+
+from util import MSG_LEN, hid_send, hid_send_many
+
+CAPTURE_MAGIC = b"VIALCAP1"
+
+# gap since the previous exchange ended (us), round-trip latency (us), request length, response length
+RECORD_HEADER = struct.Struct("<IIBB")
+# response length of an exchange where the transport raised instead of returning data
+FAILED = 0xFF
+
+CaptureRecord = namedtuple("CaptureRecord", ["gap", "latency", "request", "response"])
+
+
+class ReplayMismatch(RuntimeError):
+    pass
+
+
+def write_capture(path, records):
+    with open(path, "wb") as outf:
+        outf.write(CAPTURE_MAGIC)
+        for rec in records:
+            if rec.response is None:
+                response, response_len = b"", FAILED
+            else:
+                # responses are mostly zero padding, which doesn't need to be stored
+                response = rec.response.rstrip(b"\x00")
+                response_len = len(response)
+            outf.write(RECORD_HEADER.pack(min(rec.gap, 0xFFFFFFFF), min(rec.latency, 0xFFFFFFFF), len(rec.request),
+                                          response_len))
+            outf.write(rec.request)
+            outf.write(response)
+
+
+def read_capture(path):
+    with open(path, "rb") as inf:
+        data = inf.read()
+    if not data.startswith(CAPTURE_MAGIC):
+        raise RuntimeError("{} is not a vial capture".format(path))
+
+    records = []
+    pos = len(CAPTURE_MAGIC)
+    while pos < len(data):
+        gap, latency, req_len, resp_len = RECORD_HEADER.unpack_from(data, pos)
+        pos += RECORD_HEADER.size
+        request = data[pos:pos + req_len]
+        pos += req_len
+        response = None
+        if resp_len != FAILED:
+            response = data[pos:pos + resp_len] + b"\x00" * (MSG_LEN - resp_len)
+            pos += resp_len
+        records.append(CaptureRecord(gap, latency, request, response))
+    return records
+
+
+class RecordingTransport:
+    """
+    Wraps a usb_send-compatible transport and records every request, its response and timing. Use
+    send and send_many as Keyboard's usb_send and usb_send_many, then save() the session.
+    """
+
+    def __init__(self, send=hid_send, send_many=None):
+        self.inner_send = send
+        if send_many is None and send is hid_send:
+            send_many = hid_send_many
+        self.inner_send_many = send_many
+        self.records = []
+        self.last = None
+
+    def gap_us(self, start):
+        gap = 0 if self.last is None else int((start - self.last) * 1e6)
+        return max(gap, 0)
+
+    def send(self, dev, msg, retries=1):
+        start = time.monotonic()
+        try:
+            data = self.inner_send(dev, msg, retries=retries)
+        except RuntimeError:
+            self.records.append(CaptureRecord(self.gap_us(start), int((time.monotonic() - start) * 1e6), msg, None))
+            self.last = time.monotonic()
+            raise
+        self.records.append(CaptureRecord(self.gap_us(start), int((time.monotonic() - start) * 1e6), msg, data))
+        self.last = time.monotonic()
+        return data
+
+    def send_many(self, dev, msgs, echo=0, retries=1):
+        if self.inner_send_many is None:
+            return [self.send(dev, msg, retries=retries) for msg in msgs]
+
+        start = time.monotonic()
+        out = self.inner_send_many(dev, msgs, echo=echo, retries=retries)
+        # a pipelined batch is recorded as if its requests had been sent one by one in the same total time
+        latency = int((time.monotonic() - start) * 1e6) // max(len(msgs), 1)
+        gap = self.gap_us(start)
+        for msg, data in zip(msgs, out):
+            self.records.append(CaptureRecord(gap, latency, msg, data))
+            gap = 0
+        self.last = time.monotonic()
+        return out
+
+    def save(self, path):
+        write_capture(path, self.records)
+
+
+class ReplayTransport:
+    """
+    Serves a capture back as a usb_send-compatible transport. Requests have to match the recording.
+    speed scales the recorded timing: 1 replays in real time, 10 ten times faster, 0 without any delays.
+    """
+
+    def __init__(self, records, speed=0):
+        if isinstance(records, str):
+            records = read_capture(records)
+        self.records = records
+        self.speed = speed
+        self.idx = 0
+
+    def send(self, dev, msg, retries=1):
+        if self.idx >= len(self.records):
+            raise ReplayMismatch("capture exhausted after {} exchanges, got data={}".format(self.idx, msg.hex()))
+        rec = self.records[self.idx]
+        if msg != rec.request:
+            raise ReplayMismatch("unexpected data at index {}: expected={} got={}".format(
+                self.idx, rec.request.hex(), msg.hex()))
+        self.idx += 1
+
+        if self.speed:
+            time.sleep((rec.gap + rec.latency) / 1e6 / self.speed)
+        if rec.response is None:
+            raise RuntimeError("failed to communicate with the device")
+        return rec.response
+
+    def finish(self):
+        if self.idx != len(self.records):
+            raise ReplayMismatch("capture not replayed to the end, {} of {} exchanges left".format(
+                len(self.records) - self.idx, len(self.records)))
@@ -14,6 +14,7 @@ CMD_VIA_MACRO_GET_BUFFER = 0x0E
 CMD_VIA_MACRO_SET_BUFFER = 0x0F
 CMD_VIA_GET_LAYER_COUNT = 0x11
 CMD_VIA_KEYMAP_GET_BUFFER = 0x12
+CMD_VIA_KEYMAP_SET_BUFFER = 0x13
 CMD_VIA_VIAL_PREFIX = 0xFE
 VIA_LAYOUT_OPTIONS = 0x02
 VIA_SWITCH_MATRIX_STATE = 0x03
@@ -65,3 +66,5 @@ VIAL_PROTOCOL_QMK_SETTINGS = 4
 # When did we get support for 2-byte macros
 VIAL_PROTOCOL_EXT_MACROS = 5
 VIAL_PROTOCOL_KEY_OVERRIDE = 5
+# When can keymap be written in bulk with the VIA set-buffer command
+VIA_PROTOCOL_KEYMAP_SET_BUFFER = 9
@@ -0,0 +1,76 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import hashlib
+import json
+import logging
+import os
+
+from kle_serial import Key
+from util import is_example_keyboard
+
+# bump whenever the layout of cache entries changes, older entries are then ignored
+DEFINITION_CACHE_VERSION = 1
+
+
+class DefinitionCache:
+    """
+    Persistent cache of keyboard definitions (vial.json), so that reconnecting a known keyboard
+    doesn't need to download and decompress the whole definition again.
+
+    Entries are keyed by the keyboard UID and validated against the compressed size and a hash of the
+    first block of the compressed definition, which is always fetched from the device. That only holds up
+    while a UID belongs to a single keyboard, so the example UIDs which every new port starts out with,
+    and whose definitions get edited all the time, are never cached.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    @classmethod
+    def default(cls):
+        from util import app_data_dir
+
+        return cls(app_data_dir("definitions"))
+
+    def path(self, keyboard_id):
+        return os.path.join(self.directory, "{:016X}.json".format(keyboard_id))
+
+    @staticmethod
+    def block_hash(block):
+        return hashlib.sha256(block).hexdigest()
+
+    def load(self, keyboard_id, size, first_block):
+        """ Returns (definition, KLE keys) if there is a valid entry for this keyboard, otherwise None """
+
+        if is_example_keyboard(keyboard_id):
+            return None
+        try:
+            with open(self.path(keyboard_id), "r") as inf:
+                entry = json.load(inf)
+            if entry["version"] != DEFINITION_CACHE_VERSION or entry["size"] != size \
+                    or entry["block_hash"] != self.block_hash(first_block):
+                return None
+            return entry["definition"], [Key.from_dict(key) for key in entry["keys"]]
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.warning("DefinitionCache: ignoring unreadable entry for {:016X}: {}".format(keyboard_id, e))
+            return None
+
+    def store(self, keyboard_id, size, first_block, definition, keys):
+        if is_example_keyboard(keyboard_id):
+            return
+        entry = {
+            "version": DEFINITION_CACHE_VERSION,
+            "size": size,
+            "block_hash": self.block_hash(first_block),
+            "definition": definition,
+            "keys": [key.to_dict() for key in keys],
+        }
+        path = self.path(keyboard_id)
+        try:
+            # write to a temporary file first so that a crash never leaves a truncated entry behind
+            with open(path + ".tmp", "w") as outf:
+                json.dump(entry, outf)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            logging.warning("DefinitionCache: failed to store entry for {:016X}: {}".format(keyboard_id, e))
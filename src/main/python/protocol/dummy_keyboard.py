@@ -10,16 +10,11 @@ class DummyKeyboard(Keyboard):
     def reload_layers(self):
         self.layers = 4
 
-    def reload_keymap(self):
-        for layer in range(self.layers):
-            for row, col in self.rowcol.keys():
-                self.layout[(layer, row, col)] = "KC_NO"
-
-        for layer in range(self.layers):
-            for idx in self.encoderpos:
-                self.encoder_layout[(layer, idx, 0)] = "KC_NO"
-                self.encoder_layout[(layer, idx, 1)] = "KC_NO"
+    def reload_keymap_layers(self, first, count):
+        # a freshly allocated keymap is all KC_NO already
+        self.keymap.loaded_layers.update(range(first, first + count))
 
+    def reload_layout_options(self):
         if self.layout_labels:
             self.layout_options = 0
 
@@ -33,6 +28,11 @@ class DummyKeyboard(Keyboard):
     def set_key(self, layer, row, col, code):
         self.layout[(layer, row, col)] = code
 
+    def set_keys(self, changes, progress=None):
+        for key, code in changes.items():
+            self.layout[key] = code
+        return 0
+
     def set_encoder(self, layer, index, direction, code):
         self.encoder_layout[(layer, index, direction)] = code
 
@@ -22,6 +22,8 @@ class ProtocolDynamic(BaseProtocol):
             return
         data = self.usb_send(self.dev, struct.pack("BBB", CMD_VIA_VIAL_PREFIX, CMD_VIAL_DYNAMIC_ENTRY_OP,
                                                    DYNAMIC_VIAL_GET_NUMBER_OF_ENTRIES), retries=20)
+        # a reflash which changes the number of entries has to invalidate the capability cache
+        self.dynamic_info = data
         self.tap_dance_count = data[0]
         self.combo_count = data[1]
         self.key_override_count = data[2]
@@ -0,0 +1,368 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import json
+import lzma
+import random
+import socket
+import socketserver
+import struct
+import threading
+import time
+from array import array
+
+from kle_serial import Serial as KleSerial
+from protocol.keyboard_comm import encode_keymap_buffer, decode_keymap_buffer
+from protocol.constants import CMD_VIA_GET_PROTOCOL_VERSION, CMD_VIA_GET_KEYBOARD_VALUE, CMD_VIA_SET_KEYBOARD_VALUE, \
+    CMD_VIA_GET_KEYCODE, CMD_VIA_SET_KEYCODE, CMD_VIA_LIGHTING_SET_VALUE, CMD_VIA_LIGHTING_GET_VALUE, \
+    CMD_VIA_LIGHTING_SAVE, CMD_VIA_MACRO_GET_COUNT, CMD_VIA_MACRO_GET_BUFFER_SIZE, CMD_VIA_MACRO_GET_BUFFER, \
+    CMD_VIA_MACRO_SET_BUFFER, CMD_VIA_GET_LAYER_COUNT, CMD_VIA_KEYMAP_GET_BUFFER, CMD_VIA_KEYMAP_SET_BUFFER, \
+    CMD_VIA_VIAL_PREFIX, VIA_LAYOUT_OPTIONS, VIA_SWITCH_MATRIX_STATE, QMK_BACKLIGHT_BRIGHTNESS, QMK_BACKLIGHT_EFFECT, \
+    QMK_RGBLIGHT_BRIGHTNESS, QMK_RGBLIGHT_EFFECT, QMK_RGBLIGHT_EFFECT_SPEED, QMK_RGBLIGHT_COLOR, VIALRGB_GET_INFO, \
+    VIALRGB_GET_MODE, VIALRGB_GET_SUPPORTED, VIALRGB_SET_MODE, CMD_VIAL_GET_KEYBOARD_ID, CMD_VIAL_GET_SIZE, \
+    CMD_VIAL_GET_DEFINITION, CMD_VIAL_GET_ENCODER, CMD_VIAL_SET_ENCODER, CMD_VIAL_GET_UNLOCK_STATUS, \
+    CMD_VIAL_UNLOCK_START, CMD_VIAL_UNLOCK_POLL, CMD_VIAL_LOCK, CMD_VIAL_QMK_SETTINGS_QUERY, CMD_VIAL_QMK_SETTINGS_GET, \
+    CMD_VIAL_QMK_SETTINGS_SET, CMD_VIAL_QMK_SETTINGS_RESET, CMD_VIAL_DYNAMIC_ENTRY_OP, \
+    DYNAMIC_VIAL_GET_NUMBER_OF_ENTRIES, DYNAMIC_VIAL_TAP_DANCE_GET, DYNAMIC_VIAL_TAP_DANCE_SET, DYNAMIC_VIAL_COMBO_GET, \
+    DYNAMIC_VIAL_COMBO_SET, DYNAMIC_VIAL_KEY_OVERRIDE_GET, DYNAMIC_VIAL_KEY_OVERRIDE_SET, \
+    DYNAMIC_VIAL_ALT_REPEAT_KEY_GET, DYNAMIC_VIAL_ALT_REPEAT_KEY_SET
+from util import MSG_LEN
+
+# size in bytes of every kind of dynamic entry, in the order DYNAMIC_VIAL_GET_NUMBER_OF_ENTRIES reports them
+DYNAMIC_ENTRY_SIZES = [
+    ("tap_dance", DYNAMIC_VIAL_TAP_DANCE_GET, DYNAMIC_VIAL_TAP_DANCE_SET, 10),
+    ("combo", DYNAMIC_VIAL_COMBO_GET, DYNAMIC_VIAL_COMBO_SET, 10),
+    ("key_override", DYNAMIC_VIAL_KEY_OVERRIDE_GET, DYNAMIC_VIAL_KEY_OVERRIDE_SET, 10),
+    ("alt_repeat_key", DYNAMIC_VIAL_ALT_REPEAT_KEY_GET, DYNAMIC_VIAL_ALT_REPEAT_KEY_SET, 6),
+]
+
+# how many unlock polls it takes for the emulated user to finish holding down the unlock keys
+UNLOCK_POLLS = 5
+
+
+class VialEmulator:
+    """
+    Implements the VIA/Vial command set of a keyboard in software. handle() takes a request and returns
+    the 32-byte response; send() is usb_send compatible and device() returns a hidapi-like object, both
+    with optional per-packet latency (seconds) and loss (probability a response never arrives).
+    """
+
+    def __init__(self, definition, keyboard_id=0x1122334455667788, layers=4, vial_protocol=6, via_protocol=9,
+                 macro_count=16, macro_memory=900, dynamic_counts=(4, 4, 4, 4), qsids=(), lighting_effects=None,
+                 unlock_keys=((0, 0),), latency=0, loss=0):
+        if isinstance(definition, str):
+            definition = json.loads(definition)
+        self.definition = definition
+        self.compressed = lzma.compress(json.dumps(definition).encode("utf-8"))
+        self.keyboard_id = keyboard_id
+        self.vial_protocol = vial_protocol
+        self.via_protocol = via_protocol
+        self.layers = layers
+        self.rows = definition["matrix"]["rows"]
+        self.cols = definition["matrix"]["cols"]
+        self.latency = latency
+        self.loss = loss
+
+        self.encoders = 0
+        for key in KleSerial().deserialize(definition["layouts"]["keymap"]).keys:
+            if key.labels[4] == "e":
+                self.encoders = max(self.encoders, int(key.labels[0].split(",")[0]) + 1)
+
+        self.keymap = array("H", bytes(2 * layers * self.rows * self.cols))
+        self.encoder_keymap = array("H", bytes(2 * layers * self.encoders * 2))
+        self.layout_options = 0
+        self.macro_count = macro_count
+        self.macro = bytearray(macro_memory)
+        self.dynamic = dict()
+        for (name, get_op, set_op, size), count in zip(DYNAMIC_ENTRY_SIZES, dynamic_counts):
+            self.dynamic[name] = [bytes(size) for x in range(count)]
+        self.settings = {qsid: bytes(4) for qsid in qsids}
+
+        self.rgblight = {QMK_RGBLIGHT_BRIGHTNESS: [0], QMK_RGBLIGHT_EFFECT: [0], QMK_RGBLIGHT_EFFECT_SPEED: [0],
+                         QMK_RGBLIGHT_COLOR: [0, 0], QMK_BACKLIGHT_BRIGHTNESS: [0], QMK_BACKLIGHT_EFFECT: [0]}
+        self.lighting_effects = sorted(lighting_effects if lighting_effects is not None else range(1, 45))
+        self.rgb_mode = struct.pack("<HBBBB", 0, 128, 0, 255, 128)
+
+        self.unlock_keys = list(unlock_keys)
+        self.unlocked = False
+        self.unlock_counter = 0
+        self.pressed = set()
+
+        # a lock so the emulator can be shared between a socket server's threads
+        self.mutex = threading.Lock()
+        self.packets = 0
+
+    def press(self, row, col, pressed=True):
+        """ Changes what the matrix tester will report for a key """
+        if pressed:
+            self.pressed.add((row, col))
+        else:
+            self.pressed.discard((row, col))
+
+    def matrix_state(self):
+        row_size = (self.cols + 7) // 8
+        out = bytearray(row_size * self.rows)
+        for row, col in self.pressed:
+            out[row * row_size + row_size - 1 - col // 8] |= 1 << (col % 8)
+        return bytes(out)
+
+    def handle(self, msg):
+        """ Processes one request the way the firmware would and returns the response """
+        msg = bytes(msg) + b"\x00" * (MSG_LEN - len(msg))
+        with self.mutex:
+            self.packets += 1
+            if msg[0] == CMD_VIA_VIAL_PREFIX:
+                out = self.handle_vial(msg)
+            else:
+                out = self.handle_via(msg)
+        return out + b"\x00" * (MSG_LEN - len(out))
+
+    def handle_via(self, msg):
+        cmd = msg[0]
+        if cmd == CMD_VIA_GET_PROTOCOL_VERSION:
+            return struct.pack(">BH", cmd, self.via_protocol)
+        elif cmd == CMD_VIA_GET_LAYER_COUNT:
+            return struct.pack("BB", cmd, self.layers)
+        elif cmd == CMD_VIA_GET_KEYCODE:
+            layer, row, col = msg[1:4]
+            return msg[:4] + struct.pack(">H", self.keymap[(layer * self.rows + row) * self.cols + col])
+        elif cmd == CMD_VIA_SET_KEYCODE:
+            layer, row, col, code = struct.unpack(">BBBH", msg[1:6])
+            self.keymap[(layer * self.rows + row) * self.cols + col] = code
+            return msg
+        elif cmd in (CMD_VIA_KEYMAP_GET_BUFFER, CMD_VIA_KEYMAP_SET_BUFFER):
+            offset, size = struct.unpack(">HB", msg[1:4])
+            buf = bytearray(encode_keymap_buffer(self.keymap))
+            if cmd == CMD_VIA_KEYMAP_GET_BUFFER:
+                return msg[:4] + bytes(buf[offset:offset + size])
+            buf[offset:offset + size] = msg[4:4 + size]
+            self.keymap = decode_keymap_buffer(buf[:len(self.keymap) * 2])
+            return msg
+        elif cmd == CMD_VIA_MACRO_GET_COUNT:
+            return struct.pack("BB", cmd, self.macro_count)
+        elif cmd == CMD_VIA_MACRO_GET_BUFFER_SIZE:
+            return struct.pack(">BH", cmd, len(self.macro))
+        elif cmd == CMD_VIA_MACRO_GET_BUFFER:
+            offset, size = struct.unpack(">HB", msg[1:4])
+            return msg[:4] + bytes(self.macro[offset:offset + size])
+        elif cmd == CMD_VIA_MACRO_SET_BUFFER:
+            offset, size = struct.unpack(">HB", msg[1:4])
+            self.macro[offset:offset + size] = msg[4:4 + size]
+            return msg
+        elif cmd == CMD_VIA_GET_KEYBOARD_VALUE:
+            if msg[1] == VIA_LAYOUT_OPTIONS:
+                return msg[:2] + struct.pack(">I", self.layout_options)
+            elif msg[1] == VIA_SWITCH_MATRIX_STATE:
+                return msg[:2] + self.matrix_state()
+        elif cmd == CMD_VIA_SET_KEYBOARD_VALUE:
+            if msg[1] == VIA_LAYOUT_OPTIONS:
+                self.layout_options = struct.unpack(">I", msg[2:6])[0]
+            return msg
+        elif cmd == CMD_VIA_LIGHTING_GET_VALUE:
+            if msg[1] in self.rgblight:
+                return msg[:2] + bytes(self.rgblight[msg[1]])
+            elif msg[1] == VIALRGB_GET_INFO:
+                return msg[:2] + struct.pack("<HB", 1, 255)
+            elif msg[1] == VIALRGB_GET_MODE:
+                return msg[:2] + self.rgb_mode
+            elif msg[1] == VIALRGB_GET_SUPPORTED:
+                gt = struct.unpack("<H", msg[2:4])[0]
+                effects = [x for x in self.lighting_effects if x > gt][:(MSG_LEN - 2) // 2]
+                effects += [0xFFFF] * ((MSG_LEN - 2) // 2 - len(effects))
+                return msg[:2] + struct.pack("<{}H".format(len(effects)), *effects)
+        elif cmd == CMD_VIA_LIGHTING_SET_VALUE:
+            if msg[1] == VIALRGB_SET_MODE:
+                self.rgb_mode = msg[2:8]
+            elif msg[1] in self.rgblight:
+                self.rgblight[msg[1]] = list(msg[2:2 + len(self.rgblight[msg[1]])])
+            return msg
+        elif cmd == CMD_VIA_LIGHTING_SAVE:
+            return msg
+        # the firmware echoes back unknown commands with the id replaced by id_unhandled
+        return b"\xFF" + msg[1:]
+
+    def handle_vial(self, msg):
+        cmd = msg[1]
+        if cmd == CMD_VIAL_GET_KEYBOARD_ID:
+            return struct.pack("<IQ", self.vial_protocol, self.keyboard_id)
+        elif cmd == CMD_VIAL_GET_SIZE:
+            return struct.pack("<I", len(self.compressed))
+        elif cmd == CMD_VIAL_GET_DEFINITION:
+            block = struct.unpack("<I", msg[2:6])[0]
+            return self.compressed[block * MSG_LEN:(block + 1) * MSG_LEN]
+        elif cmd == CMD_VIAL_GET_ENCODER:
+            layer, idx = msg[2:4]
+            base = (layer * self.encoders + idx) * 2
+            return struct.pack(">HH", self.encoder_keymap[base], self.encoder_keymap[base + 1])
+        elif cmd == CMD_VIAL_SET_ENCODER:
+            layer, idx, direction, code = struct.unpack(">BBBH", msg[2:7])
+            self.encoder_keymap[(layer * self.encoders + idx) * 2 + direction] = code
+            return b""
+        elif cmd == CMD_VIAL_GET_UNLOCK_STATUS:
+            keys = b""
+            for row, col in self.unlock_keys[:15]:
+                keys += struct.pack("BB", row, col)
+            keys += b"\xFF" * (30 - len(keys))
+            return struct.pack("BB", int(self.unlocked), int(self.unlock_counter > 0)) + keys
+        elif cmd == CMD_VIAL_UNLOCK_START:
+            self.unlock_counter = UNLOCK_POLLS
+            return b""
+        elif cmd == CMD_VIAL_UNLOCK_POLL:
+            if self.unlock_counter > 0:
+                self.unlock_counter -= 1
+                self.unlocked = self.unlock_counter == 0
+            return struct.pack("BBB", int(self.unlocked), int(self.unlock_counter > 0), self.unlock_counter)
+        elif cmd == CMD_VIAL_LOCK:
+            self.unlocked = False
+            return b""
+        elif cmd == CMD_VIAL_QMK_SETTINGS_QUERY:
+            gt = struct.unpack("<H", msg[2:4])[0]
+            qsids = [x for x in sorted(self.settings) if x > gt][:MSG_LEN // 2]
+            qsids += [0xFFFF] * (MSG_LEN // 2 - len(qsids))
+            return struct.pack("<{}H".format(len(qsids)), *qsids)
+        elif cmd == CMD_VIAL_QMK_SETTINGS_GET:
+            qsid = struct.unpack("<H", msg[2:4])[0]
+            if qsid not in self.settings:
+                return b"\x01"
+            return b"\x00" + self.settings[qsid]
+        elif cmd == CMD_VIAL_QMK_SETTINGS_SET:
+            qsid = struct.unpack("<H", msg[2:4])[0]
+            if qsid not in self.settings:
+                return b"\x01"
+            self.settings[qsid] = msg[4:4 + len(self.settings[qsid])]
+            return b"\x00"
+        elif cmd == CMD_VIAL_QMK_SETTINGS_RESET:
+            for qsid in self.settings:
+                self.settings[qsid] = bytes(len(self.settings[qsid]))
+            return b""
+        elif cmd == CMD_VIAL_DYNAMIC_ENTRY_OP:
+            return self.handle_dynamic(msg)
+        return b"\xFF" + msg[1:]
+
+    def handle_dynamic(self, msg):
+        op = msg[2]
+        if op == DYNAMIC_VIAL_GET_NUMBER_OF_ENTRIES:
+            out = bytes(len(self.dynamic[name]) for name, get_op, set_op, size in DYNAMIC_ENTRY_SIZES)
+            # last byte carries the optional feature flags: caps word and layer lock
+            return out + b"\x00" * (MSG_LEN - 1 - len(out)) + b"\x03"
+        for name, get_op, set_op, size in DYNAMIC_ENTRY_SIZES:
+            entries = self.dynamic[name]
+            if op == get_op:
+                if msg[3] >= len(entries):
+                    return b"\x01"
+                return b"\x00" + entries[msg[3]]
+            elif op == set_op:
+                if msg[3] >= len(entries):
+                    return b"\x01"
+                entries[msg[3]] = msg[4:4 + size]
+                return b"\x00"
+        return b"\x01"
+
+    def lost(self):
+        return self.loss and random.random() < self.loss
+
+    def send(self, dev, msg, retries=1):
+        """ usb_send compatible, dev is ignored """
+        while retries > 0:
+            retries -= 1
+            if self.latency:
+                time.sleep(self.latency)
+            data = self.handle(msg)
+            if not self.lost():
+                return data
+        raise RuntimeError("failed to communicate with the device")
+
+    def device(self):
+        return EmulatedDevice(self)
+
+    def serve(self, path):
+        """ Serves the emulator on a Unix socket at path from a background thread, returns the server """
+        emulator = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                while True:
+                    msg = recv_exactly(self.request, MSG_LEN)
+                    if msg is None:
+                        return
+                    if emulator.latency:
+                        time.sleep(emulator.latency)
+                    data = emulator.handle(msg)
+                    if not emulator.lost():
+                        self.request.sendall(data)
+
+        server = socketserver.ThreadingUnixStreamServer(path, Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+def recv_exactly(sock, length):
+    data = b""
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+class EmulatedDevice:
+    """ hidapi-like device backed by a VialEmulator, responses are queued so requests can be pipelined """
+
+    def __init__(self, emulator):
+        self.emulator = emulator
+        self.responses = []
+
+    def write(self, data):
+        # drop the report id
+        data = bytes(data[1:])
+        if self.emulator.latency:
+            time.sleep(self.emulator.latency)
+        response = self.emulator.handle(data)
+        if not self.emulator.lost():
+            self.responses.append(response)
+        return len(data) + 1
+
+    def read(self, length, timeout_ms=0):
+        if self.responses:
+            return self.responses.pop(0)[:length]
+        time.sleep(timeout_ms / 1000)
+        return b""
+
+    def close(self):
+        pass
+
+
+class SocketDevice:
+    """ hidapi-like device talking to a VialEmulator served on a Unix socket """
+
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        # the start of a packet whose rest hadn't arrived when a read timed out
+        self.partial = b""
+
+    def write(self, data):
+        data = bytes(data[1:])
+        self.sock.sendall(data + b"\x00" * (MSG_LEN - len(data)))
+        return len(data) + 1
+
+    def read(self, length, timeout_ms=0):
+        """ Returns one whole packet, or nothing when it hasn't fully arrived before the timeout """
+        deadline = time.monotonic() + max(timeout_ms, 1) / 1000
+        while len(self.partial) < MSG_LEN:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return b""
+            self.sock.settimeout(remaining)
+            try:
+                chunk = self.sock.recv(MSG_LEN - len(self.partial))
+            except socket.timeout:
+                return b""
+            if not chunk:
+                return b""
+            self.partial += chunk
+        data, self.partial = self.partial, b""
+        return data[:length]
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,192 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import itertools
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+
+from PyQt6.QtCore import QObject, QCoreApplication, pyqtSignal
+
+from protocol.transport import classify, COMMAND_INTERACTIVE, COMMAND_POLLING, COMMAND_BULK, COMMAND_WRITE
+from util import PIPELINE_WINDOW
+
+PRIORITY_STOP = -1
+PRIORITY_INTERACTIVE = 0
+PRIORITY_POLLING = 1
+PRIORITY_BULK = 2
+# work nobody is waiting on yet, e.g. keymap layers fetched ahead of being shown
+PRIORITY_BACKGROUND = 3
+
+COMMAND_PRIORITY = {
+    COMMAND_INTERACTIVE: PRIORITY_INTERACTIVE,
+    COMMAND_WRITE: PRIORITY_INTERACTIVE,
+    COMMAND_POLLING: PRIORITY_POLLING,
+    COMMAND_BULK: PRIORITY_BULK,
+}
+
+
+class DeviceWorker(QObject):
+    """
+    Owns all I/O with one device on a dedicated thread. Work is served from a priority queue one packet
+    (or one pipelined window of packets) at a time, so interactive writes go ahead of matrix and unlock
+    polls, which in turn go ahead of bulk reloads.
+    """
+
+    # emitted on the GUI thread when a job submitted with a callback completes: (future, callback)
+    done = pyqtSignal(object, object)
+    # emitted by jobs to run something on the GUI thread while they go on, e.g. report progress: (fn, args)
+    posted = pyqtSignal(object, object)
+
+    def __init__(self, send, send_many=None):
+        super().__init__()
+        # the worker may be created on a background thread while opening a device, completions belong to the GUI
+        app = QCoreApplication.instance()
+        if app is not None:
+            self.moveToThread(app.thread())
+        self.done.connect(self.on_done)
+        self.posted.connect(self.on_posted)
+
+        self.direct_send = send
+        self.direct_send_many = send_many
+        self.queue = queue.PriorityQueue()
+        self.seq = itertools.count()
+        # once set under the lock nothing more is queued, so the drain after stopping can't miss a job
+        self.lock = threading.Lock()
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name="vial-io", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            priority, seq, job = self.queue.get()
+            if priority == PRIORITY_STOP:
+                break
+            future, fn, args, kwargs, callback = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+            if callback is not None:
+                self.done.emit(future, callback)
+
+        # nothing is going to serve whatever is still queued
+        with self.lock:
+            self.stopped = True
+        while not self.queue.empty():
+            priority, seq, job = self.queue.get()
+            if priority != PRIORITY_STOP:
+                self.fail(job[0], job[4])
+
+    def on_worker_thread(self):
+        return threading.current_thread() is self.thread
+
+    def submit(self, fn, *args, priority=PRIORITY_INTERACTIVE, callback=None, **kwargs):
+        """ Queues fn to run on the worker thread, returns a Future; callback(future) then runs on the GUI thread """
+        future = Future()
+        with self.lock:
+            if not self.stopped:
+                self.queue.put((priority, next(self.seq), (future, fn, args, kwargs, callback)))
+                return future
+        self.fail(future, callback)
+        return future
+
+    def fail(self, future, callback):
+        future.set_exception(RuntimeError("device I/O worker stopped"))
+        if callback is not None:
+            self.done.emit(future, callback)
+
+    def on_done(self, future, callback):
+        try:
+            callback(future)
+        except Exception:
+            logging.exception("device I/O completion callback failed")
+
+    def on_posted(self, fn, args):
+        try:
+            fn(*args)
+        except Exception:
+            logging.exception("device I/O progress callback failed")
+
+    def send(self, dev, msg, retries=1):
+        """ usb_send compatible, waits for the packet to be served in its priority order """
+        if self.on_worker_thread():
+            return self.direct_send(dev, msg, retries=retries)
+        priority = COMMAND_PRIORITY[classify(msg)]
+        return self.submit(self.direct_send, dev, msg, retries=retries, priority=priority).result()
+
+    def send_many(self, dev, msgs, echo=0, retries=1):
+        """ usb_send_many compatible, higher priority work can get in between every pipelined window """
+        if self.direct_send_many is None:
+            send_many = self.send_each
+        else:
+            send_many = self.direct_send_many
+        if self.on_worker_thread():
+            return send_many(dev, msgs, echo=echo, retries=retries)
+
+        out = []
+        for x in range(0, len(msgs), PIPELINE_WINDOW):
+            window = msgs[x:x + PIPELINE_WINDOW]
+            priority = COMMAND_PRIORITY[classify(window[0])]
+            out += self.submit(send_many, dev, window, echo=echo, retries=retries, priority=priority).result()
+        return out
+
+    def send_each(self, dev, msgs, echo=0, retries=1):
+        return [self.direct_send(dev, msg, retries=retries) for msg in msgs]
+
+    def stop(self):
+        self.queue.put((PRIORITY_STOP, next(self.seq), None))
+        if not self.on_worker_thread():
+            self.thread.join(timeout=5)
+
+
+def call_async(keyboard, fn, callback, priority=PRIORITY_INTERACTIVE, unlock=False):
+    """
+    Runs fn on the keyboard's I/O worker and callback(future) on the GUI thread once it is done.
+    Keyboards without a worker run fn right away.
+
+    With unlock set the keyboard has to be unlocked before fn runs, e.g. for writes which assign QK_BOOT,
+    see Unlocker.unlock_async. fn doesn't run at all when the user cancels the dialog.
+    """
+    if unlock:
+        from unlocker import Unlocker
+
+        def on_unlocked(future):
+            if future.exception() is not None:
+                callback(future)
+            elif future.result():
+                call_async(keyboard, fn, callback, priority)
+            else:
+                cancelled = Future()
+                cancelled.set_exception(RuntimeError("the keyboard was not unlocked"))
+                callback(cancelled)
+
+        return Unlocker.unlock_async(keyboard, on_unlocked)
+
+    worker = getattr(keyboard, "worker", None)
+    if worker is not None:
+        return worker.submit(fn, priority=priority, callback=callback)
+
+    future = Future()
+    try:
+        future.set_result(fn())
+    except Exception as e:
+        future.set_exception(e)
+    callback(future)
+    return future
+
+
+def call_on_gui(keyboard, fn, *args):
+    """ For jobs running through call_async: runs fn(*args) on the GUI thread without waiting for it """
+    worker = getattr(keyboard, "worker", None)
+    if worker is not None and worker.on_worker_thread():
+        worker.posted.emit(fn, args)
+    else:
+        fn(*args)
+
+
+def log_failure(future):
+    """ call_async callback for writes nothing else has to wait on """
+    if future.exception() is not None:
+        logging.error("writing to the keyboard failed: {}".format(future.exception()))
@@ -1,7 +1,10 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 import struct
+import sys
 import json
 import lzma
+from abc import ABC, abstractmethod
+from array import array
 from collections import OrderedDict
 
 from keycodes.keycodes import RESET_KEYCODE, Keycode, recreate_keyboard_keycodes
@@ -16,36 +19,275 @@ from protocol.constants import CMD_VIA_GET_PROTOCOL_VERSION, CMD_VIA_GET_KEYBOAR
     VIALRGB_GET_SUPPORTED, VIALRGB_SET_MODE, CMD_VIAL_GET_KEYBOARD_ID, CMD_VIAL_GET_SIZE, CMD_VIAL_GET_DEFINITION, \
     CMD_VIAL_GET_ENCODER, CMD_VIAL_SET_ENCODER, CMD_VIAL_GET_UNLOCK_STATUS, CMD_VIAL_UNLOCK_START, CMD_VIAL_UNLOCK_POLL, \
     CMD_VIAL_LOCK, CMD_VIAL_QMK_SETTINGS_QUERY, CMD_VIAL_QMK_SETTINGS_GET, CMD_VIAL_QMK_SETTINGS_SET, \
-    CMD_VIAL_QMK_SETTINGS_RESET, BUFFER_FETCH_CHUNK, VIAL_PROTOCOL_QMK_SETTINGS
+    CMD_VIAL_QMK_SETTINGS_RESET, BUFFER_FETCH_CHUNK, VIAL_PROTOCOL_QMK_SETTINGS, CMD_VIA_KEYMAP_SET_BUFFER, \
+    VIA_PROTOCOL_KEYMAP_SET_BUFFER
 from protocol.dynamic import ProtocolDynamic
+from protocol.io_worker import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE
 from protocol.key_override import ProtocolKeyOverride
 from protocol.macro import ProtocolMacro
 from protocol.tap_dance import ProtocolTapDance
+from protocol.transport import TransportPolicy
 from unlocker import Unlocker
 from util import MSG_LEN, hid_send
 
 SUPPORTED_VIA_PROTOCOL = [-1, 9]
 SUPPORTED_VIAL_PROTOCOL = [-1, 0, 1, 2, 3, 4, 5, 6]
 
+# stages of Keyboard.reload, in the order their data becomes available
+# definition, layers, keycodes and the first layer of the keymap
+STAGE_LAYOUT = "layout"
+# remaining layers of the keymap, or with a lazy keymap the point from which they are fetched in the background
+STAGE_KEYMAP = "keymap"
+STAGE_MACROS = "macros"
+# tap dance, combos, key overrides and alt repeat keys
+STAGE_DYNAMIC = "dynamic"
+STAGE_SETTINGS = "settings"
+STAGE_LIGHTING = "lighting"
+RELOAD_STAGES = [STAGE_LAYOUT, STAGE_KEYMAP, STAGE_MACROS, STAGE_DYNAMIC, STAGE_SETTINGS, STAGE_LIGHTING]
+
 
 class ProtocolError(Exception):
     pass
 
 
+def decode_keymap_buffer(buf):
+    """ Decodes a big-endian keymap buffer as received from the keyboard into an array of 16-bit keycodes """
+    keymap = array("H", bytes(buf))
+    if sys.byteorder == "little":
+        keymap.byteswap()
+    return keymap
+
+
+def encode_keymap_buffer(codes):
+    """ Encodes an array of 16-bit keycodes into a big-endian buffer as expected by the keyboard """
+    codes = array("H", codes)
+    if sys.byteorder == "little":
+        codes.byteswap()
+    return codes.tobytes()
+
+
+class KeymapView(ABC):
+    """
+    Dict-like view over a part of a KeymapStore, keyed by tuples and serializing keycodes on demand.
+    Like the dicts it replaces, it accepts keys outside of the keyboard's layout, those are kept aside.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        # key -> keycode for keys which aren't part of the store
+        self.extra = dict()
+
+    @abstractmethod
+    def index(self, key):
+        """ Returns position of the key within the store's codes, raises KeyError if it isn't part of the view """
+
+    @abstractmethod
+    def store_keys(self):
+        """ Keys backed by the store, in the order they were always listed in """
+
+    def keys(self):
+        yield from self.store_keys()
+        yield from list(self.extra)
+
+    def raw(self, key):
+        return self.store.codes[self.index(key)]
+
+    def set_raw(self, key, code):
+        idx = self.index(key)
+        self.store.codes[idx] = code
+        self.store.strings.pop(idx, None)
+
+    def __getitem__(self, key):
+        try:
+            idx = self.index(key)
+        except (KeyError, TypeError, ValueError):
+            return self.extra[key]
+        return self.store.string(idx)
+
+    def __setitem__(self, key, code):
+        try:
+            idx = self.index(key)
+        except (KeyError, TypeError, ValueError):
+            self.extra[key] = code
+            return
+        self.store.set_string(idx, code)
+
+    def __contains__(self, key):
+        try:
+            self.index(key)
+        except (KeyError, TypeError, ValueError):
+            return key in self.extra
+        return True
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def __iter__(self):
+        return self.keys()
+
+    def items(self):
+        for key in self.keys():
+            yield key, self[key]
+
+
+class MatrixView(KeymapView):
+    """ (layer, row, col) -> keycode, the store holds matrix positions which are present in the layout """
+
+    def index(self, key):
+        layer, row, col = key
+        store = self.store
+        if 0 <= layer < store.layers and 0 <= row < store.rows and 0 <= col < store.cols:
+            cell = row * store.cols + col
+            if store.present[cell >> 3] & (1 << (cell & 7)):
+                return layer * store.plane + cell
+        raise KeyError(key)
+
+    def store_keys(self):
+        store = self.store
+        for layer in range(store.layers):
+            for cell in store.cells:
+                yield layer, cell // store.cols, cell % store.cols
+
+    def __len__(self):
+        return self.store.layers * len(self.store.cells) + len(self.extra)
+
+    def save(self):
+        """ Nested layers/rows/cols lists of serialized keycodes, with -1 for cells not in the layout """
+        store = self.store
+        layout = []
+        for layer in range(store.layers):
+            rows = []
+            for row in range(store.rows):
+                cols = []
+                for col in range(store.cols):
+                    cell = row * store.cols + col
+                    if store.present[cell >> 3] & (1 << (cell & 7)):
+                        cols.append(store.string(layer * store.plane + cell))
+                    else:
+                        cols.append(self.extra.get((layer, row, col), -1))
+                rows.append(cols)
+            layout.append(rows)
+        return layout
+
+
+class EncoderView(KeymapView):
+    """ (layer, encoder index, direction) -> keycode """
+
+    def index(self, key):
+        layer, idx, direction = key
+        store = self.store
+        if 0 <= layer < store.layers and idx in store.encoder_indices and direction in (0, 1):
+            return store.encoder_base + (layer * store.encoders + idx) * 2 + direction
+        raise KeyError(key)
+
+    def store_keys(self):
+        for layer in range(self.store.layers):
+            for idx in sorted(self.store.encoder_indices):
+                yield layer, idx, 0
+                yield layer, idx, 1
+
+    def __len__(self):
+        return self.store.layers * len(self.store.encoder_indices) * 2 + len(self.extra)
+
+    def save(self):
+        """ Nested layers/encoders lists of serialized [cw, ccw] keycodes, -1 for encoders not in the layout """
+        store = self.store
+        return [[[store.string(store.encoder_base + (layer * store.encoders + idx) * 2 + direction)
+                  if idx in store.encoder_indices else self.extra.get((layer, idx, direction), -1)
+                  for direction in (0, 1)] for idx in range(store.encoders)] for layer in range(store.layers)]
+
+
+class KeymapStore:
+    """
+    Raw keycodes of the whole keymap packed into one array: layers*rows*cols matrix cells followed by
+    a layers*encoders*2 encoder plane. Keycodes are serialized to strings only when asked for.
+    """
+
+    def __init__(self, layers=0, rows=0, cols=0, cells=(), encoders=0, encoder_indices=None):
+        self.layers, self.rows, self.cols, self.encoders = layers, rows, cols, encoders
+        # encoders which are part of the layout, the plane has room for every index below `encoders`
+        self.encoder_indices = set(range(encoders) if encoder_indices is None else encoder_indices)
+        self.plane = rows * cols
+        self.encoder_base = layers * self.plane
+        self.codes = array("H", bytes(2 * (self.encoder_base + layers * encoders * 2)))
+        # bitmap of matrix cells which are part of the layout, the same for every layer
+        self.present = bytearray((self.plane + 7) // 8)
+        # the same cells in the order the layout lists them
+        self.cells = []
+        for row, col in cells:
+            cell = row * cols + col
+            if not self.present[cell >> 3] & (1 << (cell & 7)):
+                self.present[cell >> 3] |= 1 << (cell & 7)
+                self.cells.append(cell)
+        # index -> (raw keycode, serialized keycode), dropped whenever keycodes are recreated; the GUI reads
+        # these while the worker loads further layers, so an entry only counts while its raw keycode is current
+        self.strings = dict()
+        # layers whose keycodes have been retrieved from the keyboard
+        self.loaded_layers = set()
+        self.generation = Keycode.generation
+
+        self.layout = MatrixView(self)
+        self.encoder_layout = EncoderView(self)
+
+    def check_generation(self):
+        if self.generation != Keycode.generation:
+            self.strings.clear()
+            self.generation = Keycode.generation
+
+    def string(self, idx):
+        self.check_generation()
+        raw = self.codes[idx]
+        cached = self.strings.get(idx)
+        if cached is None or cached[0] != raw:
+            cached = self.strings[idx] = (raw, Keycode.serialize(raw))
+        return cached[1]
+
+    def set_string(self, idx, code):
+        self.check_generation()
+        raw = self.codes[idx] = Keycode.deserialize(code)
+        self.strings[idx] = (raw, code)
+
+    def load_matrix(self, buf, first_layer=0):
+        """ Loads layers of the matrix starting at first_layer from a big-endian buffer as received from the keyboard """
+        codes = decode_keymap_buffer(buf)
+        start = first_layer * self.plane
+        self.codes[start:start + len(codes)] = codes
+
+
 class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo, ProtocolKeyOverride, ProtocolAltRepeatKey):
     """ Low-level communication with a vial-enabled keyboard """
 
-    def __init__(self, dev, usb_send=hid_send):
+    def __init__(self, dev, usb_send=hid_send, usb_send_many=None, definition_cache=None, capability_cache=None):
         self.dev = dev
+        self.definition_cache = definition_cache
+        self.capability_cache = capability_cache
+        # what the firmware supports as found in the capability cache, None when it has to be queried
+        self.capabilities = None
+        self.capability_probe = self.settings_first_page = None
+        self.rgb_info = self.rgb_first_page = None
+        # a real device gets retries and timeouts adapted to how it behaves, and its bulk reads pipelined
+        self.transport = None
+        if usb_send is hid_send:
+            self.transport = TransportPolicy()
+            usb_send = self.transport.send
+            if usb_send_many is None:
+                usb_send_many = self.transport.send_many
         self.usb_send = usb_send
+        self.usb_send_many = usb_send_many
+        self.worker = None
+        # fetch layers past the first one in the background and on demand rather than during reload, needs a worker
+        self.lazy_keymap = False
         self.definition = None
 
         # n.b. using OrderedDict here to make order of layout requests consistent for tests
         self.rowcol = OrderedDict()
         self.encoderpos = OrderedDict()
         self.encoder_count = 0
-        self.layout = dict()
-        self.encoder_layout = dict()
+        self.keymap = KeymapStore()
+        self.layout = self.keymap.layout
+        self.encoder_layout = self.keymap.encoder_layout
         self.rows = self.cols = self.layers = 0
         self.layout_labels = None
         self.layout_options = -1
@@ -68,41 +310,152 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
         self.rgb_supported_effects = set()
 
         self.via_protocol = self.vial_protocol = self.keyboard_id = -1
+        self.loaded_stages = set()
 
-    def reload(self, sideload_json=None):
-        """ Load information about the keyboard: number of layers, physical key layout """
+    def attach_worker(self, worker):
+        """ Routes all further communication through a DeviceWorker, see protocol/io_worker.py """
+
+        self.worker = worker
+        self.usb_send = worker.send
+        self.usb_send_many = worker.send_many
+
+    def reload(self, sideload_json=None, on_stage=None):
+        """
+        Load information about the keyboard: number of layers, physical key layout and everything configured on it.
+        Data becomes available in stages, see RELOAD_STAGES; on_stage(stage) is called as each one completes.
+        """
 
         self.rowcol = OrderedDict()
         self.encoderpos = OrderedDict()
-        self.layout = dict()
-        self.encoder_layout = dict()
+        self.loaded_stages = set()
 
         self.reload_layout(sideload_json)
         self.reload_layers()
 
+        # the number of macros and dynamic entries decides which keycodes exist, both only take a packet or two
         self.reload_macros_early()
-        self.reload_persistent_rgb()
-        self.reload_rgb()
-        self.reload_settings()
-
         self.reload_dynamic()
+        self.load_capabilities()
 
         # based on the number of macros, tapdance, etc, this will generate global keycode arrays
         recreate_keyboard_keycodes(self)
 
-        # at this stage we have correct keycode info and can reload everything that depends on keycodes
-        self.reload_keymap()
+        # at this stage we have correct keycode info, the first layer is all the keymap editor needs to show up
+        self.allocate_keymap()
+        self.reload_keymap_layers(0, min(self.layers, 1))
+        self.reload_layout_options()
+        self.stage_done(STAGE_LAYOUT, on_stage)
+
+        lazy = self.lazy_keymap and self.worker is not None
+        if not lazy:
+            self.reload_keymap_layers(1, self.layers - 1)
+        self.stage_done(STAGE_KEYMAP, on_stage)
+
         self.reload_macros_late()
+        self.stage_done(STAGE_MACROS, on_stage)
+
         self.reload_tap_dance()
         self.reload_combo()
         self.reload_key_override()
         self.reload_alt_repeat_key()
+        self.stage_done(STAGE_DYNAMIC, on_stage)
+
+        self.reload_settings()
+        self.stage_done(STAGE_SETTINGS, on_stage)
+
+        self.reload_persistent_rgb()
+        self.reload_rgb()
+        self.store_capabilities()
+        self.stage_done(STAGE_LIGHTING, on_stage)
+
+        if lazy:
+            # only queued now so that they don't hold up the stages above, and then behind anything else;
+            # ensure_layer moves a layer the user asks for to the front
+            for layer in range(1, self.layers):
+                self.worker.submit(self.ensure_layer, layer, priority=PRIORITY_BACKGROUND)
+
+    def load_capabilities(self):
+        """
+        Looks up what the firmware supports in the capability cache. The entry is validated against the number
+        of dynamic entries, the first page of supported QMK settings and with VialRGB its info and the first page
+        of supported effects, each of which is a single packet.
+        """
+
+        self.capabilities = self.capability_probe = None
+        self.rgb_info = self.rgb_first_page = None
+        if self.capability_cache is None or self.vial_protocol < VIAL_PROTOCOL_QMK_SETTINGS:
+            return
+        # reload_supported_settings and reload_persistent_rgb start from these rather than asking again
+        self.settings_first_page = self.usb_send(
+            self.dev, struct.pack("<BBH", CMD_VIA_VIAL_PREFIX, CMD_VIAL_QMK_SETTINGS_QUERY, 0), retries=20)
+        self.capability_probe = self.dynamic_info + self.settings_first_page
+        if self.definition.get("lighting") == "vialrgb":
+            self.rgb_info = self.usb_send(self.dev, struct.pack("BB", CMD_VIA_LIGHTING_GET_VALUE, VIALRGB_GET_INFO),
+                                          retries=20)
+            self.rgb_first_page = self.usb_send(
+                self.dev, struct.pack("<BBH", CMD_VIA_LIGHTING_GET_VALUE, VIALRGB_GET_SUPPORTED, 0))
+            self.capability_probe += self.rgb_info + self.rgb_first_page
+        self.capabilities = self.capability_cache.load(self.keyboard_id, self.vial_protocol, self.via_protocol,
+                                                       self.definition, self.capability_probe)
+
+    def store_capabilities(self):
+        if self.capability_probe is None or self.capabilities is not None:
+            return
+        self.capabilities = {
+            "supported_settings": sorted(self.supported_settings),
+            "rgb_supported_effects": sorted(self.rgb_supported_effects),
+        }
+        self.capability_cache.store(self.keyboard_id, self.vial_protocol, self.via_protocol, self.definition,
+                                    self.capability_probe, self.capabilities)
+
+    def stage_done(self, stage, on_stage):
+        self.loaded_stages.add(stage)
+        if on_stage is not None:
+            on_stage(stage)
+
+    def layer_loaded(self, layer):
+        """ Whether the keymap of `layer` has been retrieved from the keyboard yet """
+        return layer in self.keymap.loaded_layers
+
+    def ensure_layer(self, layer):
+        """ Fetches `layer` of the keymap unless it is loaded already """
+        if not self.layer_loaded(layer):
+            self.reload_keymap_layers(layer, 1)
+
+    def wait_keymap(self, layers=None):
+        """ Blocks until the given layers, by default the whole keymap, are loaded """
+
+        if layers is None:
+            layers = range(self.layers)
+        missing = [layer for layer in layers if 0 <= layer < self.layers and not self.layer_loaded(layer)]
+        if not missing:
+            return
+        if self.worker is None or self.worker.on_worker_thread():
+            for layer in missing:
+                self.ensure_layer(layer)
+            return
+        # all keymap fetches go through the worker, so that a layer is never retrieved twice at the same time
+        futures = [self.worker.submit(self.ensure_layer, layer, priority=PRIORITY_INTERACTIVE) for layer in missing]
+        for future in futures:
+            future.result()
 
     def reload_layers(self):
         """ Get how many layers the keyboard has """
 
         self.layers = self.usb_send(self.dev, struct.pack("B", CMD_VIA_GET_LAYER_COUNT), retries=20)[1]
 
+    def allocate_keymap(self):
+        """ Sets up an empty keymap store sized for the current matrix, layers and encoders """
+
+        for row, col in self.rowcol.keys():
+            if row >= self.rows or col >= self.cols:
+                raise RuntimeError("malformed vial.json, key references {},{} but matrix declares rows={} cols={}"
+                                   .format(row, col, self.rows, self.cols))
+        self.keymap = KeymapStore(self.layers, self.rows, self.cols, self.rowcol.keys(), self.encoder_count,
+                                  self.encoderpos.keys())
+        self.layout = self.keymap.layout
+        self.encoder_layout = self.keymap.encoder_layout
+
     def reload_via_protocol(self):
         data = self.usb_send(self.dev, struct.pack("B", CMD_VIA_GET_PROTOCOL_VERSION), retries=20)
         self.via_protocol = struct.unpack(">H", data[1:3])[0]
@@ -117,6 +470,7 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
         self.reload_via_protocol()
 
         self.sideload = False
+        kle_keys = None
         if sideload_json is not None:
             self.sideload = True
             payload = sideload_json
@@ -129,19 +483,7 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
             data = self.usb_send(self.dev, struct.pack("BB", CMD_VIA_VIAL_PREFIX, CMD_VIAL_GET_SIZE), retries=20)
             sz = struct.unpack("<I", data[0:4])[0]
 
-            # get the payload
-            payload = b""
-            block = 0
-            while sz > 0:
-                data = self.usb_send(self.dev, struct.pack("<BBI", CMD_VIA_VIAL_PREFIX, CMD_VIAL_GET_DEFINITION, block),
-                                     retries=20)
-                if sz < MSG_LEN:
-                    data = data[:sz]
-                payload += data
-                block += 1
-                sz -= MSG_LEN
-
-            payload = json.loads(lzma.decompress(payload))
+            payload, kle_keys = self.download_definition(sz)
 
         self.check_protocol_version()
 
@@ -159,13 +501,13 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
 
         self.custom_keycodes = payload.get("customKeycodes", None)
 
-        serial = KleSerial()
-        kb = serial.deserialize(payload["layouts"]["keymap"])
+        if kle_keys is None:
+            kle_keys = KleSerial().deserialize(payload["layouts"]["keymap"]).keys
 
         self.keys = []
         self.encoders = []
 
-        for key in kb.keys:
+        for key in kle_keys:
             key.row = key.col = None
             key.encoder_idx = key.encoder_dir = None
             if key.labels[4] == "e":
@@ -193,35 +535,78 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
                 idx, opt = key.labels[8].split(",")
                 key.layout_index, key.layout_option = int(idx), int(opt)
 
+    def download_definition(self, sz):
+        """ Retrieves the compressed vial.json of size sz, returns the parsed definition and its KLE keys """
+
+        # the first block is always fetched, it is what a cached definition gets validated against
+        first = self.usb_send(self.dev, struct.pack("<BBI", CMD_VIA_VIAL_PREFIX, CMD_VIAL_GET_DEFINITION, 0),
+                              retries=20)[:min(sz, MSG_LEN)]
+        if self.definition_cache is not None:
+            cached = self.definition_cache.load(self.keyboard_id, sz, first)
+            if cached is not None:
+                return cached
+
+        # get the payload, decompressing every block as it arrives so that a corrupt stream fails right away
+        decompressor = lzma.LZMADecompressor()
+        text = bytearray(decompressor.decompress(first))
+        block = 1
+        remaining = sz - MSG_LEN
+        while remaining > 0 and not decompressor.eof:
+            data = self.usb_send(self.dev, struct.pack("<BBI", CMD_VIA_VIAL_PREFIX, CMD_VIAL_GET_DEFINITION, block),
+                                 retries=20)
+            if remaining < MSG_LEN:
+                data = data[:remaining]
+            text += decompressor.decompress(data)
+            block += 1
+            remaining -= MSG_LEN
+        if not decompressor.eof:
+            raise lzma.LZMAError("Compressed data ended before the end-of-stream marker was reached")
+
+        definition = json.loads(text)
+        keys = KleSerial().deserialize(definition["layouts"]["keymap"]).keys
+        if self.definition_cache is not None:
+            self.definition_cache.store(self.keyboard_id, sz, first, definition, keys)
+        return definition, keys
+
     def reload_keymap(self):
         """ Load current key mapping from the keyboard """
 
-        keymap = b""
-        # calculate what the size of keymap will be and retrieve the entire binary buffer
-        size = self.layers * self.rows * self.cols * 2
-        for x in range(0, size, BUFFER_FETCH_CHUNK):
-            offset = x
-            sz = min(size - offset, BUFFER_FETCH_CHUNK)
-            data = self.usb_send(self.dev, struct.pack(">BHB", CMD_VIA_KEYMAP_GET_BUFFER, offset, sz), retries=20)
-            keymap += data[4:4+sz]
-
-        for layer in range(self.layers):
-            for row, col in self.rowcol.keys():
-                if row >= self.rows or col >= self.cols:
-                    raise RuntimeError("malformed vial.json, key references {},{} but matrix declares rows={} cols={}"
-                                       .format(row, col, self.rows, self.cols))
-                # determine where this (layer, row, col) will be located in keymap array
-                offset = layer * self.rows * self.cols * 2 + row * self.cols * 2 + col * 2
-                keycode = Keycode.serialize(struct.unpack(">H", keymap[offset:offset+2])[0])
-                self.layout[(layer, row, col)] = keycode
-
-        for layer in range(self.layers):
+        self.reload_keymap_layers(0, self.layers)
+        self.reload_layout_options()
+
+    def reload_keymap_layers(self, first, count):
+        """ Load `count` layers of the keymap and their encoders, starting at layer `first` """
+
+        if count <= 0:
+            return
+
+        # calculate which part of the keymap buffer these layers are and retrieve it
+        plane = self.rows * self.cols * 2
+        start, size = first * plane, count * plane
+        keymap = bytearray(size)
+        view = memoryview(keymap)
+        msgs = [struct.pack(">BHB", CMD_VIA_KEYMAP_GET_BUFFER, offset, min(start + size - offset, BUFFER_FETCH_CHUNK))
+                for offset in range(start, start + size, BUFFER_FETCH_CHUNK)]
+        # the firmware echoes the offset/size header back, which is what pipelined responses are matched by
+        for msg, data in zip(msgs, self._usb_send_many(msgs, echo=4)):
+            offset, sz = struct.unpack(">HB", msg[1:4])
+            view[offset-start:offset-start+sz] = data[4:4+sz]
+
+        for layer in range(first, first + count):
+            # a layer which was fetched on its own in the meantime may have been changed since
+            if self.layer_loaded(layer):
+                continue
+            pos = (layer - first) * plane
+            self.keymap.load_matrix(view[pos:pos+plane], layer)
             for idx in self.encoderpos:
                 data = self.usb_send(self.dev, struct.pack("BBBB", CMD_VIA_VIAL_PREFIX, CMD_VIAL_GET_ENCODER, layer, idx),
                                      retries=20)
-                self.encoder_layout[(layer, idx, 0)] = Keycode.serialize(struct.unpack(">H", data[0:2])[0])
-                self.encoder_layout[(layer, idx, 1)] = Keycode.serialize(struct.unpack(">H", data[2:4])[0])
+                cw, ccw = struct.unpack(">HH", data[0:4])
+                self.encoder_layout.set_raw((layer, idx, 0), cw)
+                self.encoder_layout.set_raw((layer, idx, 1), ccw)
+            self.keymap.loaded_layers.add(layer)
 
+    def reload_layout_options(self):
         if self.layout_labels:
             data = self.usb_send(self.dev, struct.pack("BB", CMD_VIA_GET_KEYBOARD_VALUE, VIA_LAYOUT_OPTIONS),
                                  retries=20)
@@ -239,19 +624,28 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
             self.lighting_vialrgb = self.definition["lighting"] == "vialrgb"
 
         if self.lighting_vialrgb:
-            data = self.usb_send(self.dev, struct.pack("BB", CMD_VIA_LIGHTING_GET_VALUE, VIALRGB_GET_INFO),
-                                 retries=20)[2:]
+            data = self.rgb_info
+            if data is None:
+                data = self.usb_send(self.dev, struct.pack("BB", CMD_VIA_LIGHTING_GET_VALUE, VIALRGB_GET_INFO),
+                                     retries=20)
+            data = data[2:]
             self.rgb_version = data[0] | (data[1] << 8)
             if self.rgb_version != 1:
                 raise RuntimeError("Unsupported VialRGB protocol ({}), update your Vial version to latest"
                                    .format(self.rgb_version))
             self.rgb_maximum_brightness = data[2]
 
+        if self.lighting_vialrgb and self.capabilities is not None:
+            self.rgb_supported_effects = set(self.capabilities["rgb_supported_effects"])
+        elif self.lighting_vialrgb:
             self.rgb_supported_effects = {0}
             max_effect = 0
             while max_effect < 0xFFFF:
-                data = self.usb_send(self.dev, struct.pack("<BBH", CMD_VIA_LIGHTING_GET_VALUE, VIALRGB_GET_SUPPORTED,
-                                                           max_effect))[2:]
+                if max_effect == 0 and self.rgb_first_page is not None:
+                    data = self.rgb_first_page[2:]
+                else:
+                    data = self.usb_send(self.dev, struct.pack("<BBH", CMD_VIA_LIGHTING_GET_VALUE,
+                                                               VIALRGB_GET_SUPPORTED, max_effect))[2:]
                 for x in range(0, len(data), 2):
                     value = int.from_bytes(data[x:x+2], byteorder="little")
                     if value != 0xFFFF:
@@ -286,32 +680,42 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
 
     def reload_settings(self):
         self.settings = dict()
+        # qsid -> value waiting for qmk_settings_flush
+        self.pending_settings = dict()
         self.supported_settings = set()
         if self.vial_protocol < VIAL_PROTOCOL_QMK_SETTINGS:
             return
+        if self.capabilities is not None:
+            self.supported_settings = set(self.capabilities["supported_settings"])
+        else:
+            self.reload_supported_settings()
+
+        from editor.qmk_settings import QmkSettings
+
+        qsids = [qsid for qsid in sorted(self.supported_settings) if QmkSettings.is_qsid_supported(qsid)]
+        msgs = [struct.pack("<BBH", CMD_VIA_VIAL_PREFIX, CMD_VIAL_QMK_SETTINGS_GET, qsid) for qsid in qsids]
+        # responses don't echo the qsid, so these can only be matched in order
+        for qsid, data in zip(qsids, self._usb_send_many(msgs)):
+            if data[0] == 0:
+                self.settings[qsid] = QmkSettings.qsid_deserialize(qsid, data[1:])
+
+    def reload_supported_settings(self):
         cur = 0
         while cur != 0xFFFF:
-            data = self.usb_send(self.dev, struct.pack("<BBH", CMD_VIA_VIAL_PREFIX, CMD_VIAL_QMK_SETTINGS_QUERY, cur),
-                                 retries=20)
+            if cur == 0 and self.capability_probe is not None:
+                data = self.settings_first_page
+            else:
+                data = self.usb_send(self.dev, struct.pack("<BBH", CMD_VIA_VIAL_PREFIX, CMD_VIAL_QMK_SETTINGS_QUERY,
+                                                           cur), retries=20)
             for x in range(0, len(data), 2):
                 qsid = int.from_bytes(data[x:x+2], byteorder="little")
                 cur = max(cur, qsid)
                 if qsid != 0xFFFF:
                     self.supported_settings.add(qsid)
 
-        for qsid in self.supported_settings:
-            from editor.qmk_settings import QmkSettings
-
-            if not QmkSettings.is_qsid_supported(qsid):
-                continue
-
-            data = self.usb_send(self.dev, struct.pack("<BBH", CMD_VIA_VIAL_PREFIX, CMD_VIAL_QMK_SETTINGS_GET, qsid),
-                                 retries=20)
-            if data[0] == 0:
-                self.settings[qsid] = QmkSettings.qsid_deserialize(qsid, data[1:])
-
     def set_key(self, layer, row, col, code):
         key = (layer, row, col)
+        self.wait_keymap([layer])
         if self.layout[key] != code:
             if code == RESET_KEYCODE:
                 Unlocker.unlock(self)
@@ -320,8 +724,83 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
                                                 Keycode.deserialize(code)), retries=20)
             self.layout[key] = code
 
+    def plan_keymap_writes(self, changes):
+        """
+        Works out the packets needed to apply `changes`, a dict of (layer, row, col) -> keycode, to the keymap.
+        Keys which already hold the requested keycode are skipped. Changed keys which are close together
+        are written with one set-buffer packet (along with the unchanged keys between them) when the firmware
+        supports it, everything else is written one key per packet.
+
+        Returns a list of (packet, [(key, code)]) pairs in the order they should be sent.
+        """
+
+        # changes are diffed against what the keyboard holds, which has to be known first
+        self.wait_keymap({layer for layer, row, col in changes})
+
+        pending = dict()
+        for key, code in changes.items():
+            idx = self.layout.index(key)
+            raw = Keycode.deserialize(code)
+            if self.keymap.codes[idx] != raw:
+                pending[idx] = (key, code, raw)
+
+        span = BUFFER_FETCH_CHUNK // 2 if self.via_protocol >= VIA_PROTOCOL_KEYMAP_SET_BUFFER else 1
+        order = sorted(pending)
+        runs = []
+        pos = 0
+        while pos < len(order):
+            end = pos + 1
+            while end < len(order) and order[end] < order[pos] + span:
+                end += 1
+            runs.append((pos, end))
+            pos = end
+
+        # a run also writes back the unchanged keys between its changes, which may reach into a layer without
+        # changes of its own; that layer has to be loaded too, or its placeholder zeros would be written
+        plane = self.keymap.plane
+        self.wait_keymap({layer for pos, end in runs
+                          for layer in range(order[pos] // plane, order[end - 1] // plane + 1)})
+
+        packets = []
+        for pos, end in runs:
+            start = order[pos]
+            batch = [pending[idx] for idx in order[pos:end]]
+            if len(batch) == 1:
+                (layer, row, col), code, raw = batch[0]
+                msg = struct.pack(">BBBBH", CMD_VIA_SET_KEYCODE, layer, row, col, raw)
+            else:
+                codes = self.keymap.codes[start:order[end - 1] + 1]
+                for idx in order[pos:end]:
+                    codes[idx - start] = pending[idx][2]
+                msg = struct.pack(">BHB", CMD_VIA_KEYMAP_SET_BUFFER, start * 2, len(codes) * 2) \
+                    + encode_keymap_buffer(codes)
+            packets.append((msg, [(key, code) for key, code, raw in batch]))
+        return packets
+
+    def set_keys(self, changes, progress=None):
+        """
+        Writes many keys at once, see plan_keymap_writes. `progress` is called as progress(sent, total)
+        before the first packet and after every packet. Returns the number of packets sent.
+        """
+
+        packets = self.plan_keymap_writes(changes)
+        if progress is not None:
+            progress(0, len(packets))
+
+        if any(code == RESET_KEYCODE for msg, batch in packets for key, code in batch):
+            Unlocker.unlock(self)
+
+        for x, (msg, batch) in enumerate(packets):
+            self.usb_send(self.dev, msg, retries=20)
+            for key, code in batch:
+                self.layout[key] = code
+            if progress is not None:
+                progress(x + 1, len(packets))
+        return len(packets)
+
     def set_encoder(self, layer, index, direction, code):
         key = (layer, index, direction)
+        self.wait_keymap([layer])
         if self.encoder_layout[key] != code:
             if code == RESET_KEYCODE:
                 Unlocker.unlock(self)
@@ -369,31 +848,12 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
     def save_layout(self):
         """ Serializes current layout to a binary """
 
+        self.wait_keymap()
+
         data = {"version": 1, "uid": self.keyboard_id}
 
-        layout = []
-        for l in range(self.layers):
-            layer = []
-            layout.append(layer)
-            for r in range(self.rows):
-                row = []
-                layer.append(row)
-                for c in range(self.cols):
-                    val = self.layout.get((l, r, c), -1)
-                    row.append(val)
-
-        encoder_layout = []
-        for l in range(self.layers):
-            layer = []
-            for e in range(self.encoder_count):
-                cw = (l, e, 0)
-                ccw = (l, e, 1)
-                layer.append([self.encoder_layout.get(cw, -1),
-                              self.encoder_layout.get(ccw, -1)])
-            encoder_layout.append(layer)
-
-        data["layout"] = layout
-        data["encoder_layout"] = encoder_layout
+        data["layout"] = self.layout.save()
+        data["encoder_layout"] = self.encoder_layout.save()
         data["layout_options"] = self.layout_options
         data["macro"] = self.save_macro()
         data["vial_protocol"] = self.vial_protocol
@@ -406,23 +866,28 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
 
         return json.dumps(data).encode("utf-8")
 
-    def restore_layout(self, data):
-        """ Restores saved layout """
+    def restore_layout(self, data, progress=None):
+        """ Restores saved layout, `progress` reports how far along writing the keymap is """
+
+        self.wait_keymap()
 
         data = json.loads(data.decode("utf-8"))
 
         # restore keymap
+        changes = dict()
         for l, layer in enumerate(data["layout"]):
             for r, row in enumerate(layer):
                 for c, code in enumerate(row):
                     if (l, r, c) in self.layout:
-                        self.set_key(l, r, c, Keycode.serialize(Keycode.deserialize(code)))
+                        changes[(l, r, c)] = Keycode.serialize(Keycode.deserialize(code))
+        self.set_keys(changes, progress)
 
         # restore encoders
         for l, layer in enumerate(data["encoder_layout"]):
             for e, encoder in enumerate(layer):
-                self.set_encoder(l, e, 0, Keycode.serialize(Keycode.deserialize(encoder[0])))
-                self.set_encoder(l, e, 1, Keycode.serialize(Keycode.deserialize(encoder[1])))
+                for direction in (0, 1):
+                    if (l, e, direction) in self.encoder_layout:
+                        self.set_encoder(l, e, direction, Keycode.serialize(Keycode.deserialize(encoder[direction])))
 
         self.set_layout_options(data["layout_options"])
         self.restore_macros(data.get("macro"))
@@ -432,12 +897,14 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
         self.restore_key_override(data.get("key_override", []))
         self.restore_alt_repeat_key(data.get("alt_repeat_key", []))
 
-        for qsid, value in data.get("settings", dict()).items():
-            from editor.qmk_settings import QmkSettings
+        from editor.qmk_settings import QmkSettings
 
+        # only settings which differ from what the keyboard holds get written, all in one batch
+        for qsid, value in data.get("settings", dict()).items():
             qsid = int(qsid)
             if QmkSettings.is_qsid_supported(qsid):
-                self.qmk_settings_set(qsid, value)
+                self.qmk_settings_stage(qsid, value)
+        self.qmk_settings_flush()
 
     def reset(self):
         self.usb_send(self.dev, struct.pack("B", 0xB))
@@ -517,7 +984,31 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
                              retries=20)
         return data[0]
 
+    def qmk_settings_stage(self, qsid, value):
+        """ Queues a write for qmk_settings_flush; a value the keyboard already holds drops whatever was queued """
+        if self.settings.get(qsid) == value:
+            self.pending_settings.pop(qsid, None)
+        else:
+            self.pending_settings[qsid] = value
+
+    def qmk_settings_flush(self):
+        """ Writes all queued settings in one batch, returns the qsids which the keyboard refused """
+        from editor.qmk_settings import QmkSettings
+
+        pending, self.pending_settings = self.pending_settings, dict()
+        qsids = sorted(pending)
+        msgs = [struct.pack("<BBH", CMD_VIA_VIAL_PREFIX, CMD_VIAL_QMK_SETTINGS_SET, qsid)
+                + QmkSettings.qsid_serialize(qsid, pending[qsid]) for qsid in qsids]
+        failed = []
+        for qsid, data in zip(qsids, self._usb_send_many(msgs)):
+            if data[0] == 0:
+                self.settings[qsid] = pending[qsid]
+            else:
+                failed.append(qsid)
+        return failed
+
     def qmk_settings_reset(self):
+        self.pending_settings = dict()
         self.usb_send(self.dev, struct.pack("BB", CMD_VIA_VIAL_PREFIX, CMD_VIAL_QMK_SETTINGS_RESET))
 
     def _vialrgb_set_mode(self):
@@ -8,7 +8,7 @@ from protocol.base_protocol import BaseProtocol
 from protocol.constants import CMD_VIA_MACRO_GET_COUNT, CMD_VIA_MACRO_GET_BUFFER_SIZE, CMD_VIA_MACRO_GET_BUFFER, \
     CMD_VIA_MACRO_SET_BUFFER, BUFFER_FETCH_CHUNK, VIAL_PROTOCOL_ADVANCED_MACROS
 from unlocker import Unlocker
-from util import chunks
+from util import chunks, PIPELINE_WINDOW
 
 
 def macro_deserialize_v1(data):
@@ -149,10 +149,14 @@ class ProtocolMacro(BaseProtocol):
         self.macro = b""
         if self.macro_memory:
             # now retrieve the entire buffer, MACRO_CHUNK bytes at a time, as that is what fits into a packet
-            for x in range(0, self.macro_memory, BUFFER_FETCH_CHUNK):
-                sz = min(BUFFER_FETCH_CHUNK, self.macro_memory - x)
-                data = self.usb_send(self.dev, struct.pack(">BHB", CMD_VIA_MACRO_GET_BUFFER, x, sz), retries=20)
-                self.macro += data[4:4 + sz]
+            # when the transport can pipeline, fetch a window of chunks at once and check for the end afterwards
+            batch = PIPELINE_WINDOW if self.usb_send_many is not None else 1
+            offsets = range(0, self.macro_memory, BUFFER_FETCH_CHUNK)
+            for b in range(0, len(offsets), batch):
+                msgs = [struct.pack(">BHB", CMD_VIA_MACRO_GET_BUFFER, x, min(BUFFER_FETCH_CHUNK, self.macro_memory - x))
+                        for x in offsets[b:b + batch]]
+                for msg, data in zip(msgs, self._usb_send_many(msgs, echo=4)):
+                    self.macro += data[4:4 + msg[3]]
                 if self.macro.count(b"\x00") > self.macro_count:
                     break
             # macros are stored as NUL-separated strings, so let's clean up the buffer
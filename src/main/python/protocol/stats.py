@@ -0,0 +1,164 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import logging
+import threading
+import time
+
+from protocol import constants
+from protocol.constants import CMD_VIA_VIAL_PREFIX, CMD_VIAL_DYNAMIC_ENTRY_OP
+
+# upper bounds (ms) of the latency histogram buckets, anything slower lands in the last, open-ended one
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# how often transport statistics are written to vial.log while there is traffic
+DUMP_INTERVAL = 60
+
+
+def _names(prefix):
+    return {getattr(constants, name): name for name in dir(constants) if name.startswith(prefix)}
+
+
+VIA_NAMES = _names("CMD_VIA_")
+VIAL_NAMES = _names("CMD_VIAL_")
+DYNAMIC_NAMES = _names("DYNAMIC_VIAL_")
+
+
+def command_key(msg):
+    """ Identifies the command of a request: (command,), (0xFE, vial command) or (0xFE, 0x0D, dynamic op) """
+    if msg[0] == CMD_VIA_VIAL_PREFIX and len(msg) > 1:
+        if msg[1] == CMD_VIAL_DYNAMIC_ENTRY_OP and len(msg) > 2:
+            return msg[0], msg[1], msg[2]
+        return msg[0], msg[1]
+    return msg[0],
+
+
+def command_name(key):
+    if len(key) == 3:
+        return DYNAMIC_NAMES.get(key[2], "DYNAMIC_VIAL_0x{:02X}".format(key[2]))
+    if len(key) == 2:
+        return VIAL_NAMES.get(key[1], "CMD_VIAL_0x{:02X}".format(key[1]))
+    return VIA_NAMES.get(key[0], "CMD_VIA_0x{:02X}".format(key[0]))
+
+
+class CommandStats:
+    """ Counters and latency histogram of one command """
+
+    def __init__(self):
+        self.packets = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.total_ms = 0
+        self.max_ms = 0
+        self.histogram = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def record(self, sent, received, latency_ms, retries, timeouts, failed):
+        self.packets += 1
+        self.bytes_out += sent
+        self.bytes_in += received
+        self.retries += retries
+        self.timeouts += timeouts
+        if failed:
+            self.failures += 1
+            return
+        self.total_ms += latency_ms
+        self.max_ms = max(self.max_ms, latency_ms)
+        bucket = 0
+        while bucket < len(LATENCY_BUCKETS_MS) and latency_ms > LATENCY_BUCKETS_MS[bucket]:
+            bucket += 1
+        self.histogram[bucket] += 1
+
+    def percentile_ms(self, pct):
+        """ Upper bound of the bucket the percentile falls into, None for the open-ended bucket """
+        total = sum(self.histogram)
+        if total == 0:
+            return 0
+        target = total * pct / 100
+        seen = 0
+        for bucket, count in enumerate(self.histogram):
+            seen += count
+            if seen >= target:
+                break
+        if bucket < len(LATENCY_BUCKETS_MS):
+            return LATENCY_BUCKETS_MS[bucket]
+        return None
+
+    def to_dict(self):
+        answered = self.packets - self.failures
+        return {
+            "packets": self.packets,
+            "bytes_out": self.bytes_out,
+            "bytes_in": self.bytes_in,
+            "retries": self.retries,
+            "timeouts": self.timeouts,
+            "failures": self.failures,
+            "mean_ms": self.total_ms / answered if answered else 0,
+            "max_ms": self.max_ms,
+            "histogram": list(self.histogram),
+        }
+
+
+class TransportStats:
+    """
+    Per command statistics of everything sent to devices. Commands are keyed by their command byte, Vial
+    commands additionally by their sub-command and dynamic entry operations by their op, so the cost of a
+    reload can be broken down into keymap transfer, settings queries, lighting and so on.
+    """
+
+    def __init__(self, dump_interval=DUMP_INTERVAL):
+        self.mutex = threading.Lock()
+        self.commands = dict()
+        self.dump_interval = dump_interval
+        self.last_dump = time.monotonic()
+        self.dirty = False
+
+    def record(self, msg, received, latency_ms, retries=0, timeouts=0, failed=False):
+        """ Records one request: `received` bytes of response after `latency_ms`, or a failure """
+        key = command_key(msg)
+        with self.mutex:
+            if key not in self.commands:
+                self.commands[key] = CommandStats()
+            self.commands[key].record(len(msg), received, latency_ms, retries, timeouts, failed)
+            self.dirty = True
+            dump = self.dump_interval and time.monotonic() - self.last_dump >= self.dump_interval
+            if dump:
+                self.last_dump = time.monotonic()
+        if dump:
+            self.dump()
+
+    def snapshot(self):
+        """ Returns {command name: counters} """
+        with self.mutex:
+            return {command_name(key): self.commands[key].to_dict() for key in sorted(self.commands)}
+
+    def reset(self):
+        with self.mutex:
+            self.commands = dict()
+            self.dirty = False
+
+    def format(self):
+        lines = ["{:<36} {:>7} {:>9} {:>7} {:>8} {:>6} {:>8} {:>7} {:>7}".format(
+            "command", "packets", "bytes", "retries", "timeouts", "failed", "mean ms", "p99 ms", "max ms")]
+        with self.mutex:
+            for key in sorted(self.commands):
+                stats = self.commands[key]
+                data = stats.to_dict()
+                p99 = stats.percentile_ms(99)
+                lines.append("{:<36} {:>7} {:>9} {:>7} {:>8} {:>6} {:>8.1f} {:>7} {:>7.1f}".format(
+                    command_name(key), data["packets"], data["bytes_out"] + data["bytes_in"], data["retries"],
+                    data["timeouts"], data["failures"], data["mean_ms"],
+                    ">{}".format(LATENCY_BUCKETS_MS[-1]) if p99 is None else "<={}".format(p99), data["max_ms"]))
+        return "\n".join(lines)
+
+    def dump(self):
+        """ Writes the statistics to the log if anything was sent since the last dump """
+        with self.mutex:
+            if not self.dirty:
+                return
+            self.dirty = False
+        logging.info("transport statistics:\n%s", self.format())
+
+
+# statistics of all devices this process talks to
+STATS = TransportStats()
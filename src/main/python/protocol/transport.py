@@ -0,0 +1,229 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import errno
+import random
+import time
+from collections import deque
+
+from protocol.constants import CMD_VIA_VIAL_PREFIX, CMD_VIA_GET_KEYBOARD_VALUE, VIA_SWITCH_MATRIX_STATE, \
+    CMD_VIA_KEYMAP_GET_BUFFER, CMD_VIA_MACRO_GET_BUFFER, CMD_VIAL_GET_DEFINITION, CMD_VIAL_GET_ENCODER, \
+    CMD_VIAL_GET_UNLOCK_STATUS, CMD_VIAL_UNLOCK_POLL, CMD_VIAL_QMK_SETTINGS_QUERY, CMD_VIAL_QMK_SETTINGS_GET, \
+    CMD_VIAL_DYNAMIC_ENTRY_OP, DYNAMIC_VIAL_GET_NUMBER_OF_ENTRIES, DYNAMIC_VIAL_TAP_DANCE_GET, DYNAMIC_VIAL_COMBO_GET, \
+    DYNAMIC_VIAL_KEY_OVERRIDE_GET, DYNAMIC_VIAL_ALT_REPEAT_KEY_GET, CMD_VIA_SET_KEYCODE, CMD_VIA_KEYMAP_SET_BUFFER, \
+    CMD_VIA_MACRO_SET_BUFFER, CMD_VIA_SET_KEYBOARD_VALUE, CMD_VIA_LIGHTING_SAVE, CMD_VIAL_SET_ENCODER, \
+    CMD_VIAL_QMK_SETTINGS_SET, CMD_VIAL_QMK_SETTINGS_RESET, DYNAMIC_VIAL_TAP_DANCE_SET, DYNAMIC_VIAL_COMBO_SET, \
+    DYNAMIC_VIAL_KEY_OVERRIDE_SET, DYNAMIC_VIAL_ALT_REPEAT_KEY_SET, CMD_VIA_GET_KEYCODE, CMD_VIA_LIGHTING_GET_VALUE, \
+    CMD_VIA_LIGHTING_SET_VALUE
+from protocol.stats import STATS
+from util import MSG_LEN, hid_send_many
+
+COMMAND_INTERACTIVE = "interactive"
+COMMAND_BULK = "bulk"
+COMMAND_POLLING = "polling"
+COMMAND_WRITE = "write"
+
+VIAL_BULK_COMMANDS = {CMD_VIAL_GET_DEFINITION, CMD_VIAL_GET_ENCODER, CMD_VIAL_QMK_SETTINGS_QUERY,
+                      CMD_VIAL_QMK_SETTINGS_GET}
+VIAL_POLLING_COMMANDS = {CMD_VIAL_GET_UNLOCK_STATUS, CMD_VIAL_UNLOCK_POLL}
+DYNAMIC_BULK_COMMANDS = {DYNAMIC_VIAL_GET_NUMBER_OF_ENTRIES, DYNAMIC_VIAL_TAP_DANCE_GET, DYNAMIC_VIAL_COMBO_GET,
+                         DYNAMIC_VIAL_KEY_OVERRIDE_GET, DYNAMIC_VIAL_ALT_REPEAT_KEY_GET}
+# commands which end up in EEPROM and so can take far longer than a read
+VIA_WRITE_COMMANDS = {CMD_VIA_SET_KEYCODE, CMD_VIA_KEYMAP_SET_BUFFER, CMD_VIA_MACRO_SET_BUFFER,
+                      CMD_VIA_SET_KEYBOARD_VALUE, CMD_VIA_LIGHTING_SAVE}
+VIAL_WRITE_COMMANDS = {CMD_VIAL_SET_ENCODER, CMD_VIAL_QMK_SETTINGS_SET, CMD_VIAL_QMK_SETTINGS_RESET}
+DYNAMIC_WRITE_COMMANDS = {DYNAMIC_VIAL_TAP_DANCE_SET, DYNAMIC_VIAL_COMBO_SET, DYNAMIC_VIAL_KEY_OVERRIDE_SET,
+                          DYNAMIC_VIAL_ALT_REPEAT_KEY_SET}
+
+# how many leading bytes of a VIA request the firmware copies into its response; Vial commands overwrite
+# the whole buffer with their response so nothing can be matched for those
+VIA_ECHO = {CMD_VIA_GET_KEYCODE: 4, CMD_VIA_SET_KEYCODE: 6, CMD_VIA_KEYMAP_GET_BUFFER: 4,
+            CMD_VIA_KEYMAP_SET_BUFFER: 4, CMD_VIA_MACRO_GET_BUFFER: 4, CMD_VIA_MACRO_SET_BUFFER: 4,
+            CMD_VIA_GET_KEYBOARD_VALUE: 2, CMD_VIA_SET_KEYBOARD_VALUE: 2, CMD_VIA_LIGHTING_GET_VALUE: 2,
+            CMD_VIA_LIGHTING_SET_VALUE: 2}
+# what the firmware puts in place of the command id of a request it doesn't know
+VIA_UNHANDLED = 0xFF
+
+# a device which fails this many I/O calls in a row is considered gone
+DISCONNECT_ERRORS = 2
+
+
+class DeviceDisconnected(RuntimeError):
+    pass
+
+
+class CommandPolicy:
+    """ Retry and timeout settings for one class of commands """
+
+    def __init__(self, attempts, min_timeout_ms, max_timeout_ms, backoff_ms, max_backoff_ms):
+        self.attempts = attempts
+        self.min_timeout_ms = min_timeout_ms
+        self.max_timeout_ms = max_timeout_ms
+        self.backoff_ms = backoff_ms
+        self.max_backoff_ms = max_backoff_ms
+
+
+def default_policies():
+    return {
+        # user is waiting on these, retry quickly a few times
+        COMMAND_INTERACTIVE: CommandPolicy(5, 50, 500, 10, 200),
+        # reloads can afford to be patient
+        COMMAND_BULK: CommandPolicy(20, 100, 1000, 20, 500),
+        # a missed poll is replaced by the next one soon enough
+        COMMAND_POLLING: CommandPolicy(2, 30, 250, 5, 50),
+        # a flash write which times out gets written twice, so never give up on one early
+        COMMAND_WRITE: CommandPolicy(5, 500, 2000, 20, 500),
+    }
+
+
+def classify(msg):
+    """ Works out which class of commands a request belongs to """
+
+    if msg[0] == CMD_VIA_GET_KEYBOARD_VALUE and len(msg) > 1 and msg[1] == VIA_SWITCH_MATRIX_STATE:
+        return COMMAND_POLLING
+    if msg[0] in (CMD_VIA_KEYMAP_GET_BUFFER, CMD_VIA_MACRO_GET_BUFFER):
+        return COMMAND_BULK
+    if msg[0] in VIA_WRITE_COMMANDS:
+        return COMMAND_WRITE
+    if msg[0] == CMD_VIA_VIAL_PREFIX and len(msg) > 1:
+        if msg[1] in VIAL_POLLING_COMMANDS:
+            return COMMAND_POLLING
+        if msg[1] in VIAL_BULK_COMMANDS:
+            return COMMAND_BULK
+        if msg[1] in VIAL_WRITE_COMMANDS:
+            return COMMAND_WRITE
+        if msg[1] == CMD_VIAL_DYNAMIC_ENTRY_OP and len(msg) > 2:
+            if msg[2] in DYNAMIC_BULK_COMMANDS:
+                return COMMAND_BULK
+            if msg[2] in DYNAMIC_WRITE_COMMANDS:
+                return COMMAND_WRITE
+    return COMMAND_INTERACTIVE
+
+
+def matches(msg, data):
+    """ Whether data can be the response to msg, as far as the bytes the firmware echoes back tell """
+
+    if msg[0] == CMD_VIA_VIAL_PREFIX:
+        return True
+    echo = VIA_ECHO.get(msg[0], 1)
+    return data[1:echo] == msg[1:echo] and data[0] in (msg[0], VIA_UNHANDLED)
+
+
+class TransportPolicy:
+    """
+    Sends requests to one device, tracking round-trip latency per class of commands and deriving
+    read timeouts from it. Retries back off exponentially with jitter, and a device which keeps
+    failing at the OS level is reported through DeviceDisconnected rather than retried.
+
+    send() and send_many() are drop-in replacements for hid_send and hid_send_many.
+    """
+
+    # how many round trips per command class the latency estimate is based on
+    SAMPLES = 256
+    # timeouts are only adapted once there are enough samples to trust
+    MIN_SAMPLES = 16
+    # how far above the p99 latency a response is still waited for
+    TIMEOUT_FACTOR = 4
+
+    def __init__(self, policies=None):
+        self.policies = default_policies()
+        if policies is not None:
+            self.policies.update(policies)
+        self.latency = {name: deque(maxlen=self.SAMPLES) for name in self.policies}
+        self.p99 = dict()
+        self.errors = 0
+
+    def p99_ms(self, name):
+        samples = self.latency[name]
+        if len(samples) < self.MIN_SAMPLES:
+            return None
+        if name not in self.p99:
+            ordered = sorted(samples)
+            self.p99[name] = ordered[min(len(ordered) - 1, len(ordered) * 99 // 100)]
+        return self.p99[name]
+
+    def timeout_ms(self, name):
+        policy = self.policies[name]
+        p99 = self.p99_ms(name)
+        if p99 is None:
+            return policy.max_timeout_ms
+        return int(min(policy.max_timeout_ms, max(policy.min_timeout_ms, p99 * self.TIMEOUT_FACTOR)))
+
+    def backoff(self, name, attempt):
+        """ Seconds to wait before retry number `attempt` (starting at 1) """
+        policy = self.policies[name]
+        delay = min(policy.max_backoff_ms, policy.backoff_ms * (2 ** (attempt - 1)))
+        return random.uniform(delay / 2, delay) / 1000
+
+    def record(self, name, elapsed_ms):
+        self.latency[name].append(elapsed_ms)
+        self.p99.pop(name, None)
+
+    def io_error(self, e):
+        self.errors += 1
+        if getattr(e, "errno", None) == errno.ENODEV or self.errors >= DISCONNECT_ERRORS:
+            raise DeviceDisconnected("device disconnected: {}".format(e)) from e
+
+    def send(self, dev, msg, retries=1):
+        """ Sends one request; `retries` from the caller is capped by the command class' attempts """
+
+        if len(msg) > MSG_LEN:
+            raise RuntimeError("message must be less than 32 bytes")
+        msg += b"\x00" * (MSG_LEN - len(msg))
+
+        name = classify(msg)
+        attempts = max(1, min(retries, self.policies[name].attempts))
+        timeouts = 0
+        start = time.monotonic()
+        for attempt in range(attempts):
+            if attempt > 0:
+                time.sleep(self.backoff(name, attempt))
+            try:
+                start = time.monotonic()
+                # add 00 at start for hidapi report id
+                if dev.write(b"\x00" + msg) != MSG_LEN + 1:
+                    continue
+                data = self.read(dev, msg, start + self.timeout_ms(name) / 1000)
+                self.errors = 0
+                if not data:
+                    timeouts += 1
+                    # a late response to this request must not be taken for the response to the next one
+                    while dev.read(MSG_LEN, timeout_ms=0):
+                        pass
+                    continue
+            except OSError as e:
+                self.io_error(e)
+                continue
+            elapsed = (time.monotonic() - start) * 1000
+            self.record(name, elapsed)
+            STATS.record(msg, len(data), elapsed, retries=attempt, timeouts=timeouts)
+            return data
+
+        STATS.record(msg, 0, (time.monotonic() - start) * 1000, retries=attempts - 1, timeouts=timeouts, failed=True)
+        raise RuntimeError("failed to communicate with the device")
+
+    @staticmethod
+    def read(dev, msg, deadline):
+        """
+        Reads until the response to msg arrives or the deadline passes. Responses which can't belong to msg
+        are late ones to earlier requests which timed out, those are skipped rather than taken for this one
+        """
+
+        while True:
+            remaining = max(0, int((deadline - time.monotonic()) * 1000))
+            data = bytes(dev.read(MSG_LEN, timeout_ms=remaining))
+            if not data or matches(msg, data):
+                return data
+            if remaining == 0:
+                return b""
+
+    def send_many(self, dev, msgs, echo=0, retries=1):
+        """ Pipelines a batch, waiting on each response as long as the slowest command class in it allows """
+
+        names = {classify(msg) for msg in msgs}
+        timeout = max((self.timeout_ms(name) for name in names), default=0)
+
+        def on_response(msg, elapsed_ms):
+            self.errors = 0
+            self.record(classify(msg), elapsed_ms)
+
+        return hid_send_many(dev, msgs, echo=echo, retries=retries, send=self.send, timeout_ms=timeout,
+                             on_response=on_response, on_error=self.io_error)
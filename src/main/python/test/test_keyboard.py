@@ -1,10 +1,30 @@
+import json
 import unittest
+import asyncio
 import lzma
 import struct
+import tempfile
+import threading
+from array import array
+from unittest import mock
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from keycodes.keycodes import Keycode
-from protocol.keyboard_comm import Keyboard
-from util import chunks, MSG_LEN
+from protocol.async_keyboard import AsyncKeyboard
+from protocol.capability_cache import CapabilityCache
+from protocol.capture import RecordingTransport, ReplayTransport, ReplayMismatch, read_capture
+from protocol.definition_cache import DefinitionCache
+from protocol.emulator import VialEmulator, SocketDevice, EmulatedDevice
+from protocol.io_worker import DeviceWorker, PRIORITY_BULK, PRIORITY_POLLING
+from protocol.keyboard_comm import Keyboard, RELOAD_STAGES, STAGE_LAYOUT, STAGE_KEYMAP, STAGE_LIGHTING
+from protocol.stats import STATS
+from protocol.transport import TransportPolicy, DeviceDisconnected, classify, COMMAND_BULK, COMMAND_POLLING, \
+    COMMAND_INTERACTIVE, COMMAND_WRITE, DISCONNECT_ERRORS
+from util import chunks, MSG_LEN, PIPELINE_WINDOW, hid_send_many
 
 LAYOUT_2x2 = """
 {"name":"test","vendorId":"0x0000","productId":"0x1111","lighting":"none","matrix":{"rows":2,"cols":2},"layouts":{"keymap":[["0,0","0,1"],["1,0","1,1"]]}}
@@ -41,10 +61,13 @@ class SimulatedDevice:
     def expect_keyboard_id(self, kbid):
         self.expect("FE00", struct.pack("<IQ", 0, kbid))
 
-    def expect_layout(self, layout):
+    def expect_layout(self, layout, cached=False):
         compressed = lzma.compress(layout.encode("utf-8"))
         self.expect("FE01", struct.pack("<I", len(compressed)))
         for idx, chunk in enumerate(chunks(compressed, 32)):
+            # a cached definition is validated using only the first block
+            if cached and idx > 0:
+                break
             self.expect(
                 struct.pack("<BBI", 0xFE, 0x02, idx),
                 chunk
@@ -53,21 +76,29 @@ class SimulatedDevice:
     def expect_layers(self, layers):
         self.expect("11", struct.pack("BB", 0x11, layers))
 
-    def expect_keymap(self, keymap):
+    def expect_keymap(self, keymap, encoders=None):
+        # the first layer is retrieved on its own, then the rest of them
+        self.expect_keymap_layers(keymap, 0, 1, encoders)
+        self.expect_keymap_layers(keymap, 1, len(keymap) - 1, encoders)
+
+    def expect_keymap_layers(self, keymap, first, count, encoders=None):
         buffer = b""
-        for layer in keymap:
+        for layer in keymap[first:first + count]:
             for row in layer:
                 for col in row:
                     buffer += struct.pack(">H", col)
         # client will retrieve our keymap buffer in chunks of 28 bytes
+        start = first * len(buffer) // max(count, 1)
         for x, chunk in enumerate(chunks(buffer, 28)):
-            query = struct.pack(">BHB", 0x12, x, len(chunk))
+            query = struct.pack(">BHB", 0x12, start + x * 28, len(chunk))
             self.expect(query, query + chunk)
+        if encoders is not None:
+            self.expect_encoders(encoders[first:first + count], first)
 
-    def expect_encoders(self, encoders):
+    def expect_encoders(self, encoders, first=0):
         for l, layer in enumerate(encoders):
             for e, enc in enumerate(layer):
-                self.expect(struct.pack("BBBB", 0xFE, 3, l, e), struct.pack(">HH", enc[0], enc[1]))
+                self.expect(struct.pack("BBBB", 0xFE, 3, first + l, e), struct.pack(">HH", enc[0], enc[1]))
 
     @staticmethod
     def sim_send(dev, data, retries=1):
@@ -95,14 +126,91 @@ class SimulatedDevice:
             ))
 
 
+class PipelinedDevice:
+    """ Mimics a hidapi device which answers every request with its own header followed by a counter """
+
+    def __init__(self, drop=None):
+        self.responses = []
+        self.requests = 0
+        self.in_flight = self.max_in_flight = 0
+        # index of a request whose response gets lost
+        self.drop = drop
+        self.unplugged = False
+        self.read_timeouts = set()
+
+    def write(self, data):
+        req = data[1:]
+        if self.requests != self.drop:
+            self.responses.append(req[:4] + struct.pack("B", self.requests) + b"\x00" * (MSG_LEN - 5))
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        return len(data)
+
+    def read(self, length, timeout_ms=0):
+        if self.unplugged:
+            raise OSError("read error")
+        self.read_timeouts.add(timeout_ms)
+        if not self.responses:
+            return b""
+        self.in_flight -= 1
+        return self.responses.pop(0)
+
+
+class FlakyDevice:
+    """ Mimics a hidapi device which echoes requests, drops some responses and can be unplugged """
+
+    def __init__(self, drop=0):
+        self.drop = drop
+        self.unplugged = False
+        self.writes = 0
+        self.response = None
+
+    def write(self, data):
+        if self.unplugged:
+            raise OSError("write error")
+        self.writes += 1
+        if self.drop > 0:
+            self.drop -= 1
+        else:
+            self.response = data[1:]
+        return len(data)
+
+    def read(self, length, timeout_ms=0):
+        if self.unplugged:
+            raise OSError("read error")
+        data, self.response = self.response, None
+        return data or b""
+
+
+class LateDevice:
+    """ Mimics a hidapi device whose responses only arrive after the given number of reads came back empty """
+
+    def __init__(self, delays=()):
+        self.delays = list(delays)
+        self.pending = []
+
+    def write(self, data):
+        self.pending.append([self.delays.pop(0) if self.delays else 0, data[1:]])
+        return len(data)
+
+    def read(self, length, timeout_ms=0):
+        if not self.pending:
+            return b""
+        if self.pending[0][0] > 0:
+            self.pending[0][0] -= 1
+            return b""
+        return self.pending.pop(0)[1]
+
+
 class TestKeyboard(unittest.TestCase):
 
     @staticmethod
-    def prepare_keyboard(layout, keymap, encoders=None):
+    def prepare_keyboard(layout, keymap, encoders=None, definition_cache=None, cached=False):
         dev = SimulatedDevice()
         dev.expect_via_protocol(9)
         dev.expect_keyboard_id(0)
-        dev.expect_layout(layout)
+        dev.expect_layout(layout, cached)
         dev.expect_layers(len(keymap))
 
         # macro count
@@ -110,11 +218,9 @@ class TestKeyboard(unittest.TestCase):
         # macro buffer size
         dev.expect("0D", "0D0000")
 
-        dev.expect_keymap(keymap)
-        if encoders is not None:
-            dev.expect_encoders(encoders)
+        dev.expect_keymap(keymap, encoders)
 
-        kb = Keyboard(dev, dev.sim_send)
+        kb = Keyboard(dev, dev.sim_send, definition_cache=definition_cache)
         kb.reload()
 
         return kb, dev
@@ -134,6 +240,77 @@ class TestKeyboard(unittest.TestCase):
         self.assertEqual(kb.layout[(1, 1, 1)], s(8))
         dev.finish()
 
+    def test_keymap_multiple_chunks(self):
+        """ Tests that a keymap spanning several buffer chunks is reassembled at the right offsets """
+
+        keymap = [[[layer * 4 + 1, 0x7E00 + layer], [0x5100 + layer, layer * 4 + 4]] for layer in range(8)]
+        kb, dev = self.prepare_keyboard(LAYOUT_2x2, keymap)
+        self.assertEqual(len(kb.keymap.codes), 8 * 2 * 2)
+        for layer in range(8):
+            self.assertEqual(kb.layout[(layer, 0, 1)], s(0x7E00 + layer))
+            self.assertEqual(kb.layout[(layer, 1, 0)], s(0x5100 + layer))
+        self.assertEqual(json.loads(kb.save_layout())["layout"][7][1], [s(0x5107), s(32)])
+        dev.finish()
+
+    def test_keymap_store(self):
+        """ Tests that cells missing from the layout are not part of the keymap """
+
+        layout = LAYOUT_2x2.replace('["1,0","1,1"]', '["1,1"]')
+        kb, dev = self.prepare_keyboard(layout, [[[1, 2], [3, 4]], [[5, 6], [7, 8]]])
+        self.assertNotIn((0, 1, 0), kb.layout)
+        self.assertIn((1, 1, 1), kb.layout)
+        self.assertNotIn((2, 0, 0), kb.layout)
+        self.assertEqual(len(kb.layout), 6)
+        self.assertEqual(list(kb.layout.keys())[:3], [(0, 0, 0), (0, 0, 1), (0, 1, 1)])
+        self.assertEqual(kb.layout.get((1, 1, 0), -1), -1)
+        self.assertEqual(kb.layout.raw((1, 1, 1)), 8)
+        self.assertEqual(json.loads(kb.save_layout())["layout"][1], [[s(5), s(6)], [-1, s(8)]])
+        dev.finish()
+
+        # keys come in the order of the layout, keys outside of it are kept like a dict would
+        layout = LAYOUT_2x2.replace('["0,0","0,1"],["1,0","1,1"]', '["1,1","0,0"],["0,1","1,0"]')
+        kb, dev = self.prepare_keyboard(layout, [[[1, 2], [3, 4]]])
+        self.assertEqual(list(kb.layout.keys()), [(0, 1, 1), (0, 0, 0), (0, 0, 1), (0, 1, 0)])
+        kb.layout[(3, 5, 5)] = s(9)
+        self.assertEqual(kb.layout[(3, 5, 5)], s(9))
+        self.assertEqual(list(kb.layout)[-1], (3, 5, 5))
+        self.assertEqual(len(kb.layout), 5)
+        dev.finish()
+
+        # a cached string never outlives the keycode it was made from, e.g. when a layer arrives in the background
+        self.assertEqual(kb.layout[(0, 0, 0)], s(1))
+        kb.keymap.load_matrix(struct.pack(">HHHH", 10, 11, 12, 13))
+        self.assertEqual(kb.layout[(0, 0, 0)], s(10))
+
+    def test_reload_stages(self):
+        """ Tests that the first layer is available as soon as the layout stage completes """
+
+        keymap = [[[1, 2], [3, 4]], [[5, 6], [7, 8]]]
+        dev = SimulatedDevice()
+        dev.expect_via_protocol(9)
+        dev.expect_keyboard_id(0)
+        dev.expect_layout(LAYOUT_2x2)
+        dev.expect_layers(len(keymap))
+        dev.expect("0C", "0C00")
+        dev.expect("0D", "0D0000")
+        dev.expect_keymap(keymap)
+
+        stages = []
+
+        def on_stage(stage):
+            stages.append(stage)
+            if stage == STAGE_LAYOUT:
+                self.assertEqual(kb.layout[(0, 1, 1)], s(4))
+                self.assertEqual(kb.layout.raw((1, 1, 1)), 0)
+                self.assertNotIn(STAGE_KEYMAP, kb.loaded_stages)
+
+        kb = Keyboard(dev, dev.sim_send)
+        kb.reload(on_stage=on_stage)
+        self.assertEqual(stages, RELOAD_STAGES)
+        self.assertEqual(kb.loaded_stages, set(RELOAD_STAGES))
+        self.assertEqual(kb.layout[(1, 1, 1)], s(8))
+        dev.finish()
+
     def test_set_key(self):
         """ Tests that setting a key works """
 
@@ -171,6 +348,36 @@ class TestKeyboard(unittest.TestCase):
         self.assertEqual(kb.layout[(1, 1, 0)], Keycode.serialize(10))
         dev.finish()
 
+    def test_layout_restore_bulk(self):
+        """ Tests that restoring many changed keys uses set-buffer packets """
+
+        kb, dev = self.prepare_keyboard(LAYOUT_2x2, [[[1, 2], [3, 4]], [[5, 6], [7, 8]]])
+        for layer in range(2):
+            for row in range(2):
+                for col in range(2):
+                    kb.layout[(layer, row, col)] = s(0x20 + layer * 4 + row * 2 + col)
+        data = kb.save_layout()
+
+        kb, dev = self.prepare_keyboard(LAYOUT_2x2, [[[0x20, 2], [3, 0x23]], [[0x24, 0x25], [0x26, 0x27]]])
+        self.assertEqual(len(kb.plan_keymap_writes({(0, 0, 1): s(0x21), (0, 1, 0): s(0x22)})), 1)
+        # cells 1..2 of layer 0 and the whole layer 1 are unchanged, so nothing else needs to be written
+        dev.expect("1300020400210022", "")
+        progress = []
+        kb.restore_layout(data, progress=lambda sent, total: progress.append((sent, total)))
+        self.assertEqual(progress, [(0, 1), (1, 1)])
+        self.assertEqual(kb.layout[(0, 1, 0)], s(0x22))
+        dev.finish()
+
+    def test_layout_restore_per_key(self):
+        """ Tests that keys are written one by one when set-buffer isn't supported """
+
+        kb, dev = self.prepare_keyboard(LAYOUT_2x2, [[[1, 2], [3, 4]], [[5, 6], [7, 8]]])
+        kb.via_protocol = 8
+        dev.expect("050000010021", "")
+        dev.expect("050001000022", "")
+        self.assertEqual(kb.set_keys({(0, 0, 1): s(0x21), (0, 1, 0): s(0x22), (1, 1, 1): s(8)}), 2)
+        dev.finish()
+
     def test_encoder_simple(self):
         """ Tests that we try to retrieve encoder layout """
 
@@ -194,3 +401,893 @@ class TestKeyboard(unittest.TestCase):
         dev.expect("FE040100010020", "")
         kb.set_encoder(1, 0, 1, Keycode.serialize(0x20))
         self.assertEqual(kb.encoder_layout[(1, 0, 1)], Keycode.serialize(0x20))
+
+    def test_encoder_sparse(self):
+        """ Tests that encoder indices missing from the layout are saved as -1 and skipped on restore """
+
+        layout = LAYOUT_ENCODER.replace("0,0\\n\\n\\n\\n\\n\\n\\n\\n\\ne", "1,0\\n\\n\\n\\n\\n\\n\\n\\n\\ne") \
+            .replace("0,1\\n\\n\\n\\n\\n\\n\\n\\n\\ne", "1,1\\n\\n\\n\\n\\n\\n\\n\\n\\ne")
+        emulator = VialEmulator(layout, layers=2)
+        # the firmware has room for encoder 0 without it being in the layout
+        emulator.encoder_keymap[0:4] = array("H", [7, 8, 4, 5])
+        kb = Keyboard(emulator.device())
+        kb.reload()
+        self.assertNotIn((0, 0, 0), kb.encoder_layout)
+        self.assertEqual(kb.encoder_layout[(0, 1, 1)], s(5))
+
+        saved = kb.save_layout()
+        self.assertEqual(json.loads(saved)["encoder_layout"],
+                         [[[-1, -1], [s(4), s(5)]], [[-1, -1], ["KC_NO", "KC_NO"]]])
+        kb.restore_layout(saved)
+        self.assertEqual(list(emulator.encoder_keymap[:4]), [7, 8, 4, 5])
+
+    def test_definition_cache(self):
+        """ Tests that a cached definition is used instead of downloading it again """
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = DefinitionCache(tmp)
+            kb, dev = self.prepare_keyboard(LAYOUT_2x2, [[[1, 2], [3, 4]]], definition_cache=cache)
+            dev.finish()
+
+            kb, dev = self.prepare_keyboard(LAYOUT_2x2, [[[1, 2], [3, 4]]], definition_cache=cache, cached=True)
+            self.assertEqual(kb.rows, 2)
+            self.assertEqual(len(kb.keys), 4)
+            self.assertEqual(kb.layout[(0, 1, 1)], s(4))
+            dev.finish()
+
+            # a definition that changed on the device must not be served from the cache
+            kb, dev = self.prepare_keyboard(LAYOUT_ENCODER, [[[1]]], [[(10, 11)]], definition_cache=cache)
+            self.assertEqual(kb.encoder_count, 1)
+            dev.finish()
+
+    def test_definition_cache_example_uid(self):
+        """ Tests that definitions of keyboards still on an example UID are never cached """
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = DefinitionCache(tmp)
+            cache.store(0xD4A36200603E3007, 100, b"\x00" * 32, {"matrix": {}}, [])
+            self.assertIsNone(cache.load(0xD4A36200603E3007, 100, b"\x00" * 32))
+            cache.store(0x1234, 100, b"\x00" * 32, {"matrix": {}}, [])
+            self.assertEqual(cache.load(0x1234, 100, b"\x00" * 32), ({"matrix": {}}, []))
+
+    def test_definition_corrupt(self):
+        """ Tests that a corrupt definition is rejected without downloading the rest of it """
+
+        dev = SimulatedDevice()
+        dev.expect_via_protocol(9)
+        dev.expect_keyboard_id(0)
+        dev.expect("FE01", struct.pack("<I", 32 * 10))
+        dev.expect(struct.pack("<BBI", 0xFE, 0x02, 0), b"\xAA" * 32)
+        kb = Keyboard(dev, dev.sim_send)
+        with self.assertRaises(lzma.LZMAError):
+            kb.reload()
+        dev.finish()
+
+    def test_pipelined_send(self):
+        """ Tests that pipelined requests are matched to their responses """
+
+        dev = PipelinedDevice()
+        msgs = [struct.pack(">BHB", 0x12, x, 28) for x in range(0, 28 * 10, 28)]
+        out = hid_send_many(dev, msgs, echo=4, window=4)
+        self.assertEqual([x[:4] for x in out], msgs)
+        self.assertEqual(dev.requests, 10)
+        self.assertEqual(dev.max_in_flight, 4)
+
+    def test_pipelined_send_fallback(self):
+        """ Tests that a lost response makes the pipeline fall back to lockstep for the rest of the batch """
+
+        dev = PipelinedDevice(drop=2)
+        msgs = [struct.pack(">BHB", 0x12, x, 28) for x in range(0, 28 * 10, 28)]
+        out = hid_send_many(dev, msgs, echo=4, window=4)
+        self.assertEqual([x[:4] for x in out], msgs)
+        # six went out before the mismatch was noticed, the last eight were resent in lockstep
+        self.assertEqual(dev.requests, 6 + 8)
+        self.assertEqual(dev.responses, [])
+
+    def test_transport_policy(self):
+        """ Tests command classification, retries and adaptive timeouts of the transport policy """
+
+        self.assertEqual(classify(bytes.fromhex("0203")), COMMAND_POLLING)
+        self.assertEqual(classify(bytes.fromhex("12001C1C")), COMMAND_BULK)
+        self.assertEqual(classify(bytes.fromhex("040101")), COMMAND_INTERACTIVE)
+        self.assertEqual(classify(bytes.fromhex("050101000009")), COMMAND_WRITE)
+        self.assertEqual(classify(bytes.fromhex("FE0D0201")), COMMAND_WRITE)
+
+        policy = TransportPolicy()
+        policy.backoff = lambda name, attempt: 0
+        self.assertEqual(policy.timeout_ms(COMMAND_INTERACTIVE), 500)
+        dev = FlakyDevice(drop=2)
+        self.assertEqual(policy.send(dev, b"\x04\x01", retries=20)[:2], b"\x04\x01")
+        self.assertEqual(dev.writes, 3)
+
+        for x in range(TransportPolicy.MIN_SAMPLES):
+            policy.record(COMMAND_INTERACTIVE, 2)
+            policy.record(COMMAND_WRITE, 2)
+        # fast round trips bring the timeout down to the class minimum, which for flash writes stays high
+        self.assertEqual(policy.timeout_ms(COMMAND_INTERACTIVE), 50)
+        self.assertEqual(policy.timeout_ms(COMMAND_WRITE), 500)
+
+        # running out of attempts is not the same as the device going away
+        dev = FlakyDevice(drop=10)
+        with self.assertRaises(RuntimeError):
+            policy.send(dev, b"\x04", retries=3)
+        self.assertEqual(dev.writes, 3)
+
+    def test_transport_late_response(self):
+        """ Tests that a response arriving after its request timed out isn't taken for the next request's """
+
+        policy = TransportPolicy()
+        policy.backoff = lambda name, attempt: 0
+        for x in range(TransportPolicy.MIN_SAMPLES):
+            policy.record(COMMAND_INTERACTIVE, 2)
+
+        # the first response shows up once the request was already sent again, so there are two of them
+        dev = LateDevice(delays=[2])
+        first = policy.send(dev, b"\x04\x00\x00\xAA", retries=5)
+        second = policy.send(dev, b"\x04\x00\x00\xBB", retries=5)
+        self.assertEqual(first[:4], b"\x04\x00\x00\xAA")
+        self.assertEqual(second[:4], b"\x04\x00\x00\xBB")
+        self.assertEqual(dev.pending, [])
+
+        # a request the firmware doesn't know is answered with id_unhandled rather than skipped
+        self.assertEqual(policy.send(EmulatedDevice(VialEmulator(LAYOUT_2x2)), b"\x7E\x01")[:2], b"\xFF\x01")
+
+    def test_transport_policy_pipelined(self):
+        """ Tests that pipelined batches wait as long as the policy says and feed its latency estimate """
+
+        policy = TransportPolicy()
+        for x in range(TransportPolicy.MIN_SAMPLES):
+            policy.record(COMMAND_BULK, 1)
+        dev = PipelinedDevice()
+        msgs = [struct.pack(">BHB", 0x12, x, 28) for x in range(0, 28 * 10, 28)]
+        self.assertEqual([x[:4] for x in policy.send_many(dev, msgs, echo=4)], msgs)
+        self.assertEqual(dev.read_timeouts, {policy.policies[COMMAND_BULK].min_timeout_ms})
+        self.assertEqual(len(policy.latency[COMMAND_BULK]), TransportPolicy.MIN_SAMPLES + 10)
+
+        # an unplugged device aborts the batch instead of falling back to lockstep
+        dev = PipelinedDevice()
+        dev.unplugged = True
+        policy.errors = DISCONNECT_ERRORS - 1
+        with self.assertRaises(DeviceDisconnected):
+            policy.send_many(dev, msgs, echo=4)
+        self.assertEqual(dev.requests, PIPELINE_WINDOW)
+
+    def test_transport_disconnect(self):
+        """ Tests that a vanished device is detected without exhausting retries """
+
+        policy = TransportPolicy()
+        policy.backoff = lambda name, attempt: 0
+        dev = FlakyDevice()
+        dev.unplugged = True
+        with self.assertRaises(DeviceDisconnected):
+            policy.send(dev, b"\x05", retries=20)
+
+    def test_transport_stats(self):
+        """ Tests per command counters collected by the transport """
+
+        STATS.reset()
+        policy = TransportPolicy()
+        policy.backoff = lambda name, attempt: 0
+        policy.send(FlakyDevice(drop=1), b"\x05\x01", retries=5)
+        policy.send(FlakyDevice(), b"\xFE\x0D\x01\x00")
+        policy.send(FlakyDevice(), b"\xFE\x0A\x01\x00")
+        with self.assertRaises(RuntimeError):
+            policy.send(FlakyDevice(drop=10), b"\xFE\x0A\x02\x00", retries=2)
+        hid_send_many(FlakyDevice(), [b"\x12\x00\x00\x1C"] * 3, echo=4, window=1, send=policy.send)
+
+        stats = STATS.snapshot()
+        self.assertEqual(list(stats), ["CMD_VIA_SET_KEYCODE", "CMD_VIA_KEYMAP_GET_BUFFER",
+                                       "CMD_VIAL_QMK_SETTINGS_GET", "DYNAMIC_VIAL_TAP_DANCE_GET"])
+        self.assertEqual(stats["CMD_VIA_SET_KEYCODE"]["packets"], 1)
+        self.assertEqual(stats["CMD_VIA_SET_KEYCODE"]["retries"], 1)
+        self.assertEqual(stats["CMD_VIA_SET_KEYCODE"]["timeouts"], 1)
+        self.assertEqual(stats["CMD_VIA_KEYMAP_GET_BUFFER"]["packets"], 3)
+        self.assertEqual(stats["CMD_VIA_KEYMAP_GET_BUFFER"]["bytes_out"], 3 * MSG_LEN)
+        self.assertEqual(sum(stats["CMD_VIA_KEYMAP_GET_BUFFER"]["histogram"]), 3)
+        self.assertEqual(stats["CMD_VIAL_QMK_SETTINGS_GET"]["packets"], 2)
+        self.assertEqual(stats["CMD_VIAL_QMK_SETTINGS_GET"]["failures"], 1)
+        self.assertIn("DYNAMIC_VIAL_TAP_DANCE_GET", STATS.format())
+        STATS.reset()
+
+    def test_io_worker(self):
+        """ Tests that the I/O worker serves interactive packets before polls and bulk reads """
+
+        served = []
+
+        def send(dev, msg, retries=1):
+            served.append(msg[0])
+            return msg
+
+        worker = DeviceWorker(send)
+        gate = threading.Event()
+        worker.submit(gate.wait)
+        bulk = worker.submit(send, None, b"\x12", priority=PRIORITY_BULK)
+        poll = worker.submit(send, None, b"\x02", priority=PRIORITY_POLLING)
+        interactive = threading.Thread(target=worker.send, args=(None, b"\x05"))
+        interactive.start()
+        while worker.queue.qsize() < 3:
+            pass
+        gate.set()
+        interactive.join()
+        self.assertEqual(bulk.result(), b"\x12")
+        self.assertEqual(poll.result(), b"\x02")
+        self.assertEqual(served, [0x05, 0x02, 0x12])
+
+        worker.stop()
+        with self.assertRaises(RuntimeError):
+            worker.send(None, b"\x05")
+
+        # jobs still queued when the worker stops are failed rather than left hanging
+        worker = DeviceWorker(send)
+        gate = threading.Event()
+        worker.submit(gate.wait)
+        queued = worker.submit(send, None, b"\x12", priority=PRIORITY_BULK)
+        stopper = threading.Thread(target=worker.stop)
+        stopper.start()
+        gate.set()
+        stopper.join()
+        with self.assertRaises(RuntimeError):
+            queued.result(timeout=1)
+        with self.assertRaises(RuntimeError):
+            worker.submit(send, None, b"\x05").result(timeout=1)
+
+    def test_rgb_write_coalescing(self):
+        """ Tests that lighting changes made while the worker is busy collapse into the latest one per setter """
+
+        from editor.rgb_configurator import BasicHandler
+
+        class Target:
+            pass
+
+        kb = Target()
+        kb.worker = DeviceWorker(lambda dev, msg, retries=1: msg)
+        handler = BasicHandler(None)
+        handler.device = mock.Mock(keyboard=kb)
+        brightness, speed = [], []
+
+        gate = threading.Event()
+        kb.worker.submit(gate.wait)
+        for value in range(20):
+            handler.write(brightness.append, value)
+            handler.write(speed.append, value * 2)
+        gate.set()
+        kb.worker.submit(lambda: None).result(timeout=1)
+        self.assertEqual(brightness, [19])
+        self.assertEqual(speed, [38])
+
+        # once it has been sent the next change is queued again
+        handler.write(brightness.append, 5)
+        kb.worker.submit(lambda: None).result(timeout=1)
+        self.assertEqual(brightness, [19, 5])
+        kb.worker.stop()
+
+    def test_call_async_unlock(self):
+        """ Tests that writes which need an unlocked keyboard only run once it is unlocked """
+
+        import os
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+        from PyQt6.QtWidgets import QApplication
+        from protocol.io_worker import call_async
+        from unlocker import Unlocker
+
+        class Target:
+            worker = None
+            keys = encoders = []
+            status = 1
+
+            def get_unlock_status(self):
+                return self.status
+
+            def get_unlock_keys(self):
+                return [(0, 0)]
+
+            def unlock_start(self):
+                pass
+
+        app = QApplication.instance() or QApplication([])
+        kb = Target()
+        done = []
+        call_async(kb, lambda: "written", done.append, unlock=True)
+        self.assertEqual(done[-1].result(), "written")
+
+        # the dialog is shown without waiting on it, the write follows once it's closed
+        kb.status = 0
+        main_window = mock.Mock()
+        with mock.patch.object(Unlocker, "global_main_window", main_window, create=True), \
+                mock.patch.object(Unlocker, "global_layout_editor", None, create=True):
+            call_async(kb, lambda: self.fail("written while locked"), done.append, unlock=True)
+            self.assertEqual(len(done), 1)
+            dialog, = Unlocker.dialogs
+            main_window.lock_ui.assert_called_once_with()
+            dialog.reject()
+            with self.assertRaises(RuntimeError):
+                done[-1].result()
+
+            call_async(kb, lambda: "written", done.append, unlock=True)
+            dialog, = Unlocker.dialogs
+            dialog.accept()
+            self.assertEqual(done[-1].result(), "written")
+        self.assertEqual(main_window.unlock_ui.call_count, 2)
+        self.assertEqual(Unlocker.dialogs, set())
+
+    def test_async_keyboard(self):
+        """ Tests that keyboards can be driven from asyncio """
+
+        kb, dev = self.prepare_keyboard(LAYOUT_2x2, [[[1, 2], [3, 4]], [[5, 6], [7, 8]]])
+        kb2, dev2 = self.prepare_keyboard(LAYOUT_2x2, [[[1, 2], [3, 4]]])
+        dev.expect("050101000009", "")
+        dev2.expect("05000000000A", "")
+        akb, akb2 = AsyncKeyboard(kb), AsyncKeyboard(kb2)
+
+        async def configure():
+            await asyncio.gather(akb.set_key(1, 1, 0, s(9)), akb2.set_key(0, 0, 0, s(10)))
+
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(configure())
+        akb.close()
+        akb2.close()
+        self.assertEqual(kb.layout[(1, 1, 0)], s(9))
+        self.assertEqual(kb2.layout[(0, 0, 0)], s(10))
+        dev.finish()
+        dev2.finish()
+
+        # QK_BOOT, as a name or a number, is only written once the keyboard was unlocked by holding its keys
+        emulator = VialEmulator(LAYOUT_2x2, unlock_keys=((0, 1),))
+        kb = Keyboard(emulator.device())
+        kb.reload()
+        prompts = []
+        akb = AsyncKeyboard(kb, unlock_prompt=prompts.append)
+        akb.UNLOCK_POLL_INTERVAL = 0
+        boot = Keycode.deserialize("QK_BOOT")
+        loop.run_until_complete(akb.set_key(0, 0, 1, boot))
+        self.assertEqual(prompts, [[(0, 1)]])
+        self.assertTrue(emulator.unlocked)
+        self.assertEqual(emulator.keymap[1], boot)
+
+        # the prompt can refuse, nothing is written then
+        emulator.unlocked = False
+
+        async def decline(keys):
+            raise RuntimeError("declined")
+
+        akb.unlock_prompt = decline
+        with self.assertRaises(RuntimeError):
+            loop.run_until_complete(akb.set_key(0, 1, 0, "QK_BOOT"))
+        self.assertEqual(emulator.keymap[2], 0)
+        akb.close()
+        loop.close()
+
+    def test_capture_replay(self):
+        """ Tests that a recorded session can be replayed without the device """
+
+        keymap = [[[1, 2], [3, 4]], [[5, 6], [7, 8]]]
+        dev = SimulatedDevice()
+        dev.expect_via_protocol(9)
+        dev.expect_keyboard_id(0)
+        dev.expect_layout(LAYOUT_2x2)
+        dev.expect_layers(len(keymap))
+        dev.expect("0C", "0C00")
+        dev.expect("0D", "0D0000")
+        dev.expect_keymap(keymap)
+        dev.expect("050101000009", "")
+
+        recorder = RecordingTransport(dev.sim_send)
+        kb = Keyboard(dev, recorder.send)
+        kb.reload()
+        kb.set_key(1, 1, 0, s(9))
+        dev.finish()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = tmp + "/session.vcap"
+            recorder.save(path)
+            records = read_capture(path)
+        self.assertEqual([x.request for x in records], [x.request for x in recorder.records])
+        self.assertEqual([x.response for x in records], [x.response for x in recorder.records])
+
+        replay = ReplayTransport(records)
+        kb = Keyboard(None, replay.send)
+        kb.reload()
+        self.assertEqual(kb.layout[(1, 0, 1)], s(6))
+        kb.set_key(1, 1, 0, s(9))
+        replay.finish()
+
+        replay = ReplayTransport(records)
+        kb = Keyboard(None, replay.send)
+        kb.reload()
+        with self.assertRaises(ReplayMismatch):
+            kb.set_key(1, 1, 0, s(10))
+
+    def test_emulator(self):
+        """ Tests a full reload and the common writes against the firmware emulator """
+
+        emulator = VialEmulator(LAYOUT_ENCODER.replace('"none"', '"vialrgb"'), lighting_effects=range(1, 30))
+        kb = Keyboard(emulator.device())
+        kb.reload()
+        self.assertEqual(kb.keyboard_id, emulator.keyboard_id)
+        self.assertEqual(kb.encoder_count, 1)
+        self.assertEqual(kb.tap_dance_count, 4)
+        self.assertEqual(kb.rgb_supported_effects, set(range(30)))
+
+        kb.set_keys({(1, 0, 0): s(4), (2, 0, 0): s(5), (3, 0, 0): s(6)})
+        kb.set_encoder(3, 0, 1, s(7))
+        kb.tap_dance_set(2, (s(4), s(5), s(6), s(7), 200))
+        emulator.press(0, 0)
+        self.assertEqual(kb.matrix_poll()[2], 1)
+
+        kb = Keyboard(emulator.device())
+        kb.reload()
+        self.assertEqual([kb.layout[(l, 0, 0)] for l in range(4)], [s(0), s(4), s(5), s(6)])
+        self.assertEqual(kb.encoder_layout[(3, 0, 1)], s(7))
+        self.assertEqual(kb.tap_dance_get(2), (s(4), s(5), s(6), s(7), 200))
+
+    def test_lazy_keymap(self):
+        """ Tests that layers past the first are fetched in the background and on demand """
+
+        emulator = VialEmulator(LAYOUT_ENCODER, layers=8)
+        for layer in range(8):
+            emulator.keymap[layer] = 4 + layer
+        kb = Keyboard(emulator.device())
+        worker = DeviceWorker(kb.usb_send, kb.usb_send_many)
+        kb.attach_worker(worker)
+        kb.lazy_keymap = True
+
+        # reloading on the worker holds the background fetches back, the gate keeps them there afterwards
+        gate = threading.Event()
+
+        def on_stage(stage):
+            if stage == STAGE_LIGHTING:
+                worker.submit(gate.wait)
+
+        worker.submit(kb.reload, on_stage=on_stage).result()
+        self.assertTrue(kb.layer_loaded(0))
+        self.assertFalse(kb.layer_loaded(6))
+        fetch = worker.submit(lambda: (kb.ensure_layer(6), sorted(kb.keymap.loaded_layers))[1])
+        gate.set()
+        # the layer asked for goes ahead of the ones queued in the background
+        self.assertEqual(fetch.result(), [0, 6])
+        self.assertEqual(kb.layout[(6, 0, 0)], s(10))
+
+        # whole keymap consumers wait for the rest
+        layout = json.loads(kb.save_layout())["layout"]
+        self.assertEqual([layer[0][0] for layer in layout], [s(4 + layer) for layer in range(8)])
+        self.assertEqual(kb.keymap.loaded_layers, set(range(8)))
+        worker.stop()
+
+    def test_lazy_keymap_writes(self):
+        """ Tests that background layer fetches neither delay a reload nor let writes clobber unloaded layers """
+
+        emulator = VialEmulator(LAYOUT_2x2, layers=4)
+        for idx in range(len(emulator.keymap)):
+            emulator.keymap[idx] = 100 + idx
+        kb = Keyboard(emulator.device())
+        sent = []
+
+        def send(dev, msg, retries=1):
+            sent.append(msg)
+            return kb.transport.send(dev, msg, retries=retries)
+
+        def send_many(dev, msgs, echo=0, retries=1):
+            sent.extend(msgs)
+            return kb.transport.send_many(dev, msgs, echo=echo, retries=retries)
+
+        worker = DeviceWorker(send, send_many)
+        kb.attach_worker(worker)
+        kb.lazy_keymap = True
+        gate = threading.Event()
+
+        def on_stage(stage):
+            if stage == STAGE_LIGHTING:
+                worker.submit(gate.wait)
+
+        # reloading from another thread than the worker, like opening a keyboard does
+        kb.reload(on_stage=on_stage)
+        # nothing past the first layer (8 bytes) was fetched while the reload was going on
+        self.assertEqual([msg for msg in sent if msg[0] == 0x12 and struct.unpack(">H", msg[1:3])[0] >= 8], [])
+        self.assertEqual(kb.keymap.loaded_layers, {0})
+
+        # the run from (1, 1, 1) to (3, 0, 0) also covers all of layer 2, which has to be read first
+        written = worker.submit(kb.set_keys, {(1, 1, 1): s(1), (3, 0, 0): s(2)})
+        gate.set()
+        self.assertEqual(written.result(), 1)
+        self.assertEqual(list(emulator.keymap[7:13]), [1, 108, 109, 110, 111, 2])
+        worker.stop()
+
+    def test_capability_cache(self):
+        """ Tests that a warm connect doesn't query capabilities again, and that a reflash is noticed """
+
+        def connect(emulator, cache):
+            sent = []
+
+            def send(dev, msg, retries=1):
+                sent.append(msg)
+                return emulator.send(dev, msg, retries=retries)
+
+            kb = Keyboard(None, send, capability_cache=cache)
+            kb.reload()
+            return kb, sent
+
+        layout = LAYOUT_ENCODER.replace('"none"', '"vialrgb"')
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = CapabilityCache(tmp)
+            emulator = VialEmulator(layout, lighting_effects=range(1, 100))
+            kb, cold = connect(emulator, cache)
+            kb, warm = connect(emulator, cache)
+            self.assertEqual(kb.rgb_supported_effects, set(range(100)))
+            # every page of supported effects past the first, which is part of the probe along with VialRGB info
+            self.assertEqual(len(cold) - len(warm), 100 // 15)
+            self.assertEqual([msg[:2] for msg in warm].count(b"\x08\x42"), 1)
+
+            # a reflash which changed the effects shows up in the probe
+            emulator = VialEmulator(layout, lighting_effects=range(2, 100))
+            kb, reflashed = connect(emulator, cache)
+            self.assertEqual(len(reflashed), len(cold))
+            self.assertEqual(kb.rgb_supported_effects, set(range(100)) - {1})
+
+            emulator = VialEmulator(layout, lighting_effects=range(1, 100), dynamic_counts=(8, 4, 4, 4))
+            kb, reflashed = connect(emulator, cache)
+            # four more tap dance entries to fetch
+            self.assertEqual(len(reflashed), len(cold) + 4)
+            self.assertEqual(kb.tap_dance_count, 8)
+
+    def test_qmk_settings_batch(self):
+        """ Tests that settings are read in one pipelined batch and that only changed values get written """
+
+        from collections import defaultdict
+        from editor.qmk_settings import QmkSettings
+
+        qsid_fields = defaultdict(list, {
+            qsid: [{"type": "integer", "qsid": qsid, "width": 2, "min": 0, "max": 1000}] for qsid in (2, 3, 4)
+        })
+        with mock.patch.object(QmkSettings, "qsid_fields", qsid_fields, create=True):
+            emulator = VialEmulator(LAYOUT_2x2, qsids=(2, 3, 4))
+            sent = []
+
+            def send_many(dev, msgs, echo=0, retries=20):
+                sent.append(len(msgs))
+                return [emulator.send(dev, msg) for msg in msgs]
+
+            kb = Keyboard(emulator.device(), usb_send_many=send_many)
+            kb.reload()
+            self.assertIn(3, sent)
+            self.assertEqual(kb.settings, {2: 0, 3: 0, 4: 0})
+
+            sent.clear()
+            kb.qmk_settings_stage(2, 100)
+            kb.qmk_settings_stage(2, 200)
+            kb.qmk_settings_stage(3, 300)
+            kb.qmk_settings_stage(3, 0)
+            kb.qmk_settings_stage(4, 400)
+            self.assertEqual(kb.pending_settings, {2: 200, 4: 400})
+            self.assertEqual(kb.qmk_settings_flush(), [])
+            self.assertEqual(sent, [2])
+            self.assertEqual(kb.pending_settings, {})
+            self.assertEqual(emulator.settings[2][:2], struct.pack("<H", 200))
+            self.assertEqual(emulator.settings[3][:2], bytes(2))
+
+            kb = Keyboard(emulator.device())
+            kb.reload()
+            self.assertEqual(kb.settings, {2: 200, 3: 0, 4: 400})
+
+    def check_key_shapes(self):
+        """ Compares batched key geometry against the same rotation done by QTransform """
+
+        from PyQt6.QtCore import QPointF
+        from PyQt6.QtGui import QTransform
+        from kle_serial import Key
+        from widgets.key_geometry import key_shapes
+
+        descs = []
+        for x in range(20):
+            key = Key()
+            key.x, key.y, key.width = x * 1.25, x % 3, 1 + x % 2
+            key.rotation_angle = (0, 15, 90, -30)[x % 4]
+            key.rotation_x, key.rotation_y = 2.5, 1
+            descs.append(key)
+
+        shapes = key_shapes(descs, 17)
+        for desc, shape in zip(descs, shapes):
+            t = QTransform()
+            t.translate(shape.rotation_x, shape.rotation_y)
+            t.rotate(desc.rotation_angle)
+            t.translate(-shape.rotation_x, -shape.rotation_y)
+            x, y, w, h = shape.rect
+            expected = [t.map(QPointF(px, py)) for px, py in ((x, y), (x, y + h - 1), (x + w - 1, y + h - 1),
+                                                              (x + w - 1, y))]
+            for (px, py), point in zip(shape.corners, expected):
+                self.assertAlmostEqual(px, point.x())
+                self.assertAlmostEqual(py, point.y())
+            self.assertAlmostEqual(shape.left, min(point.x() for point in expected))
+        return shapes
+
+    def test_key_shapes(self):
+        """ Tests key geometry computed one key at a time, as without numpy """
+
+        from widgets import key_geometry
+
+        with mock.patch.object(key_geometry, "numpy", None):
+            self.check_key_shapes()
+
+    @unittest.skipUnless(numpy, "numpy is not installed")
+    def test_key_shapes_numpy(self):
+        """ Tests key geometry computed for all keys at once with numpy, which has to match the scalar path """
+
+        from widgets import key_geometry
+
+        shapes = self.check_key_shapes()
+        with mock.patch.object(key_geometry, "numpy", None):
+            scalar = self.check_key_shapes()
+        for shape, expected in zip(shapes, scalar):
+            self.assertEqual(shape.rect, expected.rect)
+            self.assertEqual(shape.mask_rect, expected.mask_rect)
+            for (px, py), (ex, ey) in zip(shape.corners + shape.mask_corners, expected.corners + expected.mask_corners):
+                self.assertAlmostEqual(px, ex)
+                self.assertAlmostEqual(py, ey)
+
+    def test_geometry_cache(self):
+        """ Tests that views of the same keys share placed geometry, but each keeps its own layout options """
+
+        import os
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+        from PyQt6.QtWidgets import QApplication
+        from widgets.keyboard_widget import KeyboardWidget, GEOMETRY_CACHE
+
+        class LayoutEditor:
+
+            def __init__(self):
+                self.choices = {}
+
+            def get_choice(self, index):
+                return self.choices.get(index, 0)
+
+        app = QApplication.instance() or QApplication([])
+        layout = json.loads(LAYOUT_2x2)
+        layout["layouts"]["keymap"][1] = ["1,0\n\n\n0,0", "1,1\n\n\n0,0", {"x": 1}, {"w": 2}, "1,0\n\n\n0,1"]
+        keyboard = Keyboard(VialEmulator(json.dumps(layout)).device())
+        keyboard.reload()
+
+        GEOMETRY_CACHE.clear()
+        first, second = KeyboardWidget(LayoutEditor()), KeyboardWidget(LayoutEditor())
+        first.set_keys(keyboard.keys, keyboard.encoders)
+        second.set_keys(keyboard.keys, keyboard.encoders)
+        self.assertEqual(len(GEOMETRY_CACHE.entries), 1)
+        self.assertEqual([w.geometry() for w in first.widgets], [w.geometry() for w in second.widgets])
+        self.assertTrue(all(a is not b for a, b in zip(first.widgets, second.widgets)))
+        placed = [w.geometry() for w in second.widgets]
+        self.assertEqual(len(placed), 4)
+
+        # the first view switches to the wide key, the second one still shows two keys
+        first.layout_editor.choices[0] = 1
+        first.update_layout()
+        self.assertEqual(len(GEOMETRY_CACHE.entries), 2)
+        self.assertEqual(len(first.widgets), 3)
+        self.assertEqual([w.geometry() for w in second.widgets], placed)
+        second.update_layout()
+        self.assertEqual([w.geometry() for w in second.widgets], placed)
+
+        # and picks up the geometry the first view placed once it switches too
+        second.layout_editor.choices[0] = 1
+        second.update_layout()
+        self.assertEqual(len(GEOMETRY_CACHE.entries), 2)
+        self.assertEqual([w.geometry() for w in second.widgets], [w.geometry() for w in first.widgets])
+
+    def test_hit_test(self):
+        """ Tests that hit testing through the key index finds the same key as a scan over every key """
+
+        import math
+        import os
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+        from PyQt6.QtCore import QPointF, Qt
+        from PyQt6.QtWidgets import QApplication
+        from widgets.keyboard_widget import KeyboardWidget, KeyIndex
+
+        class LayoutEditor:
+
+            def get_choice(self, index):
+                return 0
+
+        def scan(pos):
+            pt = QPointF(pos.x() / widget.scale, pos.y() / widget.scale)
+            for key in widget.widgets:
+                if key.masked and key.mask_polygon.containsPoint(pt, Qt.FillRule.OddEvenFill):
+                    return key, True
+                if key.polygon.containsPoint(pt, Qt.FillRule.OddEvenFill):
+                    return key, False
+            return None, False
+
+        app = QApplication.instance() or QApplication([])
+        layout = json.loads(LAYOUT_2x2)
+        # an ISO enter next to a plain key, and a rotated row which overlaps the bounding boxes of both
+        layout["matrix"]["cols"] = 3
+        layout["layouts"]["keymap"] = [["0,0", {"w": 1.25, "h": 2, "w2": 1.5, "h2": 1, "x": 0.25, "x2": -0.25}, "0,1"],
+                                       [{"r": -30, "rx": 0.5, "ry": 1.5, "y": 0.5}, "1,0", "1,1", "1,2"]]
+        keyboard = Keyboard(VialEmulator(json.dumps(layout)).device())
+        keyboard.reload()
+
+        widget = KeyboardWidget(LayoutEditor())
+        widget.set_keys(keyboard.keys, keyboard.encoders)
+        for key in widget.widgets:
+            key.masked = True
+        hits = set()
+        for shift in (0, -150.5):
+            # keys moved up and left of the origin, several cells into negative coordinates
+            for key in widget.widgets:
+                key.update_position(key.scale, key.shift_x + shift, key.shift_y + shift)
+            widget.index = KeyIndex(widget.widgets, widget.widgets[0].size)
+            cell = widget.index.cell
+            bounds = widget.widgets[0].polygon.boundingRect()
+            for key in widget.widgets:
+                bounds = bounds.united(key.polygon.boundingRect())
+            for scale in (0.7, 1, 1.6):
+                widget.set_scale(scale)
+                # quarter cells, which includes every cell edge, from a cell outside the keys
+                for x in range(4 * math.floor(bounds.left() / cell) - 4, 4 * math.ceil(bounds.right() / cell) + 4):
+                    for y in range(4 * math.floor(bounds.top() / cell) - 4, 4 * math.ceil(bounds.bottom() / cell) + 4):
+                        pos = QPointF(x * cell / 4 * scale, y * cell / 4 * scale)
+                        found = widget.hit_test(pos)
+                        self.assertEqual(found, scan(pos), (shift, scale, x, y))
+                        hits.add((found[0].desc.row, found[0].desc.col, found[1]) if found[0] else None)
+        # every key was hit, both on and off its masked part
+        self.assertEqual(hits, {None} | {(row, col, masked) for row, col in keyboard.rowcol
+                                          for masked in (False, True)})
+
+    def test_hidraw_changed(self):
+        """ Tests picking hidraw nodes out of batches of inotify events """
+
+        from autorefresh.autorefresh_thread_linux import hidraw_changed, IN_CREATE, IN_Q_OVERFLOW, INOTIFY_EVENT
+
+        def event(name, mask=IN_CREATE):
+            # names are NUL-padded to a multiple of the header alignment
+            name = name + b"\x00" * (16 - len(name) % 16) if name else b""
+            return INOTIFY_EVENT.pack(1, mask, 0, len(name)) + name
+
+        self.assertFalse(hidraw_changed(b""))
+        self.assertFalse(hidraw_changed(event(b"tty5") + event(b"sda1")))
+        self.assertTrue(hidraw_changed(event(b"tty5") + event(b"hidraw3")))
+        self.assertTrue(hidraw_changed(event(b"", IN_Q_OVERFLOW)))
+        # a truncated trailing event is ignored rather than misparsed
+        self.assertFalse(hidraw_changed(event(b"tty5") + event(b"hidraw3")[:10]))
+
+    def test_autorefresh_linux(self):
+        """ Tests that /dev changes are debounced into one rescan and ones missed while locked aren't lost """
+
+        import os
+        import time
+        from autorefresh import autorefresh_thread, autorefresh_thread_linux
+        from autorefresh.autorefresh_thread_linux import AutorefreshThreadLinux, IN_CREATE, INOTIFY_EVENT
+
+        def event(name):
+            name = name + b"\x00" * (16 - len(name) % 16)
+            return INOTIFY_EVENT.pack(1, IN_CREATE, 0, len(name)) + name
+
+        def wait_for(count):
+            deadline = time.monotonic() + 5
+            while len(scans) < count and time.monotonic() < deadline:
+                time.sleep(0.01)
+            # and make sure nothing else follows
+            time.sleep(0.2)
+            self.assertEqual(len(scans), count)
+
+        scans = []
+        events_r, events_w = os.pipe()
+        thread = AutorefreshThreadLinux()
+        with mock.patch.object(autorefresh_thread_linux, "watch_dev", return_value=events_r), \
+                mock.patch.object(autorefresh_thread_linux, "DEBOUNCE_SECONDS", 0.05), \
+                mock.patch.object(autorefresh_thread, "find_vial_devices",
+                                  side_effect=lambda *args, **kwargs: scans.append(args) or []):
+            threading.Thread(target=thread.run, daemon=True).start()
+            wait_for(1)
+
+            # unrelated nodes don't cause a rescan, a burst of hidraw ones causes only one
+            os.write(events_w, event(b"tty5"))
+            wait_for(1)
+            os.write(events_w, event(b"hidraw3"))
+            os.write(events_w, event(b"hidraw4"))
+            wait_for(2)
+
+            # e.g. a keyboard rebooting into the bootloader while it's being flashed
+            thread.lock()
+            os.write(events_w, event(b"hidraw3"))
+            wait_for(2)
+            self.assertTrue(thread.missed)
+            thread.unlock()
+            wait_for(3)
+            self.assertFalse(thread.missed)
+
+            # nothing was missed, so unlocking doesn't rescan
+            thread.lock()
+            thread.unlock()
+            wait_for(3)
+
+    def test_device_registry(self):
+        """ Tests matching HID interfaces and remembering the outcome across refreshes """
+
+        import util
+        from vial_device import VialKeyboard, VialBootloader
+
+        def desc(path, vid, pid, serial="", usage_page=0xFF60, usage=0x61):
+            return {"path": path, "vendor_id": vid, "product_id": pid, "serial_number": serial,
+                    "usage_page": usage_page, "usage": usage}
+
+        vial = desc(b"1", 0x1234, 0x5678, "vial:f64c2b3c")
+        vibl = desc(b"2", 0x1234, 0x5679, "vibl:d4f8159c")
+        via = desc(b"3", 0xFEED, 0x0001)
+        other = desc(b"4", 0xFEED, 0x0002)
+        wrong_usage = desc(b"5", 0x1234, 0x5678, "vial:f64c2b3c", usage_page=0x0001, usage=0x06)
+        via_stack = {"definitions": {str(0xFEED * 65536 + 0x0001): {}}}
+
+        self.assertTrue(util.is_rawhid_usage(vial, True))
+        self.assertFalse(util.is_rawhid_usage(wrong_usage, True))
+
+        self.assertEqual(util.match_vial_device(vial, via_stack, None, None)[:2], ("vial serial magic", True))
+        self.assertEqual(util.match_vial_device(vibl, via_stack, None, None)[:2], ("vibl serial magic", False))
+        self.assertEqual(util.match_vial_device(via, via_stack, None, None)[:2], ("VIA stack", True))
+        self.assertEqual(util.match_vial_device(other, via_stack, 0xFEED, 0x0002)[:2], ("sideload", True))
+        self.assertIsNone(util.match_vial_device(other, via_stack, None, None))
+        self.assertIsInstance(util.match_vial_device(vial, via_stack, None, None)[2](), VialKeyboard)
+        self.assertIsInstance(util.match_vial_device(vibl, via_stack, None, None)[2](), VialBootloader)
+
+        present = [vial, vibl, via, other, wrong_usage]
+        registry = util.DeviceRegistry()
+        with mock.patch.object(util.hid, "enumerate", side_effect=lambda: list(present)) as enumerate, \
+                mock.patch.object(util, "match_vial_device", side_effect=util.match_vial_device) as match, \
+                mock.patch.object(util, "can_open_rawhid", return_value=True):
+            first = util.find_vial_devices(via_stack, quiet=True, registry=registry)
+            self.assertEqual([d.desc for d in first], [vial, vibl, via])
+            self.assertEqual(match.call_count, 5)
+
+            # nothing changed: the same objects come back without matching anything again
+            second = util.find_vial_devices(via_stack, quiet=True, registry=registry)
+            self.assertEqual([id(d) for d in second], [id(d) for d in first])
+            self.assertEqual(match.call_count, 5)
+
+            # an unplugged interface is forgotten
+            present.remove(vibl)
+            self.assertEqual([d.desc for d in util.find_vial_devices(via_stack, quiet=True, registry=registry)],
+                             [vial, via])
+            self.assertNotIn((b"2", 0x1234, 0x5679, "vibl:d4f8159c"), registry.devices)
+            self.assertEqual(match.call_count, 5)
+
+            # equal but different definitions, or a hard refresh, probe everything again
+            util.find_vial_devices(dict(via_stack), quiet=True, registry=registry)
+            self.assertEqual(match.call_count, 9)
+            util.find_vial_devices(registry.via_stack_json, quiet=True, registry=registry, hard=True)
+            self.assertEqual(match.call_count, 13)
+
+            # sideloading changes what matches
+            found = util.find_vial_devices(registry.via_stack_json, 0xFEED, 0x0002, quiet=True, registry=registry)
+            self.assertEqual([d.desc for d in found], [vial, via, other])
+            self.assertTrue(found[2].sideload)
+            self.assertEqual(enumerate.call_count, 6)
+
+    def test_emulator_socket(self):
+        """ Tests talking to the firmware emulator over a Unix socket """
+
+        emulator = VialEmulator(LAYOUT_2x2)
+        with tempfile.TemporaryDirectory() as tmp:
+            server = emulator.serve(tmp + "/vial.sock")
+            dev = SocketDevice(tmp + "/vial.sock")
+            kb = Keyboard(dev)
+            kb.reload()
+            kb.set_key(0, 1, 1, s(4))
+            dev.close()
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(emulator.keymap[3], 4)
+
+        # a packet which only partly arrived before a read timed out is completed by the next read
+        import socket
+        with tempfile.TemporaryDirectory() as tmp:
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            listener.bind(tmp + "/vial.sock")
+            listener.listen(1)
+            dev = SocketDevice(tmp + "/vial.sock")
+            peer = listener.accept()[0]
+            first, second = bytes(range(MSG_LEN)), bytes(range(MSG_LEN, 2 * MSG_LEN))
+            peer.sendall(first[:10])
+            self.assertEqual(dev.read(MSG_LEN, timeout_ms=0), b"")
+            peer.sendall(first[10:] + second)
+            self.assertEqual(dev.read(MSG_LEN, timeout_ms=100), first)
+            self.assertEqual(dev.read(MSG_LEN, timeout_ms=100), second)
+            peer.close()
+            dev.close()
+            listener.close()
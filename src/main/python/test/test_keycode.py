@@ -1,6 +1,8 @@
 import unittest
 
-from keycodes.keycodes import Keycode, recreate_keyboard_keycodes
+from keycodes.keycodes import Keycode, recreate_keyboard_keycodes, recreate_keycodes, RAWCODES_MAP, SERIALIZE_TABLES
+from keycodes.keycodes_v5 import keycodes_v5
+from keycodes.keycodes_v6 import keycodes_v6
 
 
 class FakeKeyboard:
@@ -41,3 +43,48 @@ class TestKeycode(unittest.TestCase):
 
     def test_serialize_v6(self):
         self._test_serialize_protocol(6)
+
+    def _test_serialize_table_protocol(self, protocol):
+        recreate_keyboard_keycodes(FakeKeyboard(protocol))
+        masked = keycodes_v6.masked if protocol == 6 else keycodes_v5.masked
+
+        # what serialize did before the table: look the keycode up, or its outer and inner parts if it's masked
+        def expected(code):
+            if (code & 0xFF00) not in masked:
+                kc = RAWCODES_MAP.get(code)
+                if kc is not None:
+                    return kc.qmk_id
+            else:
+                outer = RAWCODES_MAP.get(code & 0xFF00)
+                inner = RAWCODES_MAP.get(code & 0x00FF)
+                if outer is not None and inner is not None:
+                    return outer.qmk_id.replace("kc", inner.qmk_id)
+            return hex(code)
+
+        for x in range(2 ** 16):
+            self.assertEqual(Keycode.serialize(x), expected(x))
+        self.assertEqual(list(SERIALIZE_TABLES), [protocol == 6])
+
+        # keycodes change along with the keyboard, which has to drop the table built for the old ones
+        recreate_keycodes()
+        self.assertEqual(SERIALIZE_TABLES, dict())
+
+    def test_serialize_table_v5(self):
+        self._test_serialize_table_protocol(5)
+
+    def test_serialize_table_v6(self):
+        self._test_serialize_table_protocol(6)
+
+    def test_expressions(self):
+        recreate_keyboard_keycodes(FakeKeyboard(6))
+        kc_a = Keycode.deserialize("KC_A")
+        self.assertEqual(Keycode.deserialize("LCTL(KC_A)"), Keycode.resolve("QK_LCTL") | kc_a)
+        self.assertEqual(Keycode.deserialize("LT(1, KC_A)"), Keycode.resolve("QK_LAYER_TAP") | (1 << 8) | kc_a)
+        self.assertEqual(Keycode.deserialize("MT(MOD_LCTL | MOD_LSFT, KC_A)"),
+                         Keycode.deserialize("C_S_T(KC_A)"))
+        self.assertEqual(Keycode.deserialize("0x100 | (1 << 3) ^ 0b1 & ~0"), 0x100 | (1 << 3) ^ 0b1 & ~0)
+        self.assertEqual(Keycode.deserialize(" 2 * 3 + -1 "), 5)
+        for invalid in ["", "KC_NOPE", "LCTL(KC_A", "LCTL(KC_A))", "1 +", "NOPE(KC_A)", "KC_A $ 1"]:
+            with self.assertRaises(Exception):
+                Keycode.deserialize(invalid, reraise=True)
+            self.assertEqual(Keycode.deserialize(invalid), 0)
@@ -0,0 +1,45 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+from PyQt6.QtCore import QTimer
+from PyQt6.QtGui import QFont
+from PyQt6.QtWidgets import QDialog, QDialogButtonBox, QVBoxLayout, QPlainTextEdit
+
+from protocol.stats import STATS
+from util import tr
+
+
+class TransportDiagnostics(QDialog):
+
+    def __init__(self):
+        super().__init__()
+
+        self.setWindowTitle(tr("TransportDiagnostics", "Transport diagnostics"))
+
+        font = QFont("monospace")
+        font.setStyleHint(QFont.StyleHint.TypeWriter)
+        self.textarea = QPlainTextEdit()
+        self.textarea.setReadOnly(True)
+        self.textarea.setLineWrapMode(QPlainTextEdit.LineWrapMode.NoWrap)
+        self.textarea.setFont(font)
+        self.textarea.setMinimumWidth(900)
+
+        self.buttonBox = QDialogButtonBox(QDialogButtonBox.StandardButton.Close
+                                          | QDialogButtonBox.StandardButton.Reset)
+        self.buttonBox.rejected.connect(self.reject)
+        self.buttonBox.button(QDialogButtonBox.StandardButton.Reset).clicked.connect(self.on_reset)
+
+        self.layout = QVBoxLayout()
+        self.layout.addWidget(self.textarea)
+        self.layout.addWidget(self.buttonBox)
+        self.setLayout(self.layout)
+
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(1000)
+        self.refresh()
+
+    def refresh(self):
+        self.textarea.setPlainText(STATS.format())
+
+    def on_reset(self):
+        STATS.reset()
+        self.refresh()
@@ -1,11 +1,14 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 import sys
+import threading
 import time
+from concurrent.futures import Future
 
 from PyQt6.QtCore import Qt, QTimer, QCoreApplication, QByteArray, QBuffer, QIODevice
 from PyQt6.QtGui import QPalette
 from PyQt6.QtWidgets import QVBoxLayout, QLabel, QProgressBar, QDialog, QApplication, QPushButton, QHBoxLayout
 
+from protocol.io_worker import call_async, PRIORITY_POLLING
 from widgets.keyboard_widget import KeyboardWidget
 from util import tr
 import themes
@@ -13,6 +16,9 @@ import themes
 
 class Unlocker(QDialog):
 
+    # dialogs shown by unlock_async, kept alive until they close
+    dialogs = set()
+
     def __init__(self, layout_editor, keyboard):
         super().__init__()
 
@@ -68,6 +74,7 @@ class Unlocker(QDialog):
         self.progress.setMinimumHeight(20)
 
         self.update_reference()
+        self.polling = False
         self.timer = QTimer()
         self.timer.timeout.connect(self.unlock_poller)
         self.perform_unlock()
@@ -118,31 +125,42 @@ class Unlocker(QDialog):
             keys = getattr(self.keyboard, 'keys', []) or []
             encoders = getattr(self.keyboard, 'encoders', []) or []
             self.keyboard_reference.set_keys(keys, encoders)
+        except Exception:
+            return
+        call_async(self.keyboard, self.keyboard.get_unlock_keys, self.on_unlock_keys)
+
+    def on_unlock_keys(self, future):
+        # use "active" background to indicate keys to hold
+        try:
+            lock_keys = future.result()
+        except Exception:
+            lock_keys = []
 
-            # use "active" background to indicate keys to hold
+        for w in self.keyboard_reference.widgets:
             try:
-                lock_keys = self.keyboard.get_unlock_keys()
+                if (w.desc.row, w.desc.col) in lock_keys:
+                    w.setOn(True)
+                else:
+                    w.setOn(False)
             except Exception:
-                lock_keys = []
+                continue
 
-            for w in self.keyboard_reference.widgets:
-                try:
-                    if (w.desc.row, w.desc.col) in lock_keys:
-                        w.setOn(True)
-                    else:
-                        w.setOn(False)
-                except Exception:
-                    continue
+        self.keyboard_reference.update()
 
-            self.keyboard_reference.update_layout()
-            self.keyboard_reference.update()
-            self.keyboard_reference.updateGeometry()
-        except Exception:
+    def unlock_poller(self):
+        # the previous poll is still waiting for the device
+        if self.polling:
+            return
+        self.polling = True
+        call_async(self.keyboard, self.keyboard.unlock_poll, self.on_unlock_polled, PRIORITY_POLLING)
+
+    def on_unlock_polled(self, future):
+        self.polling = False
+        if not self.timer.isActive():
             return
 
-    def unlock_poller(self):
         try:
-            data = self.keyboard.unlock_poll()
+            data = future.result()
         except Exception:
             # communication error (device may have been unplugged)
             try:
@@ -183,8 +201,7 @@ class Unlocker(QDialog):
         self.progress.setMaximum(1)
         self.progress.setValue(0)
 
-        self.keyboard.unlock_start()
-        self.timer.start(200)
+        call_async(self.keyboard, self.keyboard.unlock_start, self.on_unlock_started)
 
         if sys.platform == "emscripten":
             import vialglue
@@ -200,14 +217,59 @@ class Unlocker(QDialog):
 
             vialglue.unlock_start(pixmap_bytes, pixmap.width(), pixmap.height())
 
+    def on_unlock_started(self, future):
+        if future.exception() is not None:
+            self.info_label.setText(tr("Unlocker", "Device disconnected. The dialog will close."))
+            self.reject()
+            return
+        self.timer.start(200)
+
     @classmethod
     def on_dialog_finished(cls, retval):
         cls.dlg_retval = retval
 
+    @classmethod
+    def unlock_async(cls, keyboard, callback):
+        """
+        Unlocks the keyboard without blocking the GUI thread: callback(future) runs once it's done, the future
+        holding whether the keyboard is unlocked now. The dialog is only shown when the keyboard is locked
+        """
+
+        def finish(unlocked):
+            future = Future()
+            future.set_result(unlocked)
+            callback(future)
+
+        def on_status(future):
+            if future.exception() is not None:
+                callback(future)
+                return
+            if future.result() == 1:
+                finish(True)
+                return
+
+            dlg = cls(cls.global_layout_editor, keyboard)
+            cls.dialogs.add(dlg)
+
+            def on_finished(retval):
+                cls.dialogs.discard(dlg)
+                cls.global_main_window.unlock_ui()
+                finish(retval == QDialog.DialogCode.Accepted.value)
+
+            dlg.finished.connect(on_finished)
+            cls.global_main_window.lock_ui()
+            dlg.setModal(True)
+            dlg.show()
+
+        return call_async(keyboard, keyboard.get_unlock_status, on_status)
+
     @classmethod
     def unlock(cls, keyboard):
         if keyboard.get_unlock_status() == 1:
             return True
+        # the dialog can't be shown from the device's I/O worker, see call_async(unlock=True)
+        if threading.current_thread() is not threading.main_thread():
+            raise RuntimeError("the keyboard has to be unlocked from the GUI thread")
 
         cls.dlg_retval = None
         dlg = cls(cls.global_layout_editor, keyboard)
@@ -13,6 +13,7 @@ from PyQt6.QtWidgets import QApplication, QWidget, QScrollArea, QFrame
 from hidproxy import hid
 from keycodes.keycodes import Keycode
 from keymaps import KEYMAPS
+from protocol.stats import STATS
 
 # Import tr from i18n module for internationalization support
 from i18n import tr
@@ -25,6 +26,9 @@ VIBL_SERIAL_NUMBER_MAGIC = "vibl:d4f8159c"
 
 MSG_LEN = 32
 
+# how many requests hid_send_many keeps in flight before waiting for a response
+PIPELINE_WINDOW = 4
+
 # these should match what we have in vial-qmk/keyboards/vial_example
 # so that people don't accidentally reuse a sample keyboard UID
 EXAMPLE_KEYBOARDS = [
@@ -38,6 +42,10 @@ EXAMPLE_KEYBOARDS = [
 EXAMPLE_KEYBOARD_PREFIX = 0xA6867BDFD3B00F
 
 
+def is_example_keyboard(keyboard_id):
+    return keyboard_id in EXAMPLE_KEYBOARDS or (keyboard_id & 0xFFFFFFFFFFFFFF) == EXAMPLE_KEYBOARD_PREFIX
+
+
 def hid_send(dev, msg, retries=1):
     if len(msg) > MSG_LEN:
         raise RuntimeError("message must be less than 32 bytes")
@@ -45,36 +53,110 @@ def hid_send(dev, msg, retries=1):
 
     data = b""
     first = True
+    attempts = timeouts = 0
+    start = time.monotonic()
 
     while retries > 0:
         retries -= 1
         if not first:
             time.sleep(0.5)
         first = False
+        attempts += 1
         try:
+            start = time.monotonic()
             # add 00 at start for hidapi report id
             if dev.write(b"\x00" + msg) != MSG_LEN + 1:
                 continue
 
             data = bytes(dev.read(MSG_LEN, timeout_ms=500))
             if not data:
+                timeouts += 1
                 continue
         except OSError:
             continue
         break
 
+    STATS.record(msg, len(data), (time.monotonic() - start) * 1000, retries=max(attempts - 1, 0),
+                 timeouts=timeouts, failed=not data)
     if not data:
         raise RuntimeError("failed to communicate with the device")
     return data
 
 
-def is_rawhid(desc, quiet):
+def hid_send_many(dev, msgs, echo=0, window=PIPELINE_WINDOW, retries=1, send=None, timeout_ms=500,
+                  on_response=None, on_error=None):
+    """
+    Sends a batch of requests, keeping up to `window` of them in flight at once.
+
+    Responses are matched back to their requests by the first `echo` bytes, which the firmware copies
+    from the request (e.g. the >BHB header of CMD_VIA_KEYMAP_GET_BUFFER); with echo=0 only the order
+    of responses is relied upon. On a mismatch or a timeout the outstanding responses are drained and
+    the rest of the batch is sent in lockstep through `send`, which defaults to hid_send.
+
+    While pipelining, every read waits up to `timeout_ms`; each matched response is reported to
+    `on_response(msg, elapsed_ms)` and an OSError to `on_error(e)`, which may raise to abort the batch.
+    """
+
+    if send is None:
+        send = hid_send
+
+    padded = []
+    for msg in msgs:
+        if len(msg) > MSG_LEN:
+            raise RuntimeError("message must be less than 32 bytes")
+        padded.append(msg + b"\x00" * (MSG_LEN - len(msg)))
+
+    out = []
+    sent = 0
+    written = []
+    if window > 1:
+        try:
+            while len(out) < len(padded):
+                while sent < len(padded) and sent - len(out) < window:
+                    # add 00 at start for hidapi report id
+                    if dev.write(b"\x00" + padded[sent]) != MSG_LEN + 1:
+                        raise OSError("short write")
+                    written.append(time.monotonic())
+                    sent += 1
+
+                data = bytes(dev.read(MSG_LEN, timeout_ms=timeout_ms))
+                if not data or data[:echo] != padded[len(out)][:echo]:
+                    break
+                elapsed = (time.monotonic() - written[len(out)]) * 1000
+                STATS.record(padded[len(out)], len(data), elapsed)
+                if on_response is not None:
+                    on_response(padded[len(out)], elapsed)
+                out.append(data)
+        except OSError as e:
+            if on_error is not None:
+                on_error(e)
+
+    if len(out) < len(padded):
+        if sent > len(out):
+            logging.warning("hid_send_many: pipelining failed after {}/{} responses, falling back to lockstep"
+                            .format(len(out), len(padded)))
+            # throw away whatever is still queued so that it doesn't get mistaken for a lockstep response
+            try:
+                while dev.read(MSG_LEN, timeout_ms=50):
+                    pass
+            except OSError:
+                pass
+        for msg in padded[len(out):]:
+            out.append(send(dev, msg, retries=retries))
+
+    return out
+
+
+def is_rawhid_usage(desc, quiet):
     if desc["usage_page"] != 0xFF60 or desc["usage"] != 0x61:
         if not quiet:
             logging.warning("is_rawhid: {} does not match - usage_page={:04X} usage={:02X}".format(
                 desc["path"], desc["usage_page"], desc["usage"]))
         return False
+    return True
 
+
+def can_open_rawhid(desc, quiet):
     # there's no reason to check for permission issues on mac or windows
     # and mac won't let us reopen an opened device
     # so skip the rest of the checks for non-linux
@@ -94,38 +176,101 @@ def is_rawhid(desc, quiet):
     return True
 
 
-def find_vial_devices(via_stack_json, sideload_vid=None, sideload_pid=None, quiet=False):
-    from vial_device import VialBootloader, VialKeyboard, VialDummyKeyboard
+class DeviceRegistry:
+    """
+    Remembers the outcome of probing HID interfaces, keyed by (path, vid, pid, serial), so that a refresh
+    where nothing got plugged in or out doesn't have to reopen every device or build new VialDevice objects
+    """
+
+    def __init__(self):
+        self.devices = dict()
+        # interfaces which can never be a vial device, e.g. wrong usage page
+        self.rejected = set()
+        # sideloading or loading VIA definitions changes what matches, so everything has to be probed again;
+        # the definitions object itself is kept rather than its id(), which could be reused once it's freed
+        self.sideload = None
+        self.via_stack_json = None
+
+    def clear(self):
+        self.devices.clear()
+        self.rejected.clear()
+
+    def prune(self, present):
+        """ Forgets interfaces which are no longer plugged in """
+        for key in list(self.devices.keys()):
+            if key not in present:
+                del self.devices[key]
+        self.rejected &= present
+
+
+def match_vial_device(dev, via_stack_json, sideload_vid, sideload_pid):
+    """ Works out what kind of vial device an interface is based on its descriptor alone """
+    from vial_device import VialBootloader, VialKeyboard
+
+    if dev["vendor_id"] == sideload_vid and dev["product_id"] == sideload_pid:
+        return "sideload", True, lambda: VialKeyboard(dev, sideload=True)
+    elif VIAL_SERIAL_NUMBER_MAGIC in dev["serial_number"]:
+        return "vial serial magic", True, lambda: VialKeyboard(dev)
+    elif VIBL_SERIAL_NUMBER_MAGIC in dev["serial_number"]:
+        return "vibl serial magic", False, lambda: VialBootloader(dev)
+    elif str(dev["vendor_id"] * 65536 + dev["product_id"]) in via_stack_json["definitions"]:
+        return "VIA stack", True, lambda: VialKeyboard(dev, via_stack=True)
+    return None
+
+
+def find_vial_devices(via_stack_json, sideload_vid=None, sideload_pid=None, quiet=False, registry=None, hard=False):
+    """
+    Enumerates vial keyboards and bootloaders. With a registry, interfaces that were probed before are not
+    probed again unless hard is set, and the same VialDevice objects are returned for them.
+    """
+    from vial_device import VialDummyKeyboard
+
+    if registry is not None:
+        sideload = (sideload_vid, sideload_pid)
+        if hard or registry.sideload != sideload or registry.via_stack_json is not via_stack_json:
+            registry.clear()
+            registry.sideload = sideload
+            registry.via_stack_json = via_stack_json
 
     filtered = []
+    present = set()
     for dev in hid.enumerate():
-        if dev["vendor_id"] == sideload_vid and dev["product_id"] == sideload_pid:
-            if not quiet:
-                logging.info("Trying VID={:04X}, PID={:04X}, serial={}, path={} - sideload".format(
-                    dev["vendor_id"], dev["product_id"], dev["serial_number"], dev["path"]
-                ))
-            if is_rawhid(dev, quiet):
-                filtered.append(VialKeyboard(dev, sideload=True))
-        elif VIAL_SERIAL_NUMBER_MAGIC in dev["serial_number"]:
-            if not quiet:
-                logging.info("Matching VID={:04X}, PID={:04X}, serial={}, path={} - vial serial magic".format(
-                    dev["vendor_id"], dev["product_id"], dev["serial_number"], dev["path"]
-                ))
-            if is_rawhid(dev, quiet):
-                filtered.append(VialKeyboard(dev))
-        elif VIBL_SERIAL_NUMBER_MAGIC in dev["serial_number"]:
-            if not quiet:
-                logging.info("Matching VID={:04X}, PID={:04X}, serial={}, path={} - vibl serial magic".format(
-                    dev["vendor_id"], dev["product_id"], dev["serial_number"], dev["path"]
-                ))
-            filtered.append(VialBootloader(dev))
-        elif str(dev["vendor_id"] * 65536 + dev["product_id"]) in via_stack_json["definitions"]:
-            if not quiet:
-                logging.info("Matching VID={:04X}, PID={:04X}, serial={}, path={} - VIA stack".format(
-                    dev["vendor_id"], dev["product_id"], dev["serial_number"], dev["path"]
-                ))
-            if is_rawhid(dev, quiet):
-                filtered.append(VialKeyboard(dev, via_stack=True))
+        key = (dev["path"], dev["vendor_id"], dev["product_id"], dev["serial_number"])
+        present.add(key)
+        if registry is not None:
+            if key in registry.devices:
+                filtered.append(registry.devices[key])
+                continue
+            if key in registry.rejected:
+                continue
+
+        match = match_vial_device(dev, via_stack_json, sideload_vid, sideload_pid)
+        if match is None:
+            if registry is not None:
+                registry.rejected.add(key)
+            continue
+
+        reason, rawhid, create = match
+        if not quiet:
+            logging.info("{} VID={:04X}, PID={:04X}, serial={}, path={} - {}".format(
+                "Trying" if reason == "sideload" else "Matching",
+                dev["vendor_id"], dev["product_id"], dev["serial_number"], dev["path"], reason
+            ))
+        if rawhid and not is_rawhid_usage(dev, quiet):
+            if registry is not None:
+                registry.rejected.add(key)
+            continue
+        # failing to open may only be a matter of permissions not being set up yet, so don't remember that
+        if rawhid and not can_open_rawhid(dev, quiet):
+            continue
+
+        device = create()
+        if registry is not None:
+            registry.devices[key] = device
+        filtered.append(device)
+
+    if registry is not None:
+        registry.prune(present)
 
     if sideload_vid == sideload_pid == 0:
         filtered.append(VialDummyKeyboard())
@@ -145,11 +290,17 @@ def pad_for_vibl(msg):
     return msg + b"\x00" * (64 - len(msg))
 
 
+def app_data_dir(*subdirs):
+    """ Returns a directory under the application's local data location, creating it if needed """
+    directory = os.path.join(QStandardPaths.writableLocation(QStandardPaths.StandardLocation.AppLocalDataLocation),
+                             *subdirs)
+    pathlib.Path(directory).mkdir(parents=True, exist_ok=True)
+    return directory
+
+
 def init_logger():
     logging.basicConfig(level=logging.INFO)
-    directory = QStandardPaths.writableLocation(QStandardPaths.StandardLocation.AppLocalDataLocation)
-    pathlib.Path(directory).mkdir(parents=True, exist_ok=True)
-    path = os.path.join(directory, "vial.log")
+    path = os.path.join(app_data_dir(), "vial.log")
     handler = RotatingFileHandler(path, maxBytes=5 * 1024 * 1024, backupCount=5)
     handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(module)s:%(lineno)d - %(message)s"))
     logging.getLogger().addHandler(handler)
@@ -1,7 +1,11 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
+import sys
 import time
 
 from hidproxy import hid
+from protocol.capability_cache import CapabilityCache
+from protocol.definition_cache import DefinitionCache
+from protocol.io_worker import DeviceWorker
 from protocol.keyboard_comm import Keyboard, ProtocolError
 from protocol.dummy_keyboard import DummyKeyboard
 from util import MSG_LEN, pad_for_vibl
@@ -15,7 +19,7 @@ class VialDevice:
         self.sideload = False
         self.via_stack = False
 
-    def open(self, override_json=None):
+    def open(self, override_json=None, on_stage=None):
         self.dev = hid.device()
         for x in range(10):
             try:
@@ -45,27 +49,32 @@ class VialKeyboard(VialDevice):
         self.via_stack = via_stack
         self.keyboard = None
 
-    def open(self, override_json=None):
+    def open(self, override_json=None, on_stage=None):
         super().open(override_json)
         try:
-            self.keyboard = Keyboard(self.dev)
-            self.keyboard.reload(override_json)
+            self.keyboard = Keyboard(self.dev, definition_cache=DefinitionCache.default(),
+                                     capability_cache=CapabilityCache.default())
+            # the web build has no threads, everything else talks to the device from a dedicated one
+            if sys.platform != "emscripten":
+                self.keyboard.attach_worker(DeviceWorker(self.keyboard.usb_send, self.keyboard.usb_send_many))
+                self.keyboard.lazy_keymap = True
+            self.keyboard.reload(override_json, on_stage)
         except ProtocolError:
             # Unsupported protocol/version on this interface; close handle and
             # propagate exception so caller can handle it gracefully.
-            try:
-                self.dev.close()
-            except Exception:
-                pass
+            self.close()
             raise
         except Exception:
             # Ensure device handle is closed on any other error during open
-            try:
-                self.dev.close()
-            except Exception:
-                pass
+            self.close()
             raise
 
+    def close(self):
+        if self.keyboard is not None and self.keyboard.worker is not None:
+            self.keyboard.worker.stop()
+            self.keyboard.worker = None
+        super().close()
+
     def title(self):
         s = "{} {}".format(self.desc["manufacturer_string"], self.desc["product_string"]).strip()
         if self.sideload:
@@ -107,9 +116,9 @@ class VialDummyKeyboard(VialKeyboard):
         self.sideload = True
         self.desc = {"path": "/dummy/keyboard"}
 
-    def open(self, override_json=None):
+    def open(self, override_json=None, on_stage=None):
         self.keyboard = DummyKeyboard(None, usb_send=self.raise_usb_send)
-        self.keyboard.reload(override_json)
+        self.keyboard.reload(override_json, on_stage)
 
     def title(self):
         return "[Dummy Keyboard]"
@@ -1,5 +1,7 @@
-from PyQt6.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout
-from PyQt6.QtCore import pyqtSignal
+from PyQt6.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QLabel
+from PyQt6.QtCore import pyqtSignal, Qt
+
+from util import tr
 
 
 class EditorContainer(QWidget):
@@ -15,3 +17,17 @@ class EditorContainer(QWidget):
 
     def mousePressEvent(self, ev):
         self.clicked.emit()
+
+
+class EditorPlaceholder(QWidget):
+    """ Takes the place of an editor in the tabs until the keyboard data it shows has been loaded """
+
+    def __init__(self):
+        super().__init__()
+
+        self.editor = None
+        label = QLabel(tr("EditorPlaceholder", "Loading..."))
+        label.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        layout = QVBoxLayout()
+        layout.addWidget(label)
+        self.setLayout(layout)
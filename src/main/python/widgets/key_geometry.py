@@ -0,0 +1,119 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import math
+
+from constants import KEY_SIZE_RATIO, KEY_SPACING_RATIO, KEYBOARD_WIDGET_MASK_HEIGHT, SHADOW_SIDE_PADDING, \
+    SHADOW_TOP_PADDING, SHADOW_BOTTOM_PADDING, KEYBOARD_WIDGET_NONMASK_PADDING
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# below this many keys numpy costs more to set up than it saves
+NUMPY_MIN_KEYS = 16
+
+DESC_FIELDS = ("x", "y", "width", "height", "x2", "y2", "width2", "height2",
+               "rotation_x", "rotation_y", "rotation_angle")
+
+
+class ScalarMath:
+
+    round = staticmethod(round)
+    snap = staticmethod(lambda v: round(v, 15))
+    minimum = staticmethod(min)
+    sin = staticmethod(math.sin)
+    cos = staticmethod(math.cos)
+    radians = staticmethod(math.radians)
+
+
+class ArrayMath:
+
+    # both this and the builtin round() round halves to even
+    round = staticmethod(lambda a: numpy.rint(a))
+    snap = staticmethod(lambda a: numpy.round(a, 15))
+    minimum = staticmethod(lambda a, b: numpy.minimum(a, b))
+    sin = staticmethod(lambda a: numpy.sin(a))
+    cos = staticmethod(lambda a: numpy.cos(a))
+    radians = staticmethod(lambda a: numpy.radians(a))
+
+
+class KeyShape:
+    """ Geometry of one key at one scale, in its own coordinates: before the widget shifts it into place """
+
+    def __init__(self, values):
+        (self.size, self.x, self.y, self.w, self.h, self.x2, self.y2, self.w2, self.h2,
+         self.rotation_x, self.rotation_y) = values[:11]
+        self.rect, self.rect2, self.text_rect, self.nonmask_rect, self.mask_rect = \
+            [tuple(int(v) for v in values[x:x + 4]) for x in range(11, 31, 4)]
+        # rotated corners of rect, rect2 and mask_rect
+        self.corners, self.corners2, self.mask_corners = \
+            [list(zip(values[x:x + 8:2], values[x + 1:x + 8:2])) for x in range(31, 55, 8)]
+        # top left of the outline's bounding box
+        self.left, self.top = values[55:57]
+
+
+def calculate(m, d, scale):
+    """ Computes every value of a KeyShape, for one key given scalars or for all keys given arrays """
+
+    size = scale * (KEY_SIZE_RATIO + KEY_SPACING_RATIO)
+    spacing = scale * KEY_SPACING_RATIO
+
+    x = size * d["x"]
+    y = size * d["y"]
+    w = size * d["width"] - spacing
+    h = size * d["height"] - spacing
+    x2 = x + size * d["x2"]
+    y2 = y + size * d["y2"]
+    w2 = size * d["width2"] - spacing
+    h2 = size * d["height2"] - spacing
+    rotation_x = size * d["rotation_x"]
+    rotation_y = size * d["rotation_y"]
+
+    rect = [m.round(x), m.round(y), m.round(w), m.round(h)]
+    rect2 = [m.round(x2), m.round(y2), m.round(w2), m.round(h2)]
+    text_rect = [rect[0], m.round(y + size * SHADOW_TOP_PADDING), rect[2],
+                 m.round(h - size * (SHADOW_BOTTOM_PADDING + SHADOW_TOP_PADDING))]
+    nonmask_rect = [rect[0], m.round(y + size * KEYBOARD_WIDGET_NONMASK_PADDING), rect[2],
+                    m.round(h * (1 - KEYBOARD_WIDGET_MASK_HEIGHT))]
+    mask_rect = [m.round(x + size * SHADOW_SIDE_PADDING), m.round(y + h * (1 - KEYBOARD_WIDGET_MASK_HEIGHT)),
+                 m.round(w - 2 * size * SHADOW_SIDE_PADDING),
+                 m.round(h * KEYBOARD_WIDGET_MASK_HEIGHT - size * SHADOW_BOTTOM_PADDING)]
+
+    angle = m.radians(d["rotation_angle"])
+    # exact for right angles like QTransform.rotate, so that rotated edges stay parallel
+    sin, cos = m.snap(m.sin(angle)), m.snap(m.cos(angle))
+
+    def corners(r):
+        # same corners as QRect gives, which are inclusive of the last pixel
+        x1, y1 = r[0], r[1]
+        xe, ye = r[0] + r[2] - 1, r[1] + r[3] - 1
+        out = []
+        for px, py in ((x1, y1), (x1, ye), (xe, ye), (xe, y1)):
+            px, py = px - rotation_x, py - rotation_y
+            out += [px * cos - py * sin + rotation_x, px * sin + py * cos + rotation_y]
+        return out
+
+    outline = corners(rect)
+    outline2 = corners(rect2)
+    left, top = outline[0], outline[1]
+    for v in range(2, 8, 2):
+        left = m.minimum(left, outline[v])
+        top = m.minimum(top, outline[v + 1])
+    for v in range(0, 8, 2):
+        left = m.minimum(left, outline2[v])
+        top = m.minimum(top, outline2[v + 1])
+
+    return [size, x, y, w, h, x2, y2, w2, h2, rotation_x, rotation_y] + rect + rect2 + text_rect \
+        + nonmask_rect + mask_rect + outline + outline2 + corners(mask_rect) + [left, top]
+
+
+def key_shapes(descs, scale):
+    """ Returns a KeyShape for every KLE key, computed in one batch with numpy when it's available """
+
+    if numpy is not None and len(descs) >= NUMPY_MIN_KEYS:
+        d = {field: numpy.array([getattr(desc, field) for desc in descs], dtype=float) for field in DESC_FIELDS}
+        columns = [numpy.broadcast_to(v, len(descs)).tolist() for v in calculate(ArrayMath, d, scale)]
+        return [KeyShape(values) for values in zip(*columns)]
+
+    return [KeyShape(calculate(ScalarMath, {field: getattr(desc, field) for field in DESC_FIELDS}, scale))
+            for desc in descs]
@@ -1,18 +1,26 @@
-from collections import defaultdict
+import math
+from collections import defaultdict, OrderedDict
 
-from PyQt6.QtGui import QPainter, QColor, QPainterPath, QTransform, QBrush, QPolygonF, QPalette
+from PyQt6.QtGui import QPainter, QColor, QPainterPath, QTransform, QBrush, QPolygonF, QPalette, QPixmap, QPen
 from PyQt6.QtWidgets import QWidget, QToolTip, QApplication
 from PyQt6.QtCore import Qt, QSize, QRect, QPointF, pyqtSignal, QEvent, QRectF
 
-from constants import KEY_SIZE_RATIO, KEY_SPACING_RATIO, KEYBOARD_WIDGET_PADDING, \
-    KEYBOARD_WIDGET_MASK_HEIGHT, KEY_ROUNDNESS, SHADOW_SIDE_PADDING, SHADOW_TOP_PADDING, SHADOW_BOTTOM_PADDING, \
-    KEYBOARD_WIDGET_NONMASK_PADDING
+from constants import KEYBOARD_WIDGET_PADDING, KEY_ROUNDNESS, SHADOW_SIDE_PADDING, SHADOW_TOP_PADDING, \
+    SHADOW_BOTTOM_PADDING
 from themes import Theme
+from widgets.key_geometry import key_shapes, DESC_FIELDS
 
 
 class KeyWidget:
 
-    def __init__(self, desc, scale, shift_x=0, shift_y=0):
+    # everything update_position computes, which widgets showing the same keys can share
+    GEOMETRY_ATTRS = ("scale", "shape", "size", "rotation_x", "rotation_y", "x", "y", "w", "h", "x2", "y2", "w2",
+                      "h2", "rect", "text_rect", "rect2", "corner", "background_draw_path", "foreground_draw_path",
+                      "extra_draw_path", "nonmask_rect", "mask_rect", "paint_rect", "rotated_paint_rect",
+                      "tile_geometry", "shift_x", "shift_y", "bbox", "bbox2", "polygon", "polygon2", "mask_bbox",
+                      "mask_polygon", "paint_bbox")
+
+    def __init__(self, desc, scale=None, shift_x=0, shift_y=0):
         self.active = False
         self.on = False
         self.masked = False
@@ -24,98 +32,104 @@ class KeyWidget:
         self.color = None
         self.mask_color = None
         self.scale = 0
+        self.shift_x = self.shift_y = None
 
         self.rotation_angle = desc.rotation_angle
 
         self.has2 = desc.width2 != desc.width or desc.height2 != desc.height or desc.x2 != 0 or desc.y2 != 0
 
-        self.update_position(scale, shift_x, shift_y)
+        # without a scale, geometry is left for KeyboardWidget to set up for all keys at once
+        if scale is not None:
+            self.update_position(scale, shift_x, shift_y)
 
     def update_position(self, scale, shift_x=0, shift_y=0):
-        if self.scale != scale or self.shift_x != shift_x or self.shift_y != shift_y:
-            self.scale = scale
-            self.size = self.scale * (KEY_SIZE_RATIO + KEY_SPACING_RATIO)
-            spacing = self.scale * KEY_SPACING_RATIO
-
-            self.rotation_x = self.size * self.desc.rotation_x
-            self.rotation_y = self.size * self.desc.rotation_y
-
+        if self.scale != scale:
+            self.set_shape(scale, key_shapes([self.desc], scale)[0])
+        if self.shift_x != shift_x or self.shift_y != shift_y:
             self.shift_x = shift_x
             self.shift_y = shift_y
-            self.x = self.size * self.desc.x
-            self.y = self.size * self.desc.y
-            self.w = self.size * self.desc.width - spacing
-            self.h = self.size * self.desc.height - spacing
-
-            self.rect = QRect(
-                round(self.x),
-                round(self.y),
-                round(self.w),
-                round(self.h)
-            )
-            self.text_rect = QRect(
-                round(self.x),
-                round(self.y + self.size * SHADOW_TOP_PADDING),
-                round(self.w),
-                round(self.h - self.size * (SHADOW_BOTTOM_PADDING + SHADOW_TOP_PADDING))
-            )
+            self.place()
 
-            self.x2 = self.x + self.size * self.desc.x2
-            self.y2 = self.y + self.size * self.desc.y2
-            self.w2 = self.size * self.desc.width2 - spacing
-            self.h2 = self.size * self.desc.height2 - spacing
-
-            self.rect2 = QRect(
-                round(self.x2),
-                round(self.y2),
-                round(self.w2),
-                round(self.h2)
-            )
+    def set_shape(self, scale, shape):
+        """ Takes geometry at a new scale, usually computed in one batch for the whole keyboard by key_shapes """
 
-            self.bbox = self.calculate_bbox(self.rect)
-            self.bbox2 = self.calculate_bbox(self.rect2)
-            self.polygon = QPolygonF(self.bbox + [self.bbox[0]])
-            self.polygon2 = QPolygonF(self.bbox2 + [self.bbox2[0]])
+        self.scale = scale
+        self.shape = shape
+        self.size = shape.size
+        self.rotation_x = shape.rotation_x
+        self.rotation_y = shape.rotation_y
+        self.x, self.y, self.w, self.h = shape.x, shape.y, shape.w, shape.h
+        self.x2, self.y2, self.w2, self.h2 = shape.x2, shape.y2, shape.w2, shape.h2
+
+        self.rect = QRect(*shape.rect)
+        self.text_rect = QRect(*shape.text_rect)
+        self.rect2 = QRect(*shape.rect2)
+
+        self.corner = self.size * KEY_ROUNDNESS
+        self.background_draw_path = self.calculate_background_draw_path()
+        self.foreground_draw_path = self.calculate_foreground_draw_path()
+        self.extra_draw_path = self.calculate_extra_draw_path()
+
+        # calculate areas where the inner keycode will be located
+        # nonmask = outer (e.g. Rsft_T)
+        # mask = inner (e.g. KC_A)
+        self.nonmask_rect = QRect(*shape.nonmask_rect)
+        self.mask_rect = QRect(*shape.mask_rect)
+
+        # area painted for this key in its own, unrotated coordinates, with room for the selection outline
+        self.paint_rect = self.background_draw_path.boundingRect()
+        if not self.extra_draw_path.isEmpty():
+            self.paint_rect = self.paint_rect.united(self.extra_draw_path.boundingRect())
+        self.paint_rect.adjust(-2, -2, 2, 2)
+        self.rotated_paint_rect = self.calculate_transform().mapRect(self.paint_rect)
+        self.tile_geometry = self.calculate_tile_geometry()
+
+        # geometry in widget coordinates has to follow
+        self.shift_x = self.shift_y = None
+
+    def place(self):
+        """ Moves the outlines computed by set_shape to the current shift """
+
+        def shifted(corners):
+            return [QPointF(x + self.shift_x, y + self.shift_y) for x, y in corners]
+
+        self.bbox = shifted(self.shape.corners)
+        self.bbox2 = shifted(self.shape.corners2)
+        self.polygon = QPolygonF(self.bbox + [self.bbox[0]])
+        self.polygon2 = QPolygonF(self.bbox2 + [self.bbox2[0]])
+        if self.has2:
             self.polygon = self.polygon.united(self.polygon2)
-            self.corner = self.size * KEY_ROUNDNESS
-            self.background_draw_path = self.calculate_background_draw_path()
-            self.foreground_draw_path = self.calculate_foreground_draw_path()
-            self.extra_draw_path = self.calculate_extra_draw_path()
-
-            # calculate areas where the inner keycode will be located
-            # nonmask = outer (e.g. Rsft_T)
-            # mask = inner (e.g. KC_A)
-            self.nonmask_rect = QRect(
-                round(self.x),
-                round(self.y + self.size * KEYBOARD_WIDGET_NONMASK_PADDING),
-                round(self.w),
-                round(self.h * (1 - KEYBOARD_WIDGET_MASK_HEIGHT))
-            )
-            self.mask_rect = QRect(
-                round(self.x + self.size * SHADOW_SIDE_PADDING),
-                round(self.y + self.h * (1 - KEYBOARD_WIDGET_MASK_HEIGHT)),
-                round(self.w - 2 * self.size * SHADOW_SIDE_PADDING),
-                round(self.h * KEYBOARD_WIDGET_MASK_HEIGHT - self.size * SHADOW_BOTTOM_PADDING)
-            )
-            self.mask_bbox = self.calculate_bbox(self.mask_rect)
-            self.mask_polygon = QPolygonF(self.mask_bbox + [self.mask_bbox[0]])
-
-    def calculate_bbox(self, rect):
-        x1 = rect.topLeft().x()
-        y1 = rect.topLeft().y()
-        x2 = rect.bottomRight().x()
-        y2 = rect.bottomRight().y()
-        points = [(x1, y1), (x1, y2), (x2, y2), (x2, y1)]
-        bbox = []
-        for p in points:
-            t = QTransform()
-            t.translate(self.shift_x, self.shift_y)
-            t.translate(self.rotation_x, self.rotation_y)
-            t.rotate(self.rotation_angle)
-            t.translate(-self.rotation_x, -self.rotation_y)
-            p = t.map(QPointF(p[0], p[1]))
-            bbox.append(p)
-        return bbox
+        self.mask_bbox = shifted(self.shape.mask_corners)
+        self.mask_polygon = QPolygonF(self.mask_bbox + [self.mask_bbox[0]])
+        self.paint_bbox = self.rotated_paint_rect.translated(self.shift_x, self.shift_y)
+
+    def geometry(self):
+        return {attr: getattr(self, attr) for attr in self.GEOMETRY_ATTRS}
+
+    def set_geometry(self, geometry):
+        """ Takes geometry computed for another widget of the same key, which is never modified in place """
+        for attr, value in geometry.items():
+            setattr(self, attr, value)
+
+    def calculate_transform(self):
+        """ Rotation of this key, in unshifted coordinates """
+        t = QTransform()
+        t.translate(self.rotation_x, self.rotation_y)
+        t.rotate(self.rotation_angle)
+        t.translate(-self.rotation_x, -self.rotation_y)
+        return t
+
+    def calculate_tile_geometry(self):
+        """ Shape of this key relative to its paint_rect, keys which look the same share cached tiles """
+        ox, oy = self.paint_rect.x(), self.paint_rect.y()
+        shape = [type(self).__name__, self.corner]
+        for path in (self.background_draw_path, self.foreground_draw_path, self.extra_draw_path):
+            for x in range(path.elementCount()):
+                el = path.elementAt(x)
+                shape.append((el.type.value, round(el.x - ox, 3), round(el.y - oy, 3)))
+        for rect in (self.text_rect, self.nonmask_rect, self.mask_rect):
+            shape.append((rect.x() - ox, rect.y() - oy, rect.width(), rect.height()))
+        return tuple(shape)
 
     def calculate_background_draw_path(self):
         path = QPainterPath()
@@ -248,6 +262,132 @@ class EncoderWidget(KeyWidget):
         return "EncoderWidget"
 
 
+class KeyIndex:
+    """ Uniform grid over the outlines of placed keys, so hit testing only looks at keys near the point """
+
+    def __init__(self, keys, cell):
+        self.cell = cell
+        self.cells = defaultdict(list)
+        # keys are added in order, which keeps the lookup order of a plain scan over them
+        for key in keys:
+            r = key.polygon.boundingRect()
+            for cx in range(math.floor(r.left() / cell), math.floor(r.right() / cell) + 1):
+                for cy in range(math.floor(r.top() / cell), math.floor(r.bottom() / cell) + 1):
+                    self.cells[(cx, cy)].append(key)
+
+    def candidates(self, pt):
+        return self.cells.get((math.floor(pt.x() / self.cell), math.floor(pt.y() / self.cell)), ())
+
+
+class KeycapPalette:
+    """ Pens and brushes for drawing keycaps, built once per theme rather than on every paint """
+
+    current_palette = None
+
+    def __init__(self, key):
+        self.key = key
+        palette = QApplication.palette()
+        button = palette.color(QPalette.ColorRole.Button)
+        highlight = palette.color(QPalette.ColorRole.Highlight)
+
+        self.text_color = palette.color(QPalette.ColorRole.ButtonText)
+        self.background = QBrush(button)
+        self.foreground = QBrush(button.lighter(120))
+        self.mask = QBrush(button.lighter(Theme.mask_light_factor()))
+        self.extra = QBrush(self.text_color)
+        self.background_pressed = QBrush(highlight)
+        self.foreground_pressed = QBrush(highlight.lighter(120))
+        self.background_on = QBrush(highlight.darker(150))
+        self.foreground_on = QBrush(highlight.darker(120))
+
+        # for currently selected keycap
+        self.active_pen = QPen(highlight)
+        self.active_pen.setWidthF(1.5)
+
+    @classmethod
+    def get(cls):
+        key = (QApplication.palette().cacheKey(), Theme.mask_light_factor())
+        if cls.current_palette is None or cls.current_palette.key != key:
+            cls.current_palette = cls(key)
+        return cls.current_palette
+
+
+class KeycapCache:
+    """
+    Least recently used cache of rendered keycaps. Tiles are keyed by everything that affects how a keycap
+    looks, so keys of the same shape and legend share a tile and repainting an unchanged key is one blit.
+    """
+
+    def __init__(self, limit=32 * 1024 * 1024):
+        self.limit = limit
+        self.size = 0
+        self.tiles = OrderedDict()
+
+    def get(self, key):
+        tile = self.tiles.get(key)
+        if tile is not None:
+            self.tiles.move_to_end(key)
+        return tile
+
+    def put(self, key, tile):
+        if key in self.tiles:
+            self.size -= self.tile_size(self.tiles.pop(key))
+        self.tiles[key] = tile
+        self.size += self.tile_size(tile)
+        while self.size > self.limit and len(self.tiles) > 1:
+            self.size -= self.tile_size(self.tiles.popitem(last=False)[1])
+
+    def clear(self):
+        self.tiles.clear()
+        self.size = 0
+
+    @staticmethod
+    def tile_size(tile):
+        return tile.width() * tile.height() * 4
+
+
+# tiles of all keyboard widgets
+KEYCAP_CACHE = KeycapCache()
+
+
+class GeometryCache:
+    """
+    Least recently used cache of placed key geometry, keyed by the keys, layout options, font scale and padding.
+    Every view of a keyboard (keymap, matrix tester, layout preview, unlock dialog) builds its own key widgets
+    for their state and legends, but the geometry of those is the same and only computed by the first view.
+    """
+
+    def __init__(self, limit=32):
+        self.limit = limit
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.limit:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+# geometry of all keyboard widgets
+GEOMETRY_CACHE = GeometryCache()
+
+# what a key's geometry depends on
+DEFINITION_FIELDS = DESC_FIELDS + ("layout_index", "layout_option", "decal")
+
+
+def color_key(color):
+    return None if color is None else color.rgba()
+
+
 class KeyboardWidget(QWidget):
 
     clicked = pyqtSignal()
@@ -275,6 +415,8 @@ class KeyboardWidget(QWidget):
         self.widgets = []
 
         self.width = self.height = 0
+        self.definition = ()
+        self.index = KeyIndex([], 1)
         self.active_key = None
         self.active_mask = False
 
@@ -286,23 +428,36 @@ class KeyboardWidget(QWidget):
         self.update_layout()
 
     def add_keys(self, keys):
-        scale_factor = self.fontMetrics().height()
-
         for key, cls in keys:
             if key.layout_index == -1:
-                self.common_widgets.append(cls(key, scale_factor))
+                self.common_widgets.append(cls(key))
             else:
-                self.widgets_for_layout.append(cls(key, scale_factor))
+                self.widgets_for_layout.append(cls(key))
+
+        # identifies the keys for GEOMETRY_CACHE, in the order of common_widgets + widgets_for_layout
+        self.definition = tuple(
+            (type(widget).__name__, getattr(widget.desc, "encoder_dir", None))
+            + tuple(getattr(widget.desc, field) for field in DEFINITION_FIELDS)
+            for widget in self.common_widgets + self.widgets_for_layout)
+
+    def layout_options(self):
+        indices = sorted(set(widget.desc.layout_index for widget in self.widgets_for_layout))
+        return tuple(self.layout_editor.get_choice(idx) for idx in indices)
 
     def place_widgets(self):
         scale_factor = self.fontMetrics().height()
 
-        self.widgets = []
+        # geometry of every key which isn't at this scale yet, computed in one batch
+        stale = [widget for widget in self.common_widgets + self.widgets_for_layout if widget.scale != scale_factor]
+        for widget, shape in zip(stale, key_shapes([widget.desc for widget in stale], scale_factor)):
+            widget.set_shape(scale_factor, shape)
+
+        # (widget, shift_x, shift_y) for widgets in the current layout
+        placed = []
 
         # place common widgets, that is, ones which are always displayed and require no extra transforms
         for widget in self.common_widgets:
-            widget.update_position(scale_factor)
-            self.widgets.append(widget)
+            placed.append((widget, 0, 0))
 
         # top-left position for specific layout
         layout_x = defaultdict(lambda: defaultdict(lambda: 1e6))
@@ -310,11 +465,9 @@ class KeyboardWidget(QWidget):
 
         # determine top-left position for every layout option
         for widget in self.widgets_for_layout:
-            widget.update_position(scale_factor)
             idx, opt = widget.desc.layout_index, widget.desc.layout_option
-            p = widget.polygon.boundingRect().topLeft()
-            layout_x[idx][opt] = min(layout_x[idx][opt], p.x())
-            layout_y[idx][opt] = min(layout_y[idx][opt], p.y())
+            layout_x[idx][opt] = min(layout_x[idx][opt], widget.shape.left)
+            layout_y[idx][opt] = min(layout_y[idx][opt], widget.shape.top)
 
         # obtain widgets for all layout options now that we know how to shift them
         for widget in self.widgets_for_layout:
@@ -322,29 +475,55 @@ class KeyboardWidget(QWidget):
             if opt == self.layout_editor.get_choice(idx):
                 shift_x = layout_x[idx][opt] - layout_x[idx][0]
                 shift_y = layout_y[idx][opt] - layout_y[idx][0]
-                widget.update_position(scale_factor, -shift_x, -shift_y)
-                self.widgets.append(widget)
+                placed.append((widget, -shift_x, -shift_y))
 
         # at this point some widgets on left side might be cutoff, or there may be too much empty space
         # calculate top left position of visible widgets and shift everything around
         top_x = top_y = 1e6
-        for widget in self.widgets:
+        for widget, shift_x, shift_y in placed:
             if not widget.desc.decal:
-                p = widget.polygon.boundingRect().topLeft()
-                top_x = min(top_x, p.x())
-                top_y = min(top_y, p.y())
-        for widget in self.widgets:
-            widget.update_position(widget.scale, widget.shift_x - top_x + self.padding,
-                                   widget.shift_y - top_y + self.padding)
+                top_x = min(top_x, widget.shape.left + shift_x)
+                top_y = min(top_y, widget.shape.top + shift_y)
+
+        self.widgets = []
+        for widget, shift_x, shift_y in placed:
+            widget.update_position(scale_factor, shift_x - top_x + self.padding, shift_y - top_y + self.padding)
+            self.widgets.append(widget)
 
     def update_layout(self):
-        """ Updates self.widgets for the currently active layout """
+        """
+        Updates self.widgets and their geometry for the currently active layout. Only needed when keys,
+        layout options or the font change; a change of pressed/on state or legends only needs update_keys
+        """
+
+        keys = self.common_widgets + self.widgets_for_layout
+        cache_key = (self.definition, self.layout_options(), self.fontMetrics().height(), self.padding)
+        placed = GEOMETRY_CACHE.get(cache_key)
+        if placed is None:
+            # determine widgets for current layout
+            self.place_widgets()
+            self.widgets = list(filter(lambda w: not w.desc.decal, self.widgets))
+
+            self.widgets.sort(key=lambda w: (w.y, w.x))
+
+            positions = {widget: x for x, widget in enumerate(keys)}
+            GEOMETRY_CACHE.put(cache_key, [(positions[widget], widget.geometry()) for widget in self.widgets])
+        else:
+            # another view of the same keys got here first
+            self.widgets = []
+            for x, geometry in placed:
+                keys[x].set_geometry(geometry)
+                self.widgets.append(keys[x])
+
+        if self.widgets:
+            self.index = KeyIndex(self.widgets, self.widgets[0].size)
+        else:
+            self.index = KeyIndex([], 1)
 
-        # determine widgets for current layout
-        self.place_widgets()
-        self.widgets = list(filter(lambda w: not w.desc.decal, self.widgets))
+        self.update_size()
 
-        self.widgets.sort(key=lambda w: (w.y, w.x))
+    def update_size(self):
+        """ Updates the size of the widget for the current scale, key geometry stays as is """
 
         # determine maximum width and height of container
         max_w = max_h = 0
@@ -362,123 +541,134 @@ class KeyboardWidget(QWidget):
     def paintEvent(self, event):
         qp = QPainter()
         qp.begin(self)
-        try:
-            qp.setRenderHint(QPainter.RenderHint.Antialiasing)
-        except Exception:
-            qp.setRenderHint(QPainter.Antialiasing)
 
-        # for regular keycaps
-        regular_pen = qp.pen()
-        regular_pen.setColor(QApplication.palette().color(QPalette.ColorRole.ButtonText))
-        qp.setPen(regular_pen)
+        palette = KeycapPalette.get()
+        font_key = self.font().key()
+        region = event.region()
+        for key in self.widgets:
+            # only keys within the area being repainted, which is usually just the keys that changed
+            if region.intersects(self.key_bounds(key)):
+                self.draw_key(qp, key, palette, font_key)
+
+        qp.end()
 
-        background_brush = QBrush()
-        background_brush.setColor(QApplication.palette().color(QPalette.ColorRole.Button))
-        background_brush.setStyle(Qt.BrushStyle.SolidPattern)
+    def key_bounds(self, key):
+        """ Area of the widget covered by this key """
+        r = key.paint_bbox
+        return QRectF(r.x() * self.scale, r.y() * self.scale,
+                      r.width() * self.scale, r.height() * self.scale).toAlignedRect().adjusted(-1, -1, 1, 1)
 
-        foreground_brush = QBrush()
-        foreground_brush.setColor(QApplication.palette().color(QPalette.ColorRole.Button).lighter(120))
-        foreground_brush.setStyle(Qt.BrushStyle.SolidPattern)
+    def update_keys(self, keys):
+        """ Schedules a repaint of just these keys, for changes to their state or legend """
+        for key in keys:
+            self.update(self.key_bounds(key))
 
-        mask_brush = QBrush()
-        mask_brush.setColor(QApplication.palette().color(QPalette.ColorRole.Button).lighter(Theme.mask_light_factor()))
-        mask_brush.setStyle(Qt.BrushStyle.SolidPattern)
+    def draw_key(self, qp, key, palette, font_key):
+        active = key.active or (self.active_key == key and not self.active_mask)
+        mask_active = key.masked and self.active_key == key and self.active_mask
 
-        # for currently selected keycap
-        active_pen = qp.pen()
-        active_pen.setColor(QApplication.palette().color(QPalette.ColorRole.Highlight))
-        active_pen.setWidthF(1.5)
-
-        # for the encoder arrow
-        extra_pen = regular_pen
-        extra_brush = QBrush()
-        extra_brush.setColor(QApplication.palette().color(QPalette.ColorRole.ButtonText))
-        extra_brush.setStyle(Qt.BrushStyle.SolidPattern)
-
-        # for pressed keycaps
-        background_pressed_brush = QBrush()
-        background_pressed_brush.setColor(QApplication.palette().color(QPalette.ColorRole.Highlight))
-        background_pressed_brush.setStyle(Qt.BrushStyle.SolidPattern)
-
-        foreground_pressed_brush = QBrush()
-        foreground_pressed_brush.setColor(QApplication.palette().color(QPalette.ColorRole.Highlight).lighter(120))
-        foreground_pressed_brush.setStyle(Qt.BrushStyle.SolidPattern)
-
-        background_on_brush = QBrush()
-        background_on_brush.setColor(QApplication.palette().color(QPalette.ColorRole.Highlight).darker(150))
-        background_on_brush.setStyle(Qt.BrushStyle.SolidPattern)
-
-        foreground_on_brush = QBrush()
-        foreground_on_brush.setColor(QApplication.palette().color(QPalette.ColorRole.Highlight).darker(120))
-        foreground_on_brush.setStyle(Qt.BrushStyle.SolidPattern)
-
-        mask_font = qp.font()
-        mask_font.setPointSize(round(mask_font.pointSize() * 0.9))
-        mask_font.setStyleStrategy(mask_font.StyleStrategy.PreferAntialias)
-        mask_font.setFixedPitch(False)
-
-        for idx, key in enumerate(self.widgets):
+        if key.rotation_angle:
+            # a rotated tile would have to be resampled, which blurs it; rotated keys are few enough to paint directly
             qp.save()
-
-            qp.scale(self.scale, self.scale)
-            qp.translate(key.shift_x, key.shift_y)
-            qp.translate(key.rotation_x, key.rotation_y)
+            qp.setRenderHint(QPainter.RenderHint.Antialiasing)
+            qp.setFont(self.font())
+            qp.translate((key.shift_x + key.rotation_x) * self.scale, (key.shift_y + key.rotation_y) * self.scale)
             qp.rotate(key.rotation_angle)
-            qp.translate(-key.rotation_x, -key.rotation_y)
-
-            active = key.active or (self.active_key == key and not self.active_mask)
-
-            # draw keycap background/drop-shadow
-            try:
-                qp.setPen(active_pen if active else Qt.PenStyle.NoPen)
-            except Exception:
-                qp.setPen(active_pen if active else Qt.NoPen)
-            brush = background_brush
-            if key.pressed:
-                brush = background_pressed_brush
-            elif key.on:
-                brush = background_on_brush
-            qp.setBrush(brush)
-            qp.drawPath(key.background_draw_path)
-
-            # draw keycap foreground
-            qp.setPen(Qt.PenStyle.NoPen)
-            brush = foreground_brush
-            if key.pressed:
-                brush = foreground_pressed_brush
-            elif key.on:
-                brush = foreground_on_brush
-            qp.setBrush(brush)
-            qp.drawPath(key.foreground_draw_path)
-
-            # draw key text
-            if key.masked:
-                # draw the outer legend
-                qp.setFont(mask_font)
-                qp.setPen(key.color if key.color else regular_pen)
-                qp.drawText(key.nonmask_rect, Qt.AlignmentFlag.AlignCenter, key.text)
-
-                # draw the inner highlight rect
-                qp.setPen(active_pen if self.active_key == key and self.active_mask else Qt.PenStyle.NoPen)
-                qp.setBrush(mask_brush)
-                qp.drawRoundedRect(key.mask_rect, key.corner, key.corner)
-
-                # draw the inner legend
-                qp.setPen(key.mask_color if key.mask_color else regular_pen)
-                qp.drawText(key.mask_rect, Qt.AlignmentFlag.AlignCenter, key.mask_text)
-            else:
-                # draw the legend
-                qp.setPen(key.color if key.color else regular_pen)
-                qp.drawText(key.text_rect, Qt.AlignmentFlag.AlignCenter, key.text)
-
-            # draw the extra shape (encoder arrow)
-            qp.setPen(extra_pen)
-            qp.setBrush(extra_brush)
-            qp.drawPath(key.extra_draw_path)
-
+            qp.translate(-key.rotation_x * self.scale, -key.rotation_y * self.scale)
+            qp.scale(self.scale, self.scale)
+            self.paint_key(qp, key, palette, active, mask_active)
             qp.restore()
+            return
+
+        # blit on whole device pixels so that legends stay sharp, the tile carries the subpixel offset
+        dpr = self.devicePixelRatioF()
+        rect = key.paint_rect
+        x = (key.shift_x + rect.x()) * self.scale * dpr
+        y = (key.shift_y + rect.y()) * self.scale * dpr
+        origin = QPointF(math.floor(x) / dpr, math.floor(y) / dpr)
+        frac_x = round((x - math.floor(x)) * 4) / 4
+        frac_y = round((y - math.floor(y)) * 4) / 4
+
+        tile_key = (key.tile_geometry, self.scale, dpr, frac_x, frac_y, palette.key, font_key,
+                    active, mask_active, bool(key.pressed), bool(key.on), key.masked, key.text, key.mask_text,
+                    color_key(key.color), color_key(key.mask_color))
+        tile = KEYCAP_CACHE.get(tile_key)
+        if tile is None:
+            tile = self.render_key(key, palette, dpr, frac_x, frac_y, active, mask_active)
+            KEYCAP_CACHE.put(tile_key, tile)
+        qp.drawPixmap(origin, tile)
+
+    def render_key(self, key, palette, dpr, frac_x, frac_y, active, mask_active):
+        rect = key.paint_rect
+        tile = QPixmap(math.ceil(rect.width() * self.scale * dpr) + 1, math.ceil(rect.height() * self.scale * dpr) + 1)
+        tile.setDevicePixelRatio(dpr)
+        tile.fill(Qt.GlobalColor.transparent)
 
+        qp = QPainter()
+        qp.begin(tile)
+        qp.setRenderHint(QPainter.RenderHint.Antialiasing)
+        qp.setFont(self.font())
+        qp.translate(frac_x / dpr, frac_y / dpr)
+        qp.scale(self.scale, self.scale)
+        qp.translate(-rect.x(), -rect.y())
+        self.paint_key(qp, key, palette, active, mask_active)
         qp.end()
+        return tile
+
+    def paint_key(self, qp, key, palette, active, mask_active):
+        """ Paints one keycap in the key's own unscaled coordinates, into a tile or straight onto the widget """
+
+        regular_pen = QPen(palette.text_color)
+
+        # draw keycap background/drop-shadow
+        qp.setPen(palette.active_pen if active else Qt.PenStyle.NoPen)
+        brush = palette.background
+        if key.pressed:
+            brush = palette.background_pressed
+        elif key.on:
+            brush = palette.background_on
+        qp.setBrush(brush)
+        qp.drawPath(key.background_draw_path)
+
+        # draw keycap foreground
+        qp.setPen(Qt.PenStyle.NoPen)
+        brush = palette.foreground
+        if key.pressed:
+            brush = palette.foreground_pressed
+        elif key.on:
+            brush = palette.foreground_on
+        qp.setBrush(brush)
+        qp.drawPath(key.foreground_draw_path)
+
+        # draw key text
+        if key.masked:
+            mask_font = qp.font()
+            mask_font.setPointSize(round(mask_font.pointSize() * 0.9))
+            mask_font.setStyleStrategy(mask_font.StyleStrategy.PreferAntialias)
+            mask_font.setFixedPitch(False)
+
+            # draw the outer legend
+            qp.setFont(mask_font)
+            qp.setPen(key.color if key.color else regular_pen)
+            qp.drawText(key.nonmask_rect, Qt.AlignmentFlag.AlignCenter, key.text)
+
+            # draw the inner highlight rect
+            qp.setPen(palette.active_pen if mask_active else Qt.PenStyle.NoPen)
+            qp.setBrush(palette.mask)
+            qp.drawRoundedRect(key.mask_rect, key.corner, key.corner)
+
+            # draw the inner legend
+            qp.setPen(key.mask_color if key.mask_color else regular_pen)
+            qp.drawText(key.mask_rect, Qt.AlignmentFlag.AlignCenter, key.mask_text)
+        else:
+            # draw the legend
+            qp.setPen(key.color if key.color else regular_pen)
+            qp.drawText(key.text_rect, Qt.AlignmentFlag.AlignCenter, key.text)
+
+        # draw the extra shape (encoder arrow)
+        qp.setPen(regular_pen)
+        qp.setBrush(palette.extra)
+        qp.drawPath(key.extra_draw_path)
 
     def minimumSizeHint(self):
         return QSize(self.width, self.height)
@@ -486,15 +676,11 @@ class KeyboardWidget(QWidget):
     def hit_test(self, pos):
         """ Returns key, hit_masked_part """
 
-        for key in self.widgets:
-            try:
-                fill_rule = Qt.FillRule.OddEvenFill
-            except Exception:
-                fill_rule = Qt.OddEvenFill
-            pt = QPointF(pos.x() / self.scale, pos.y() / self.scale)
-            if key.masked and key.mask_polygon.containsPoint(pt, fill_rule):
+        pt = QPointF(pos.x() / self.scale, pos.y() / self.scale)
+        for key in self.index.candidates(pt):
+            if key.masked and key.mask_polygon.containsPoint(pt, Qt.FillRule.OddEvenFill):
                 return key, True
-            if key.polygon.containsPoint(pt, fill_rule):
+            if key.polygon.containsPoint(pt, Qt.FillRule.OddEvenFill):
                 return key, False
 
         return None, False
@@ -503,16 +689,13 @@ class KeyboardWidget(QWidget):
         if not self.enabled:
             return
 
+        previous = self.active_key
         self.active_key, self.active_mask = self.hit_test(ev.pos())
         if self.active_key is not None:
             self.clicked.emit()
         else:
             self.deselected.emit()
-        self.update()
-
-    def resizeEvent(self, ev):
-        if self.isEnabled():
-            self.update_layout()
+        self.update_keys([key for key in (previous, self.active_key) if key is not None])
 
     def select_next(self):
         """ Selects next key based on their order in the keymap """
@@ -541,7 +724,7 @@ class KeyboardWidget(QWidget):
                 QToolTip.showText(ev.globalPos(), key.tooltip)
             else:
                 QToolTip.hideText()
-        elif ev.type() == QEvent.Type.LayoutRequest:
+        elif ev.type() in (QEvent.Type.LayoutRequest, QEvent.Type.FontChange):
             self.update_layout()
         elif ev.type() == QEvent.Type.MouseButtonDblClick and self.active_key:
             self.anykey.emit()
@@ -551,7 +734,9 @@ class KeyboardWidget(QWidget):
         self.enabled = val
 
     def set_scale(self, scale):
-        self.scale = scale
+        if scale != self.scale:
+            self.scale = scale
+            self.update_size()
 
     def get_scale(self):
         return self.scale